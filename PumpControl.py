@@ -1,12 +1,22 @@
 #!/usr/bin/python3.9.6
-import RPi.GPIO as GPIO
+import copy
+import math
+import threading
 import time
-import board
-import busio
-from adafruit_ads1x15 import ads1115 as ADS
-from adafruit_ads1x15.analog_in import AnalogIn
-from datetime import datetime
-import csv
+import traceback
+
+from sampling import PressureSample, voltage_to_pressure
+from acquisition import ContinuousAcquisition, ScanningAcquisition
+from scheduler import Phase, PhaseStats, TickScheduler
+from controller import BangBangController
+from protocol import PhaseSpec, compile_protocol
+from events import EVENT_FIELDS, Actuator, EventKind, EventLog
+from session_clock import SessionClock
+from session_logger import FileHandler, NoFileHandler
+from metrics import Metrics, clock_ns
+from filters import PressureFilter
+from calibration import CalibrationProfile, ProfileCache, load_or_calibrate
+from safety_supervisor import SafetyLimits, SafetySupervisor
 
 class PumpControl:
     def __init__(self, 
@@ -15,7 +25,24 @@ class PumpControl:
                 desired_inflate_time: float,
                 desired_hold_time: float,
                 desired_deflate_time: float,
-                desired_time_between_trials: float):
+                desired_time_between_trials: float,
+                continuous_data_rate: int = None,
+                control_frequency: float = 100.0,
+                controller = None,
+                pwm_frequency: float = None,
+                scan_channels: list = None,
+                pins: tuple = None,
+                ads_address: int = 0x48,
+                i2c = None,
+                bus_lock = None,
+                log_prefix: str = None,
+                session_clock: SessionClock = None,
+                metrics: Metrics = None,
+                pressure_filter: PressureFilter = None,
+                calibration: CalibrationProfile = None,
+                calibration_cache: str = None,
+                safety_limits: SafetyLimits = SafetyLimits(),
+                session_files: bool = True):
         
         ### Trial Settings ###
         self.desired_number_of_trials = desired_number_of_trials
@@ -24,6 +51,24 @@ class PumpControl:
         self.desired_hold_time = desired_hold_time
         self.desired_deflate_time = desired_deflate_time
         self.desired_time_between_trials = desired_time_between_trials
+
+        # Control loop rate in Hz. Every trial phase runs one control step per tick
+        self.control_frequency = control_frequency
+
+        # Timeline of phases with the setpoint of every tick, see protocol.py
+        self.protocol = compile_protocol(desired_number_of_trials, desired_pressure, desired_inflate_time,
+                                         desired_hold_time, desired_deflate_time, desired_time_between_trials,
+                                         control_frequency)
+        self.phase_spec = self.protocol.phases[0]
+
+        # Turns the setpoint of each tick into a pump command, see controller.py.
+        # Bang-bang is the default; pass a PidController for PID + feed-forward control
+        self.controller = controller if controller is not None else BangBangController()
+
+        # Optional streaming filter between the ADC and the controller, see filters.py.
+        # The trace keeps the raw readings; the controller, GUI and last_sample get the
+        # filtered pressure. Without a filter the controller acts on every raw reading
+        self.pressure_filter = pressure_filter
         
         # Set channel to pin number for BOARD
         #InflateChannel = 33
@@ -34,6 +79,129 @@ class PumpControl:
         self.InflateChannel = 13
         self.DeflateChannel = 12
         self.ValveChannel = 27
+        # pins = (inflate, deflate, valve) moves a cuff to other pins, i.e. a second cuff
+        if pins is not None:
+            self.InflateChannel, self.DeflateChannel, self.ValveChannel = pins
+
+        # I2C address of the ADS1115 (0x48-0x4B, set by its ADDR pin). Several cuffs in one
+        # process share one I2C bus and one lock that every read on the bus holds, see
+        # device_manager.py. Without a shared bus this PumpControl opens its own
+        self.ads_address = ads_address
+        self.shared_i2c = i2c
+        self.bus_lock = bus_lock if bus_lock is not None else threading.Lock()
+
+        # Hot path counters and histograms, see metrics.py. They are served live by a
+        # metrics.MetricsServer and summarised as METRIC events when the session closes.
+        # A DeviceManager gives every cuff a registry labelled with the cuff name
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.adc_time = self.metrics.histogram('adc_conversion_seconds', "ADC read time, from holding the bus lock to the result")
+        self.gpio_time = self.metrics.histogram('gpio_write_seconds', "Time of one pump or valve pin write")
+
+        # Safety supervisor, see safety_supervisor.py. A thread with its own pressure reading
+        # and hard pressure, duration and heartbeat limits vents the cuff even if the control
+        # loop is stuck. It starts with the first phase; safety_limits=None runs without one.
+        # heartbeat is the clock_ns time of the control loop's latest sample
+        self.supervisor = SafetySupervisor(self, safety_limits) if safety_limits is not None else None
+        self.safety_trip = None
+        self.heartbeat = clock_ns()
+        # Set by emergency_shutoff, which releases the pins and so only runs once
+        self.shut_off = False
+
+        # Monotonic clock and sleep used for timestamps and control ticks.
+        # Replaced by a simulated clock in PumpControlSimulator, which also sets the
+        # async_sleep used by async_runtime.py (asyncio.sleep when a backend has none)
+        self.clock_source_ns = time.perf_counter_ns
+        self.sleep = time.sleep
+
+        # Sets self.GPIO, self.ads and self.pressure_channel
+        self.setup_hardware()
+
+        # Session timebase, see session_clock.py. Samples, events and phase timing are all
+        # offsets from the session start on the same clock: self.clock() in seconds and
+        # self.clock_ns() in nanoseconds. Cuffs run together by a DeviceManager share one
+        self.session_clock = session_clock if session_clock is not None else SessionClock(self.clock_source_ns)
+        self.clock = self.session_clock.time
+        self.clock_ns = self.session_clock.time_ns
+
+        # Pressure sensor calibration, see calibration.py. With a calibration_cache (a JSON
+        # file) the cached profile of this ADC is used while it is fresh; otherwise the vented
+        # cuff is zeroed now and the profile saved. Without either the constants in
+        # sampling.py are used
+        if calibration is None and calibration_cache is not None:
+            calibration, _ = load_or_calibrate(self.read_voltage, self.ads_address, ProfileCache(calibration_cache))
+        self.calibration = calibration if calibration is not None else CalibrationProfile(self.ads_address)
+        self.ads_offset = self.calibration.offset
+        self.pressure_per_volt = self.calibration.gain
+
+        # Optional continuous acquisition. When a data rate (128-860 SPS) is given the ADS
+        # converts continuously and a background thread fills a ring buffer, so the control
+        # loops read the latest sample instead of waiting on a single-shot conversion.
+        # Alternatively scan_channels, a list of acquisition.ScanChannel, multiplexes several
+        # ADS inputs (i.e. acquisition.PRESSURE_SCAN) into one buffer per channel. The first
+        # channel must be the cuff pressure, it is the one the control loop reads.
+        self.acquisition = None
+        if continuous_data_rate is not None and scan_channels is not None:
+            raise ValueError("Use either continuous_data_rate or scan_channels, not both")
+        if continuous_data_rate is not None:
+            self.start_acquisition(continuous_data_rate)
+        elif scan_channels is not None:
+            self.start_scanning(scan_channels)
+
+
+
+        ### Data Logging ###
+        # Each cuff of a DeviceManager gets its own prefix so their files do not collide
+        if log_prefix is not None:
+            self.log_prefix = log_prefix
+        # Session events are kept in a typed, columnar EventLog (events.py) and streamed
+        # to the session CSV while trials run. With session_files=False nothing is written,
+        # i.e. when the hardware is only used to calibrate
+        self.log_file = self.FileHandler(self.log_prefix) if session_files else NoFileHandler()
+        self.session_log = self.log_file.open_logger(EVENT_FIELDS)
+        self.session_log.queue_depth = self.metrics.histogram('log_queue_depth', "Session CSV rows waiting to be written", unit=1)
+        self.metrics.counter('log_rows_dropped_total', "Session CSV rows dropped because the queue was full",
+                             lambda: self.session_log.dropped)
+        self.metrics.counter('adc_missed_samples_total', "Conversions the acquisition thread skipped to catch up",
+                             lambda: self.acquisition.missed if self.acquisition is not None else 0)
+        self.events = EventLog(self.clock_ns, self.stream_event)
+
+        # Pressure samples go to a binary trace tagged with the current phase and trial
+        self.phase = Phase.IDLE
+        self.trial = 0
+        self.trace = self.log_file.open_trace(self.trial_parameters())
+
+        # Define the inflation, deflation, and valve as FlowObject state machines
+        # Control pin number and object name are passed to create the state machines
+        # With a pwm_frequency the pumps are driven at the duty the controller asks for,
+        # otherwise they are switched fully on or off
+        # Every on/off transition is recorded as an ACTUATOR event
+        self.inflation_pump = self.FlowObject(self.GPIO, self.InflateChannel, 'inflation_pump', pwm_frequency, self.clock, self.log_transition, self.gpio_time)
+        self.deflation_pump = self.FlowObject(self.GPIO, self.DeflateChannel, 'deflation_pump', pwm_frequency, self.clock, self.log_transition, self.gpio_time)
+        self.valve = self.FlowObject(self.GPIO, self.ValveChannel, 'valve', None, self.clock, self.log_transition, self.gpio_time)
+
+        # Most recent pressure sample, shared by the controller, the log and the GUI.
+        # raw_sample is the same sample before the pressure filter
+        self.last_sample = self.raw_sample = self.read_sample()
+        if self.pressure_filter is not None:
+            self.pressure_filter.reset()
+            self.last_sample = self.pressure_filter.filter_sample(self.last_sample)
+        # Setpoint of the most recent control step in mmHg
+        self.setpoint = 0.0
+
+    ### Hardware Setup ###
+    # Hardware libraries are imported here rather than at module import, so PumpControl
+    # (and PumpControlSimulator) can be imported on a machine without the Pi libraries
+    def setup_hardware(self) -> None:
+        # Input: None
+        # Return: None
+        import RPi.GPIO as GPIO
+        import board
+        import busio
+        from adafruit_ads1x15 import ads1115 as ADS
+        from adafruit_ads1x15.analog_in import AnalogIn
+        self.GPIO = GPIO
+        self.ADS = ADS
+        self.AnalogIn = AnalogIn
 
         ### GPIO setup ###
         # BOARD chooses channels by printed numbers on RPi, i.e. 40
@@ -47,73 +215,154 @@ class PumpControl:
         GPIO.setup(self.DeflateChannel, GPIO.OUT)
         GPIO.setup(self.ValveChannel, GPIO.OUT)
 
-
-
         ### ADC Control Functions ###
         # Guide - https://learn.adafruit.com/adafruit-4-channel-adc-breakouts/python-circuitpython
-        self.i2c = busio.I2C(board.SCL, board.SDA)
-        self.ads = ADS.ADS1115(self.i2c)
+        self.i2c = self.shared_i2c if self.shared_i2c is not None else busio.I2C(board.SCL, board.SDA)
+        self.ads = ADS.ADS1115(self.i2c, address=self.ads_address)
         # ADS gain is not used, so it is set to the default of 1
         self.ads.gain = 1
 
         # ADS mode set to single stream
         self.ads.mode = ADS.Mode.SINGLE
-        # TODO: Offset is calculated at initialization to determine OpAmp bias
-        #self.ads_offset = AnalogIn(self.ads, ADS.P0).voltage
-
+        # The op-amp bias (ads_offset) is measured at initialization by calibration.py
 
+        # The pressure channel is created once and reused for every conversion
+        self.pressure_channel = AnalogIn(self.ads, ADS.P0)
 
-        ### Data Logging ###
-        # 2 dimensional array that stores device activity for debugging
-        self.activity_log = [['Time', 'Object', 'Activity', 'Details']]
-
-        # Define the inflation, deflation, and valve as FlowObject state machines
-        # Control pin number and object name are passed to create the state machines
-        self.inflation_pump = self.FlowObject(self.InflateChannel, 'inflation_pump')
-        self.deflation_pump = self.FlowObject(self.DeflateChannel, 'deflation_pump')
-        self.valve = self.FlowObject(self.ValveChannel, 'valve')
+    # Switch the ADS to continuous conversion and start the acquisition thread
+    def start_acquisition(self, data_rate: int) -> None:
+        # Input: int (samples per second, 128-860)
+        # Return: None
+        self.acquisition = ContinuousAcquisition(self.pressure_channel, data_rate, clock=self.clock, lock=self.bus_lock,
+                                                 conversion_time=self.adc_time, convert=self.calibration.to_pressure)
+        self.ads.data_rate = data_rate
+        self.ads.mode = self.ADS.Mode.CONTINUOUS
+        self.acquisition.start()
+        self.wait_for_acquisition()
+
+    # Scan several ADS inputs in single-shot mode, see acquisition.ScanningAcquisition
+    def start_scanning(self, channels: list) -> None:
+        # Input: list of ScanChannel
+        # Return: None
+        # The cuff pressure channel converts with this ADC's calibration
+        if channels[0].convert is voltage_to_pressure:
+            channels = list(channels)
+            channels[0] = copy.copy(channels[0])
+            channels[0].convert = self.calibration.to_pressure
+        self.ads.mode = self.ADS.Mode.SINGLE
+        self.acquisition = ScanningAcquisition(self.ads, channels, lambda pin: self.AnalogIn(self.ads, pin),
+                                               clock=self.clock, lock=self.bus_lock, conversion_time=self.adc_time)
+        self.acquisition.start()
+        self.wait_for_acquisition()
+
+    # Wait for the first sample of the acquisition thread. Raises the thread's error, or
+    # RuntimeError when no sample arrives within timeout
+    def wait_for_acquisition(self, timeout: float = 1.0) -> None:
+        # Input: float (seconds)
+        # Return: None
+        if not self.acquisition.wait_for_sample(timeout):
+            self.acquisition.stop()
+            raise RuntimeError("No sample from the ADS1115 at address " + hex(self.ads_address)
+                               + " within " + format(timeout, 'g') + " s")
+
+    # Newest sample of a scanned channel, i.e. 'line' or 'supply'. None without scanning
+    def read_channel(self, name: str) -> PressureSample:
+        # Input: str (channel name)
+        # Return: PressureSample (value in the channel's unit) or None
+        if not isinstance(self.acquisition, ScanningAcquisition):
+            return None
+        return self.acquisition.latest(name)
+
+    # Hardware shared by several PumpControls in one process: one I2C bus and the lock
+    # for it. DeviceManager passes these to every cuff as keyword arguments
+    @classmethod
+    def shared_hardware(cls, **options) -> dict:
+        # Input: backend keyword arguments
+        # Return: dict (keyword arguments for every PumpControl)
+        import board
+        import busio
+        return {'i2c': busio.I2C(board.SCL, board.SDA), 'bus_lock': threading.Lock()}
 
     ### File Handling ###
-    class FileHandler:
-        # Data source indicates what generated the data being written to the file.
-        # Default is set to pressure
-        def __init__(self, data_source: str = "Log_") -> None:
-            # File name is source + current time (YYYY-MM-DD_HH_mm_ss)
-            # ex. "pressure_2023-2-19_11-32-55.csv"
-            self.__file_name = data_source + datetime.now().strftime("%Y-%m-%d_%H-%M-%S") + ".csv"
-        
-        def write_session(self, output: list[list]) -> None:
-            with open(self.__file_name, 'w') as file:
-                writer = csv.writer(file)
-                for row in output:
-                    writer.writerow(row)
-
-        def read_file(self):
-            with open(self.__file_name, 'r') as file:
-                reader = csv.reader(file)
-                for row in reader:
-                    print('#' + str(reader.line_num) + ' ' + str(row))
+    # FileHandler is shared with PumpControlTester, see session_logger.py
+    FileHandler = FileHandler
+    # Prefix of the session file names
+    log_prefix = "Log_"
 
 
 
     ### Flow Control State Machines ###
-    # FlowObject holds the logic for enabling and disabling the pumps and valves
+    # FlowObject holds the logic for enabling and disabling the pumps and valves.
+    # Hardware is only written and an event only emitted when the state actually changes,
+    # so control steps can request the same state every tick for free. Each FlowObject
+    # counts its transitions, total on time and the time of its last transition.
     class FlowObject:
-        
-        # When creating a FlowObject, the corresponding pin must be passed.
-        def __init__(self, pin: int, name: str) -> None:
-            # Input: int (Pin number), str (name of FlowObject)
+        __slots__ = ('__output', '__high', '__low', '__pwm_duty', '__pin', '__name', '__clock', '__on_transition',
+                     '__write_time', '__state', '__duty', '__on_since', '__locked_out', 'toggles', 'on_time', 'last_transition')
+
+        # When creating a FlowObject, the GPIO module and corresponding pin must be passed.
+        # Pumps can be given a PWM frequency in Hz to allow running at part duty.
+        # on_transition is called with the FlowObject whenever it turns on or off, and
+        # write_time receives the time of every pin write
+        def __init__(self, gpio, pin: int, name: str, pwm_frequency: float = None,
+                     clock=time.perf_counter, on_transition=None, write_time=None) -> None:
+            # Input: GPIO module, int (Pin number), str (name of FlowObject), optional float (PWM frequency in Hz),
+            #        callable (clock in seconds), optional callable (receives the FlowObject),
+            #        optional metrics.Histogram (nanoseconds)
             # Return: None
             self.__state = False # False = OFF/OPEN, True = ON/CLOSED
             self.__pin = pin
             self.__name = name
-
-        # Set the desired state of the pump or valve
-        def set_state(self, state: bool) -> list:
-            # Input: boolean (flow state)
-            # Return: None
+            self.__clock = clock
+            self.__on_transition = on_transition
+            self.__write_time = write_time
+            self.__duty = 0.0
+            self.__on_since = 0.0
+            self.__locked_out = False
+
+            # Cached pin handle: bound output function and levels, or the PWM duty setter
+            self.__output = gpio.output
+            self.__high = gpio.HIGH
+            self.__low = gpio.LOW
+            self.__pwm_duty = None
+            if pwm_frequency is not None:
+                pwm = gpio.PWM(pin, pwm_frequency)
+                pwm.start(0)
+                self.__pwm_duty = pwm.ChangeDutyCycle
+            else:
+                self.__output(pin, self.__low) # Start from a known state
+
+            ### Counters ###
+            self.toggles = 0
+            self.on_time = 0.0 # Seconds spent on, not counting the current on period
+            self.last_transition = None
+
+        # Set the desired state of the pump or valve. force writes the pin even if the
+        # state is unchanged, i.e. during an emergency shutoff
+        def set_state(self, state: bool, force: bool = False) -> bool:
+            # Input: boolean (flow state), boolean (write even if unchanged)
+            # Return: boolean (True if the state changed)
+            if state == self.__state:
+                if force:
+                    self.set_action()
+                return False
+            if state and self.__locked_out:
+                return False
             self.__state = state
-            return self.set_action()
+            self.set_action()
+            self.__transition(state)
+            return True
+
+        @property
+        def name(self) -> str:
+            return self.__name
+
+        # Duty cycle the pump or valve is running at, 0 when off
+        @property
+        def duty(self) -> float:
+            if self.__pwm_duty is not None:
+                return self.__duty
+            return 1.0 if self.__state else 0.0
 
         # Get the current state of the pump or valve
         def get_state(self) -> bool:
@@ -121,27 +370,105 @@ class PumpControl:
             # Return: boolean (current flow state)
             return self.__state
 
+        # Set the duty cycle of a pump between 0 (off) and 1 (fully on).
+        # Without PWM any duty above 0 turns the pump fully on.
+        def set_duty(self, duty: float) -> bool:
+            # Input: float (duty cycle)
+            # Return: boolean (True if the pump turned on or off)
+            state = duty > 0
+            if state and self.__locked_out:
+                return False
+            if self.__pwm_duty is None:
+                return self.set_state(state)
+            if duty != self.__duty:
+                self.__duty = duty
+                start = clock_ns()
+                self.__pwm_duty(duty * 100)
+                if self.__write_time is not None:
+                    self.__write_time.record(clock_ns() - start)
+            if state == self.__state:
+                return False
+            self.__state = state
+            self.__transition(state)
+            return True
+
+        # Seconds spent on, including the current on period
+        def total_on_time(self) -> float:
+            # Input: None
+            # Return: float (seconds)
+            if self.__state:
+                return self.on_time + self.__clock() - self.__on_since
+            return self.on_time
+
         # Apply the current state to the pump or valve
-        def set_action(self) -> list:
+        def set_action(self) -> None:
+            # Input: None
+            # Return: None
+            start = clock_ns()
+            on = self.__state and not self.__locked_out
+            if self.__pwm_duty is not None:
+                self.__duty = 1.0 if on else 0.0
+                self.__pwm_duty(self.__duty * 100)
+            else:
+                self.__output(self.__pin, self.__high if on else self.__low)
+            if self.__write_time is not None:
+                self.__write_time.record(clock_ns() - start)
+
+        # Write the pin off (pump off, valve open) and keep it off whatever is asked for later.
+        # Called by the safety supervisor on its own thread, so only the pin is written; the
+        # state, counters and events stay with the control thread's emergency_shutoff
+        def lock_out(self) -> None:
             # Input: None
             # Return: None
-            global activity_log
-            if not self.__state:
-                GPIO.output(self.__pin, GPIO.LOW)
-                return [datetime.now().strftime("%H:%M:%S"), "Turn off " + self.__name]
+            self.__locked_out = True
+            if self.__pwm_duty is not None:
+                self.__pwm_duty(0)
+            else:
+                self.__output(self.__pin, self.__low)
+
+        @property
+        def locked_out(self) -> bool:
+            return self.__locked_out
+
+        # Update counters and report the transition
+        def __transition(self, state: bool) -> None:
+            now = self.__clock()
+            self.toggles += 1
+            self.last_transition = now
+            if state:
+                self.__on_since = now
             else:
-                GPIO.output(self.__pin, GPIO.HIGH)
-                return [datetime.now().strftime("%H:%M:%S"), "Turn on " + self.__name]
+                self.on_time += now - self.__on_since
+            if self.__on_transition is not None:
+                self.__on_transition(self)
 
-    # Trigger emergency shutoff of pumps, opens valves to vent system
+    # Trigger emergency shutoff of pumps, opens valves to vent system. Later calls return at
+    # once: the pins are already released, and RPi.GPIO raises on a released pin
     def emergency_shutoff(self) -> None:
         # Input: None
         # Return: None
-        self.log_activity([datetime.now().strftime("%H:%M:%S"), "Emergency Shutoff"])
-        self.log_activity(self.inflation_pump.set_state(False)) # False = OFF
-        self.log_activity(self.deflation_pump.set_state(False))
-        self.log_activity(self.valve.set_state(False))
-        GPIO.cleanup()
+        if self.shut_off:
+            return
+        self.shut_off = True
+        self.log_note("Emergency Shutoff")
+        # The supervisor stops writing the pins before they are released
+        if self.supervisor is not None:
+            self.supervisor.stop()
+        self.inflation_pump.set_state(False, force=True) # False = OFF
+        self.deflation_pump.set_state(False, force=True)
+        self.valve.set_state(False, force=True)
+        if self.acquisition is not None:
+            self.acquisition.stop()
+        # Only this cuff's pins are released, other cuffs on the same Pi keep running
+        self.GPIO.cleanup((self.InflateChannel, self.DeflateChannel, self.ValveChannel))
+
+    # Pumps off and valves open from the safety supervisor's thread, see FlowObject.lock_out
+    def lock_out(self) -> None:
+        # Input: None
+        # Return: None
+        self.inflation_pump.lock_out()
+        self.deflation_pump.lock_out()
+        self.valve.lock_out()
 
 
 
@@ -150,127 +477,370 @@ class PumpControl:
         # Input: float 
         # Return: None
         # Turn on inflation pump while current pressure below threshold
-        self.log_activity([datetime.now().strftime("%H:%M:%S"), "Raise Pressure Start"])
-        while self.get_pressure() < target_pressure:
+        # Every reading goes to the pressure trace; the end note has the final pressure
+        self.log_note("Raise Pressure Start")
+        current_pressure = self.get_pressure()
+        while current_pressure < target_pressure:
+            self.deflation_pump.set_state(False) # Ensure deflation pump is off
+            self.inflation_pump.set_state(True)
             current_pressure = self.get_pressure()
-            print(current_pressure)
-            self.log_activity(self.deflation_pump.set_state(False)) # Ensure deflation pump is off
-            if not self.inflation_pump.get_state():
-                self.log_activity(self.inflation_pump.set_state(True))
-        self.log_activity(self.inflation_pump.set_state(False))
-        print(self.get_pressure())
-        self.log_activity([datetime.now().strftime("%H:%M:%S"), "Raise Pressure End"])
+        self.inflation_pump.set_state(False)
+        self.log_note("Raise Pressure End", current_pressure)
 
     def lower_pressure(self, target_pressure: float) -> None:
         # Input: float 
         # Return: None
         # Turn on inflation pump while current pressure below threshold
-        self.log_activity([datetime.now().strftime("%H:%M:%S"), "Lower Pressure Start"])
-        while self.get_pressure() > target_pressure:
-            current_pressure = self.get_pressure() 
-            print(current_pressure)
-            self.log_activity(self.inflation_pump.set_state(False)) # Ensure inflation pump is off
-            if not self.deflation_pump.get_state():
-                self.log_activity(self.deflation_pump.set_state(True))
-        print(self.get_pressure())
-        self.log_activity(self.deflation_pump.set_state(False))
-        self.log_activity([datetime.now().strftime("%H:%M:%S"), "Lower Pressure End"])
+        self.log_note("Lower Pressure Start")
+        current_pressure = self.get_pressure()
+        while current_pressure > target_pressure:
+            self.inflation_pump.set_state(False) # Ensure inflation pump is off
+            self.deflation_pump.set_state(True)
+            current_pressure = self.get_pressure()
+        self.deflation_pump.set_state(False)
+        self.log_note("Lower Pressure End", current_pressure)
         
-    def inflation_line_pressure(self, target_pressure: float, inflate_time_elapsed: float, desired_inflate_time: float) -> float:
-        ## finds slope of inflation by dividing target pressure by total inflation time, then multiplies
-        ## by current time so the function can return what the pressure should be along the line
-        return ((target_pressure // desired_inflate_time) * inflate_time_elapsed)
+    ### Control Steps ###
+    # Each step takes one sample and makes one actuation decision. They are called once
+    # per tick by the TickScheduler with the time elapsed in the current phase.
+    # The setpoint and its slope come from the compiled protocol (protocol.py), so a step
+    # only looks the setpoint up in the table of the running phase.
+    def inflate_step(self, inflate_time_elapsed: float) -> None:
+        # Input: float (seconds since inflation started)
+        # Return: None
+        # Pressure follows the inflation line. The deflation pump is never used while inflating
+        spec = self.phase_spec
+        self.setpoint = spec.setpoint(inflate_time_elapsed)
+        command = self.controller.update(self.setpoint, spec.setpoint_rate, self.get_sample())
+        self.apply_command(max(command, 0.0))
+
+    def deflate_step(self, deflate_time_elapsed: float) -> None:
+        # Input: float (seconds since deflation started)
+        # Return: None
+        # Pressure follows the deflation line. The inflation pump is never used while deflating
+        spec = self.phase_spec
+        self.setpoint = spec.setpoint(deflate_time_elapsed)
+        command = self.controller.update(self.setpoint, spec.setpoint_rate, self.get_sample())
+        self.apply_command(min(command, 0.0))
+
+    # Hold keeps the pressure at the desired pressure with both pumps
+    def hold_step(self, hold_time_elapsed: float) -> None:
+        # Input: float (seconds since the phase started)
+        # Return: None
+        spec = self.phase_spec
+        self.setpoint = spec.setpoint(hold_time_elapsed)
+        command = self.controller.update(self.setpoint, spec.setpoint_rate, self.get_sample())
+        self.apply_command(command)
+
+    # Rest between trials only samples pressure
+    def rest_step(self, rest_time_elapsed: float) -> None:
+        # Input: float (seconds since the phase started)
+        # Return: None
+        self.get_pressure()
 
-    def deflation_line_pressure(self, target_pressure: float, deflate_start_time: float, desired_deflate_time: float) -> float:
-        ## finds slope of deflation by dividing target pressure by total inflation time, then multiplies
-        ## by current time. This value is how much the pressure should have dropped in the time elapsed, this is then
-        ## subtracted from the target pressure to provide a slope downward rather than upward like inflation_line_pressure
-        return (target_pressure - ((target_pressure // desired_deflate_time) * (time.perf_counter() - deflate_start_time)))
+    # Drive the pumps from a controller command between -1 (full deflation) and 1 (full inflation)
+    def apply_command(self, command: float) -> None:
+        # Input: float (pump command)
+        # Return: None
+        # The pump that has to stop is switched first so both pumps are never on together
+        if command > 0:
+            self.deflation_pump.set_duty(0.0)
+            self.inflation_pump.set_duty(command)
+        else:
+            self.inflation_pump.set_duty(0.0)
+            # abs, not -command: a command of 0 would become a duty of -0.0 in the events
+            self.deflation_pump.set_duty(abs(command))
 
+    # Turn both pumps off at the end of a ramp phase
+    def stop_pumps(self) -> None:
+        # Input: None
+        # Return: None
+        self.apply_command(0.0)
 
 
-    ### Pressure Sensor Querying Function ###
-    def get_pressure(self) -> float:
+
+    ### Pressure Sensor Querying Functions ###
+    # Performs exactly one ADC conversion, or returns the newest buffered sample when
+    # continuous acquisition is running. Converted with the calibration profile
+    def read_sample(self) -> PressureSample:
         # Input: None
-        # Return: Float (in mmHg)
-        chan = AnalogIn(self.ads, ADS.P0)
+        # Return: PressureSample (timestamp, voltage, mmHg)
+        if self.acquisition is not None:
+            return self.acquisition.latest()
+        with self.bus_lock:
+            start = clock_ns()
+            voltage = self.pressure_channel.voltage
+        self.adc_time.record(clock_ns() - start)
+        return PressureSample(self.clock(), voltage, (voltage + self.ads_offset) * self.pressure_per_volt)
+
+    # Pressure for the safety supervisor, read on its thread: the newest buffered sample in
+    # continuous mode, otherwise the control loop's last raw sample while it is at most
+    # max_age old, or a conversion of its own. None when the bus stayed busy for bus_timeout
+    def safety_pressure(self, max_age: float, bus_timeout: float) -> float:
+        # Input: float (seconds), float (seconds)
+        # Return: float (mmHg) or None
+        if self.acquisition is not None:
+            # A failed acquisition thread counts as no reading, so the sensor check trips
+            if self.acquisition.error is not None:
+                return None
+            sample = self.acquisition.latest()
+        else:
+            sample = self.raw_sample
+        if sample is not None and self.clock() - sample.timestamp <= max_age:
+            return sample.pressure
+        if not self.bus_lock.acquire(timeout=bus_timeout):
+            return None
+        try:
+            voltage = self.pressure_channel.voltage
+        finally:
+            self.bus_lock.release()
+        return self.calibration.to_pressure(voltage)
 
-        # Adds current pressure, timestamp, and voltage to pressure log
-        self.log_activity([datetime.now().strftime("%H:%M:%S"), chan.voltage, chan.voltage//0.1067])
+    # One single-shot ADC reading in V, i.e. for calibration
+    def read_voltage(self) -> float:
+        # Input: None
+        # Return: float (V)
+        with self.bus_lock:
+            return self.pressure_channel.voltage
 
-        #TODO: Fine tune ads_offset to obtain correct value at start
-        #return ((chan.voltage + ads_offset) * 9372)
-        return ((chan.voltage + 0.0042) * 9372)
-    # Example Output: 1.61679
-    # Pressure sensor outputs 0.1067 mV per mmHg
-    # Multiplier is set at 1/0.1067 * 1000, or 9372, to turn the ratio into mmHG per V because the ADC returns Volts, not mV.
-    # ads_offset is an offset to counteract bias introduced by an op amp, around 4-6 mV
-    #
+    # Reads one sample, adds it to the pressure trace and stores it, filtered if there is
+    # a pressure filter, as the latest sample
+    def get_sample(self) -> PressureSample:
+        # Input: None
+        # Return: PressureSample (filtered)
+        self.heartbeat = clock_ns()
+        sample = self.read_sample()
+        # In continuous mode the control loop can run faster than the ADC, so the same
+        # buffered sample is only recorded, and filtered, once
+        if sample.timestamp != self.last_sample.timestamp:
+            self.raw_sample = sample
+            self.trace.write(sample, self.phase, self.trial)
+            if self.pressure_filter is not None:
+                sample = self.pressure_filter.filter_sample(sample)
+            self.last_sample = sample
+        return self.last_sample
+
+    # Pressure slope in mmHg/s estimated by the pressure filter, nan without one
+    @property
+    def pressure_rate(self) -> float:
+        return self.pressure_filter.rate if self.pressure_filter is not None else math.nan
 
-    # 300 mmHg should output ~31.997 mV
+    def get_pressure(self) -> float:
+        # Input: None
+        # Return: Float (in mmHg)
+        return self.get_sample().pressure
 
 
 
     ### Input Sanitization ###
-    # Ensures that user input is numeric, not alphabetic
+    # Ensures that user input is a non-negative number, i.e. 6, 400 or 25.43
     def input_sanitizer(self, response: str) -> float:
         # Input: String (raw user input)
         # Return: Float (numerical user input)
-        if response.isnumeric():
-            return float(response)
-        else:
-            # If response is numeric, function will continue asking recursively until an adequate number is provided
-            return self.input_sanitizer(input("Please enter numbers only (Ex. 6, 400, 25.43) without any letters or special characters."))
+        # Asks again until an adequate number is provided, in a loop so repeated bad input cannot exhaust the stack
+        while True:
+            try:
+                value = float(response)
+            except ValueError:
+                value = math.nan
+            if math.isfinite(value) and value >= 0:
+                return value
+            response = input("Please enter numbers only (Ex. 6, 400, 25.43) without any letters or special characters.")
+
+    ### Logging Functions ###
+    def log_event(self, kind: EventKind, source: int = 0, value: float = math.nan, text: str = '') -> None:
+        # Input: EventKind, int (Actuator or Phase), float (payload), str (name or note), see events.py
+        # Return: None
+        self.events.record(kind, source, value, text)
+
+    def log_note(self, text: str, value: float = math.nan) -> None:
+        # Input: str (note), optional float (value)
+        # Return: None
+        self.events.record(EventKind.NOTE, 0, value, text)
 
-    ### Logging Function ###
-    def log_activity(self, entry: list):
-        self.activity_log.append(entry)
+    def log_transition(self, flow_object: "PumpControl.FlowObject") -> None:
+        # Input: FlowObject (after turning on or off)
+        # Return: None
+        self.events.record(EventKind.ACTUATOR, Actuator[flow_object.name.upper()], flow_object.duty)
 
-    def start_trials(self):
+    # Every recorded event is also queued for the session CSV
+    def stream_event(self, event) -> None:
+        # Input: Event
+        # Return: None
+        self.session_log.log(event.row())
+
+    # Trial parameters stored in the header of the pressure trace
+    def trial_parameters(self) -> dict:
+        # Input: None
+        # Return: dict
+        return {'number_of_trials': self.desired_number_of_trials,
+                'pressure': self.desired_pressure,
+                'inflate_time': self.desired_inflate_time,
+                'hold_time': self.desired_hold_time,
+                'deflate_time': self.desired_deflate_time,
+                'time_between_trials': self.desired_time_between_trials,
+                'control_frequency': self.control_frequency,
+                'calibration_offset': self.calibration.offset,
+                'calibration_gain': self.calibration.gain,
+                **self.session_clock.anchor()}
+
+    # Write out the actuator counters and everything still queued, then close the session files
+    def close_log(self) -> None:
+        # Input: None
+        # Return: None
+        if self.supervisor is not None:
+            self.supervisor.stop()
+        if self.safety_trip is not None:
+            trip = self.safety_trip
+            self.log_note("Safety trip " + trip.reason, trip.value)
+            self.log_event(EventKind.METRIC, 0, trip.latency, "safety.trip_latency")
+        for flow_object in (self.inflation_pump, self.deflation_pump, self.valve):
+            self.log_event(EventKind.METRIC, 0, flow_object.toggles, flow_object.name + ".toggles")
+            self.log_event(EventKind.METRIC, 0, flow_object.total_on_time(), flow_object.name + ".on_time")
+        for name, value in self.metrics.summary().items():
+            self.log_event(EventKind.METRIC, 0, value, name)
+        self.session_log.close()
+        self.trace.close()
+
+    # Scheduler running at the control frequency on this controller's clock
+    def make_scheduler(self) -> TickScheduler:
+        # Input: None
+        # Return: TickScheduler
+        return TickScheduler(self.control_frequency, self.clock, self.sleep, self.period_histogram())
+
+    # Histogram of the control loop period, for schedulers running this controller's steps
+    def period_histogram(self):
+        # Input: None
+        # Return: metrics.Histogram
+        return self.metrics.histogram('control_loop_period_seconds', "Time between the starts of two control steps")
+
+    # Control step for each phase
+    def step_for(self, phase: Phase):
+        # Input: Phase
+        # Return: callable (control step)
+        return {Phase.INFLATE: self.inflate_step, Phase.HOLD: self.hold_step,
+                Phase.DEFLATE: self.deflate_step, Phase.REST: self.rest_step}[phase]
+
+    # Make spec the running phase
+    def begin_phase(self, spec: PhaseSpec) -> None:
+        # Input: PhaseSpec
+        # Return: None
+        self.phase_spec = spec
+        self.phase = spec.phase
+        self.trial = spec.trial
+        self.events.trial = spec.trial
+        self.controller.reset()
+        self.log_event(EventKind.PHASE_START, spec.phase, spec.duration)
+        self.heartbeat = clock_ns()
+        if self.supervisor is not None:
+            self.supervisor.start()
+
+    # Finish the running phase and record its actual duration and tick timing.
+    # The pumps are stopped at the end of the inflation and deflation ramps
+    def end_phase(self, spec: PhaseSpec, stats: PhaseStats) -> None:
+        # Input: PhaseSpec, PhaseStats
+        # Return: None
+        phase = spec.phase
+        self.phase = Phase.IDLE
+        if phase in (Phase.INFLATE, Phase.DEFLATE):
+            self.stop_pumps()
+        self.trace.flush()
+
+        self.log_event(EventKind.PHASE_END, phase, stats.duration)
+        for name, value in stats.metrics().items():
+            self.log_event(EventKind.METRIC, phase, value, name)
+
+    # Run one phase of the protocol on the scheduler. The phase also ends when the safety
+    # supervisor trips
+    def run_phase(self, scheduler: TickScheduler, spec: PhaseSpec, step=None, keep_running=None) -> PhaseStats:
+        # Input: TickScheduler, PhaseSpec, optional callable (control step, default step_for(phase)),
+        #        optional callable (returns bool)
+        # Return: PhaseStats
+        def safe() -> bool:
+            return self.safety_trip is None and (keep_running is None or keep_running())
+
+        self.begin_phase(spec)
+        stats = scheduler.run_phase(spec.phase, spec.duration, step or self.step_for(spec.phase), safe)
+        self.end_phase(spec, stats)
+        return stats
+
+    ### Enters user input to activity log ###
+    def log_parameters(self) -> None:
+        # Input: None
+        # Return: None
+        for name, value in self.trial_parameters().items():
+            if isinstance(value, (int, float)) and name != 'wall_start_ns':
+                self.log_event(EventKind.PARAMETER, 0, value, name)
+        self.log_note("Controller " + type(self.controller).__name__)
+        # Value is the age of the profile in seconds, inf for the default constants
+        self.log_note("Calibration " + self.calibration.method, self.calibration.age())
+        if self.pressure_filter is not None:
+            self.log_note("Filter " + type(self.pressure_filter).__name__)
+
+    # Control step that passes the sample it took to on_sample, i.e. to show it on the GUI
+    def sampling_step(self, step, on_sample):
+        # Input: callable (control step), callable (receives a PressureSample)
+        # Return: callable (control step)
+        def sampled(elapsed: float) -> None:
+            step(elapsed)
+            on_sample(self.last_sample)
+        return sampled
+
+    # Run the whole protocol, then shut off and close the session files however it ended.
+    # keep_running is checked every tick, returning False halts the session. A session
+    # vented by the safety supervisor ends as TRIPPED. on_sample receives the sample of
+    # every control step
+    def run_trials(self, keep_running=None, on_sample=None) -> str:
+        # Input: optional callable (returns bool), optional callable (receives a PressureSample)
+        # Return: str (COMPLETE, HALTED, TRIPPED or ERROR)
+        outcome = 'COMPLETE'
         try:
-            ### Enters user input to activity log ###
-            self.log_activity([datetime.now().strftime("%H:%M:%S"), "Number of Trials", str(self.desired_number_of_trials)])
-            self.log_activity([datetime.now().strftime("%H:%M:%S"), "Target Pressure", str(self.desired_pressure)])
-            self.log_activity([datetime.now().strftime("%H:%M:%S"), "Desired inflate time", str(self.desired_inflate_time)])
-            self.log_activity([datetime.now().strftime("%H:%M:%S"), "Desired hold time", str(self.desired_hold_time)])
-            self.log_activity([datetime.now().strftime("%H:%M:%S"), "Desired deflate time", str(self.desired_deflate_time)])
-            self.log_activity([datetime.now().strftime("%H:%M:%S"), "Time between Trials", str(self.desired_time_between_trials)])
-
-            ## Total trial time equation. 
-            total_trial_time = self.desired_number_of_trials * (self.desired_inflate_time + self.desired_hold_time + self.desired_deflate_time) + (self.desired_time_between_trials * (self.desired_number_of_trials - 1))
-            
-            start_time = time.perf_counter()
-            while (time.perf_counter() - start_time) < total_trial_time:            
-                ## Inflation cycle. Starting time for inflation is recorded, and a function is called to compare current pressure
-                ## to desired pressure at the current time. While loop keeps this running for as long as desired inflate time
-                ## has not been reached
-                inflate_start_time = time.perf_counter()
-                while ((time.perf_counter() - self.desired_inflate_time - inflate_start_time) < 0):
-                    self.raise_pressure(self.inflation_line_pressure(self.desired_pressure, (time.perf_counter() - inflate_start_time), self.desired_inflate_time))
-                
-                self.log_activity([datetime.now().strftime("%H:%M:%S"), "Actual inflate time", str(time.perf_counter() - inflate_start_time)])
-
-                ## While loop essentially waits the program for the hold time requested            
-                hold_start_time = time.perf_counter()
-                while ((time.perf_counter() - hold_start_time) < self.desired_hold_time):
-                    print("Holding at ", self.get_pressure())
-
-                self.log_activity([datetime.now().strftime("%H:%M:%S"), "Actual hold time", str(time.perf_counter() - hold_start_time)])
-
-                ## Deflation cycle. Essentially the same as inflation cycle            
-                deflate_start_time = time.perf_counter()
-                while ((time.perf_counter() - self.desired_deflate_time - deflate_start_time) < 0):
-                    self.lower_pressure(self.deflation_line_pressure(self.desired_pressure, deflate_start_time, self.desired_deflate_time))
-                
-                self.log_activity([datetime.now().strftime("%H:%M:%S"), "Actual deflate time", str(time.perf_counter() - deflate_start_time)])    
+            self.log_parameters()
+
+            ## Every phase of the compiled protocol runs on the scheduler at the control frequency.
+            ## Each tick of inflation and deflation follows the setpoint table of the ramp, hold
+            ## regulates at the desired pressure and rest between trials only samples pressure.
+            ## The scheduler sleeps between ticks instead of spinning, and records jitter and
+            ## overruns per phase
+            scheduler = self.make_scheduler()
+            for spec in self.protocol.phases:
+                if self.safety_trip is not None:
+                    break
+                if keep_running is not None and not keep_running():
+                    outcome = 'HALTED'
+                    break
+                step = self.step_for(spec.phase)
+                if on_sample is not None:
+                    step = self.sampling_step(step, on_sample)
+                stats = self.run_phase(scheduler, spec, step, keep_running)
+                # The STOP may land in any phase, the last one included
+                if stats.stopped:
+                    outcome = 'HALTED'
+                    break
         except KeyboardInterrupt:
             self.emergency_shutoff()
-            
-        except:
+            outcome = 'HALTED'
+
+        except Exception:
+            self.emergency_shutoff()
+            # Callers only get the outcome, the traceback is kept in the session log
+            self.log_note(traceback.format_exc())
+            outcome = 'ERROR'
+
+        except BaseException:
+            # i.e. SystemExit: vent the cuff and close the files, then let it through
             self.emergency_shutoff()
+            self.close_log()
+            raise
+
+        if self.safety_trip is not None and outcome != 'ERROR':
+            outcome = 'TRIPPED'
 
         self.emergency_shutoff()
 
-        log_file = self.FileHandler()
-        log_file.write_session(self.activity_log)
-        log_file.read_file()
\ No newline at end of file
+        self.close_log()
+        return outcome
+
+    def start_trials(self):
+        self.run_trials()
+        self.log_file.read_file()
@@ -0,0 +1,312 @@
+#!/usr/bin/python3.9.6
+import argparse
+import contextlib
+import io
+import json
+import os
+from array import array
+
+from PumpControl import PumpControl
+from PumpControlSimulator import SimulatedClock
+from pressure_trace import read_trace, read_trace_header
+from sampling import PressureSample
+from scheduler import Phase
+from events import EventKind
+from controller import CONTROLLERS, make_controller
+from filters import FILTERS, make_filter
+
+### Replay Hardware ###
+# The pumps and valve are not connected to anything during a replay, so their pins
+# only need to accept writes.
+class ReplayGPIO:
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+
+    def setmode(self, mode: int) -> None:
+        pass
+
+    def setup(self, pin: int, direction: int) -> None:
+        pass
+
+    def output(self, pin: int, value: int) -> None:
+        pass
+
+    def PWM(self, pin: int, frequency: float) -> "ReplayPWM":
+        return ReplayPWM()
+
+    def cleanup(self, channels=None) -> None:
+        pass
+
+class ReplayPWM:
+    def start(self, duty_cycle: float) -> None:
+        pass
+
+    def ChangeDutyCycle(self, duty_cycle: float) -> None:
+        pass
+
+    def stop(self) -> None:
+        pass
+
+
+
+### Recorded Pressure Source ###
+# Plays back the samples of a pressure trace against a clock. Reading at time t gives the
+# last record at or before t. Records within `tolerance` after t count as at t, so rounding
+# in the recorded times does not move a record onto the next tick.
+# The recording is lined up with the replay at the start of every phase by seek(), which
+# puts the first record of that trial and phase on the first tick. Delays between phases
+# in the recorded session then do not shift the replay out of step.
+# Reads only move forward, so playing a whole session is a single pass over the records.
+# The records stay memory-mapped: only the times are copied, into a flat array of 8 bytes
+# per record, since every read compares them. Voltage and pressure are read from the trace
+# for the one record returned.
+class RecordedPressure:
+    def __init__(self, trace_file: str, tolerance: float = 1e-6) -> None:
+        # Input: str (trace file name), float (seconds)
+        # Return: None
+        import numpy as np
+        self.parameters, records = read_trace(trace_file)
+        if len(records) == 0:
+            raise ValueError(trace_file + " has no pressure samples")
+        self.times = array('d', np.ascontiguousarray(records['time']).tobytes())
+        self.voltages = records['voltage']
+        self.pressures = records['pressure']
+        # (first record, trial, phase) of every run of records with the same trial and phase
+        trials = records['trial']
+        phases = records['phase']
+        starts = np.flatnonzero((trials[1:] != trials[:-1]) | (phases[1:] != phases[:-1])) + 1
+        self.segments = [(0, int(trials[0]), int(phases[0]))]
+        self.segments += [(int(index), int(trials[index]), int(phases[index])) for index in starts]
+        self.duration = self.times[-1] - self.times[0]
+        self.tolerance = tolerance
+        # Recording time minus replay time
+        self.offset = self.times[0]
+        self.__index = 0
+
+    # Line the recording up so the first record of the trial and phase is read at time t.
+    # If the recording has no such phase, i.e. it was stopped early, nothing changes
+    def seek(self, trial: int, phase: int, t: float) -> None:
+        # Input: int (trial), int (Phase), float (replay seconds)
+        # Return: None
+        for index, segment_trial, segment_phase in self.segments:
+            if index >= self.__index and segment_trial == trial and segment_phase == phase:
+                self.__index = index
+                self.offset = self.times[index] - t
+                return
+
+    def read(self, t: float) -> PressureSample:
+        # Input: float (replay seconds)
+        # Return: PressureSample
+        index = self.__index
+        times = self.times
+        last = len(times) - 1
+        t += self.offset + self.tolerance
+        while index < last and times[index + 1] <= t:
+            index += 1
+        self.__index = index
+        return PressureSample(times[index], float(self.voltages[index]), float(self.pressures[index]))
+
+
+
+### Replay Summary ###
+# Tracking error per phase (setpoint minus recorded pressure, taken on every control tick),
+# overshoot above the desired pressure while inflating and holding, and pump actuation counts.
+class ReplaySummary:
+    TRACKED = (Phase.INFLATE, Phase.HOLD, Phase.DEFLATE)
+
+    def __init__(self, desired_pressure: float) -> None:
+        # Input: float (mmHg)
+        # Return: None
+        self.desired_pressure = desired_pressure
+        self.ticks = {phase: 0 for phase in self.TRACKED}
+        self.abs_error = {phase: 0.0 for phase in self.TRACKED}
+        self.square_error = {phase: 0.0 for phase in self.TRACKED}
+        self.max_error = {phase: 0.0 for phase in self.TRACKED}
+        self.overshoot = 0.0
+        self.toggles = {}
+        self.on_time = {}
+
+    def record(self, phase: Phase, setpoint: float, pressure: float) -> None:
+        # Input: Phase, float (mmHg), float (mmHg)
+        # Return: None
+        if phase not in self.ticks:
+            return
+        error = abs(setpoint - pressure)
+        self.ticks[phase] += 1
+        self.abs_error[phase] += error
+        self.square_error[phase] += error * error
+        if error > self.max_error[phase]:
+            self.max_error[phase] = error
+        if phase != Phase.DEFLATE and pressure - self.desired_pressure > self.overshoot:
+            self.overshoot = pressure - self.desired_pressure
+
+    def record_actuator(self, name: str, toggles: int, on_time: float) -> None:
+        self.toggles[name] = toggles
+        self.on_time[name] = on_time
+
+    def as_dict(self) -> dict:
+        # Input: None
+        # Return: dict
+        phases = {}
+        for phase in self.TRACKED:
+            ticks = self.ticks[phase]
+            phases[phase.name.lower()] = {
+                'ticks': ticks,
+                'mean_abs_error': self.abs_error[phase] / ticks if ticks else 0.0,
+                'rms_error': (self.square_error[phase] / ticks) ** 0.5 if ticks else 0.0,
+                'max_error': self.max_error[phase]}
+        return {'phases': phases, 'overshoot': self.overshoot,
+                'toggles': dict(self.toggles), 'on_time': dict(self.on_time)}
+
+    # Flat name -> value pairs, recorded as METRIC events at the end of the replay
+    def metrics(self) -> dict:
+        # Input: None
+        # Return: dict of str -> float
+        result = self.as_dict()
+        metrics = {}
+        for name, phase in result['phases'].items():
+            for field, value in phase.items():
+                metrics['replay.' + name + '.' + field] = value
+        metrics['replay.overshoot'] = self.overshoot
+        for name, toggles in self.toggles.items():
+            metrics['replay.' + name + '.toggles'] = toggles
+        return metrics
+
+
+
+### Replay Backend ###
+# PumpControl reading its pressure from a recorded trace instead of the ADC. The real
+# scheduler, controller and actuation code runs on a replay clock, so controller and
+# timing changes can be checked against real sensor behaviour without a Pi.
+# The recording does not respond to the replayed actuation: replay is open loop, and shows
+# how a controller reacts to the pressure the cuff actually produced.
+#   speed = None  replays as fast as possible
+#   speed = 1     replays at recorded speed
+#
+#   PumpControlReplay.from_trace("Log_2023-02-19_11-32-55.trace").start_trials()
+class PumpControlReplay(PumpControl):
+    log_prefix = "Replay_"
+
+    def __init__(self,
+                desired_number_of_trials: float,
+                desired_pressure: float,
+                desired_inflate_time: float,
+                desired_hold_time: float,
+                desired_deflate_time: float,
+                desired_time_between_trials: float,
+                trace_file: str = None,
+                speed: float = None,
+                **kwargs):
+        if trace_file is None:
+            raise ValueError("The replay backend needs a trace_file")
+        self.recording = RecordedPressure(trace_file)
+        self.replay_clock = SimulatedClock(speed)
+        self.replay_summary = ReplaySummary(desired_pressure)
+        # Replays run without the ADS, continuous acquisition and scanning do not apply
+        kwargs.pop('continuous_data_rate', None)
+        kwargs.pop('scan_channels', None)
+        # A replay drives no cuff, so there is nothing for a safety supervisor to vent
+        kwargs.setdefault('safety_limits', None)
+        super().__init__(desired_number_of_trials, desired_pressure, desired_inflate_time,
+                         desired_hold_time, desired_deflate_time, desired_time_between_trials, **kwargs)
+
+    # Replay a trace with the trial settings stored in its header
+    @classmethod
+    def from_trace(cls, trace_file: str, speed: float = None, **kwargs) -> "PumpControlReplay":
+        # Input: str (trace file name), optional float (speed), keyword arguments for PumpControl
+        # Return: PumpControlReplay
+        parameters, _ = read_trace_header(trace_file)
+        kwargs.setdefault('control_frequency', parameters.get('control_frequency', 100.0))
+        return cls(parameters['number_of_trials'], parameters['pressure'], parameters['inflate_time'],
+                   parameters['hold_time'], parameters['deflate_time'], parameters['time_between_trials'],
+                   trace_file=trace_file, speed=speed, **kwargs)
+
+    def setup_hardware(self) -> None:
+        # Input: None
+        # Return: None
+        self.clock_source_ns = self.replay_clock.time_ns
+        self.sleep = self.replay_clock.sleep
+        self.async_sleep = self.replay_clock.async_sleep
+        self.GPIO = ReplayGPIO()
+
+    def start_acquisition(self, data_rate: int) -> None:
+        self.acquisition = None
+
+    def start_scanning(self, channels: list) -> None:
+        self.acquisition = None
+
+    def read_sample(self) -> PressureSample:
+        # Input: None
+        # Return: PressureSample
+        return self.recording.read(self.clock())
+
+    def begin_phase(self, spec) -> None:
+        # Input: PhaseSpec
+        # Return: None
+        self.recording.seek(spec.trial, spec.phase, self.clock())
+        super().begin_phase(spec)
+
+    # Every control step ends with a command, so its setpoint and sample are recorded here
+    def apply_command(self, command: float) -> None:
+        # Input: float (pump command)
+        # Return: None
+        self.replay_summary.record(self.phase, self.setpoint, self.last_sample.pressure)
+        super().apply_command(command)
+
+    def close_log(self) -> None:
+        # Input: None
+        # Return: None
+        for flow_object in (self.inflation_pump, self.deflation_pump):
+            self.replay_summary.record_actuator(flow_object.name, flow_object.toggles, flow_object.total_on_time())
+        for name, value in self.replay_summary.metrics().items():
+            self.log_event(EventKind.METRIC, 0, value, name)
+        super().close_log()
+
+
+
+# Replay one session and return its summary. With quiet the activity log that
+# start_trials prints at the end is discarded, it is still written to the Replay_ CSV,
+# in output_dir when given, otherwise in the current directory.
+# Traces hold the raw readings, so a pressure filter can be compared on real sensor noise
+def replay_session(trace_file: str, controller: str = None, speed: float = None, quiet: bool = True,
+                   pressure_filter: str = None, output_dir: str = None, **kwargs) -> dict:
+    # Input: str (trace file name), optional str (controller name), optional float (speed),
+    #        bool (discard printed output), optional str (filter name), optional str (directory
+    #        for the Replay_ files), keyword arguments for PumpControl
+    # Return: dict (see ReplaySummary.as_dict)
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+        kwargs['log_prefix'] = os.path.join(output_dir, PumpControlReplay.log_prefix)
+    if controller is not None:
+        kwargs['controller'] = make_controller(controller)
+    if pressure_filter is not None:
+        kwargs['pressure_filter'] = make_filter(pressure_filter)
+    pump_control = PumpControlReplay.from_trace(trace_file, speed, **kwargs)
+    if quiet:
+        with contextlib.redirect_stdout(io.StringIO()):
+            pump_control.start_trials()
+    else:
+        pump_control.start_trials()
+    return pump_control.replay_summary.as_dict()
+
+
+
+# Replays every trace given and prints one JSON summary per line, i.e. for CI:
+#   python3 PumpControlReplay.py --controller pid --pwm-frequency 200 Log_*.trace
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded sessions through the pump controller")
+    parser.add_argument('traces', nargs='+', help="pressure trace files (.trace)")
+    parser.add_argument('--controller', choices=sorted(CONTROLLERS), default=None)
+    parser.add_argument('--filter', choices=sorted(FILTERS), default=None, help="pressure filter, see filters.py")
+    parser.add_argument('--pwm-frequency', type=float, default=None)
+    parser.add_argument('--speed', type=float, default=None, help="1 replays at recorded speed, default is as fast as possible")
+    parser.add_argument('--output-dir', default=None, help="directory for the Replay_ logs and traces, default is the current directory")
+    args = parser.parse_args()
+    for trace_file in args.traces:
+        summary = replay_session(trace_file, args.controller, args.speed, pressure_filter=args.filter,
+                                 output_dir=args.output_dir, pwm_frequency=args.pwm_frequency)
+        print(json.dumps({'trace': trace_file, **summary}))
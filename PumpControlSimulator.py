@@ -0,0 +1,275 @@
+#!/usr/bin/python3.9.6
+import math
+import random
+import threading
+import time
+
+from PumpControl import PumpControl
+from sampling import pressure_to_voltage
+
+### Simulated Clock ###
+# Time only moves when something sleeps or waits on a conversion, so the control code
+# runs unchanged on simulated time.
+#   speed = None  runs as fast as possible
+#   speed = 100   runs 100 times faster than real time
+#   speed = 1     runs in real time
+class SimulatedClock:
+    def __init__(self, speed: float = None) -> None:
+        # Input: optional float (speed up over real time)
+        # Return: None
+        self.speed = speed
+        self.now = 0.0
+
+    def time(self) -> float:
+        # Input: None
+        # Return: float (simulated seconds)
+        return self.now
+
+    def time_ns(self) -> int:
+        # Input: None
+        # Return: int (simulated nanoseconds)
+        return round(self.now * 1e9)
+
+    def sleep(self, seconds: float) -> None:
+        # Input: float (simulated seconds)
+        # Return: None
+        if seconds <= 0:
+            return
+        self.now += seconds
+        if self.speed is not None:
+            time.sleep(seconds / self.speed)
+
+    # Same as sleep, but lets the event loop run other tasks while real time passes.
+    # asyncio is only imported by sessions that use it
+    async def async_sleep(self, seconds: float) -> None:
+        # Input: float (simulated seconds)
+        # Return: None
+        import asyncio
+        if seconds > 0:
+            self.now += seconds
+        await asyncio.sleep(max(seconds, 0.0) / self.speed if self.speed is not None else 0)
+
+
+
+### Cuff Model ###
+# Lumped model of the cuff, tubing, pumps, leak, vent valve and pressure sensor.
+#
+#   dP/dt = (Q_inflate - Q_deflate - Q_leak - Q_valve) / C(P)
+#
+# Flows are in mL/s and pressure in mmHg. The cuff gets stiffer as it fills, so compliance
+# falls with pressure: C(P) = compliance / (1 + P / stiffening_pressure).
+# The inflation pump loses flow against back pressure and stalls at stall_pressure.
+# The deflation pump loses flow as the cuff empties. Leak and valve flow are proportional
+# to pressure. The valve vents when its pin is on.
+# The sensor follows the cuff pressure with a first order lag and adds Gaussian noise.
+# The model is advanced under a lock, since the safety supervisor writes the pins from its
+# own thread.
+class CuffModel:
+    def __init__(self,
+                 compliance: float = 0.5,
+                 stiffening_pressure: float = 400.0,
+                 inflate_flow: float = 100.0,
+                 stall_pressure: float = 450.0,
+                 deflate_flow: float = 80.0,
+                 deflate_half_pressure: float = 20.0,
+                 leak: float = 0.001,
+                 valve_flow: float = 1.0,
+                 sensor_lag: float = 0.02,
+                 sensor_noise: float = 0.5,
+                 seed: int = None) -> None:
+        # Input: float (mL/mmHg), float (mmHg), float (mL/s), float (mmHg), float (mL/s),
+        #        float (mmHg), float (mL/s per mmHg), float (mL/s per mmHg), float (s), float (mmHg), optional int
+        # Return: None
+        self.compliance = compliance
+        self.stiffening_pressure = stiffening_pressure
+        self.inflate_flow = inflate_flow
+        self.stall_pressure = stall_pressure
+        self.deflate_flow = deflate_flow
+        self.deflate_half_pressure = deflate_half_pressure
+        self.leak = leak
+        self.valve_flow = valve_flow
+        self.sensor_lag = sensor_lag
+        self.sensor_noise = sensor_noise
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+        # State
+        self.time = 0.0
+        self.pressure = 0.0
+        self.sensed_pressure = 0.0
+        self.inflate_duty = 0.0
+        self.deflate_duty = 0.0
+        self.valve_open = False
+
+    # Rate of change of cuff pressure in mmHg/s
+    def pressure_rate(self, pressure: float) -> float:
+        # Input: float (mmHg)
+        # Return: float (mmHg/s)
+        inflow = self.inflate_duty * self.inflate_flow * max(0.0, 1.0 - pressure / self.stall_pressure)
+        outflow = self.deflate_duty * self.deflate_flow * pressure / (pressure + self.deflate_half_pressure)
+        outflow += self.leak * pressure
+        if self.valve_open:
+            outflow += self.valve_flow * pressure
+        compliance = self.compliance / (1.0 + pressure / self.stiffening_pressure)
+        return (inflow - outflow) / compliance
+
+    # Integrate the model up to time t in steps of at most max_step seconds
+    def advance(self, t: float, max_step: float = 0.001) -> None:
+        # Input: float (seconds), float (seconds)
+        # Return: None
+        with self.lock:
+            while self.time < t:
+                dt = min(max_step, t - self.time)
+                self.pressure = max(0.0, self.pressure + self.pressure_rate(self.pressure) * dt)
+                self.sensed_pressure += (self.pressure - self.sensed_pressure) * (1.0 - math.exp(-dt / self.sensor_lag))
+                self.time += dt
+
+    # Sensor reading at the current model time
+    def read_pressure(self) -> float:
+        # Input: None
+        # Return: float (mmHg)
+        return self.sensed_pressure + self.random.gauss(0.0, self.sensor_noise)
+
+
+
+### Simulated Hardware ###
+# Stand-ins for RPi.GPIO, the ADS1115 and an AnalogIn channel. They are wired to the cuff
+# model, so PumpControl drives the model through exactly the same calls it makes on the Pi.
+class SimulatedGPIO:
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+
+    def __init__(self, cuff: CuffModel, clock: SimulatedClock, inflate_pin: int, deflate_pin: int, valve_pin: int) -> None:
+        self.cuff = cuff
+        self.clock = clock
+        self.pins = {inflate_pin: 'inflate', deflate_pin: 'deflate', valve_pin: 'valve'}
+
+    def setmode(self, mode: int) -> None:
+        pass
+
+    def setup(self, pin: int, direction: int) -> None:
+        pass
+
+    def output(self, pin: int, value: int) -> None:
+        self.set_duty(pin, 1.0 if value else 0.0)
+
+    def PWM(self, pin: int, frequency: float) -> "SimulatedPWM":
+        return SimulatedPWM(self, pin)
+
+    def cleanup(self, channels=None) -> None:
+        for pin in self.pins if channels is None else channels:
+            self.set_duty(pin, 0.0)
+
+    # Bring the model up to now before changing an input
+    def set_duty(self, pin: int, duty: float) -> None:
+        self.cuff.advance(self.clock.time())
+        target = self.pins.get(pin)
+        if target == 'inflate':
+            self.cuff.inflate_duty = duty
+        elif target == 'deflate':
+            self.cuff.deflate_duty = duty
+        elif target == 'valve':
+            self.cuff.valve_open = duty > 0
+
+class SimulatedPWM:
+    def __init__(self, gpio: SimulatedGPIO, pin: int) -> None:
+        self.gpio = gpio
+        self.pin = pin
+
+    def start(self, duty_cycle: float) -> None:
+        self.gpio.set_duty(self.pin, duty_cycle / 100)
+
+    def ChangeDutyCycle(self, duty_cycle: float) -> None:
+        self.gpio.set_duty(self.pin, duty_cycle / 100)
+
+    def stop(self) -> None:
+        self.gpio.set_duty(self.pin, 0.0)
+
+class SimulatedADS:
+    def __init__(self) -> None:
+        self.gain = 1
+        self.mode = None
+        self.data_rate = 128
+
+# Reading the voltage costs one single-shot conversion of simulated time, like the real ADS.
+# The result is quantized to the ADS1115 LSB at gain 1 (4.096 V / 32768).
+class SimulatedChannel:
+    LSB = 4.096 / 32768
+
+    def __init__(self, cuff: CuffModel, clock: SimulatedClock, conversion_time: float = 1 / 860 + 0.0005) -> None:
+        # Input: CuffModel, SimulatedClock, float (seconds per conversion including I2C)
+        # Return: None
+        self.cuff = cuff
+        self.clock = clock
+        self.conversion_time = conversion_time
+
+    @property
+    def voltage(self) -> float:
+        self.clock.sleep(self.conversion_time)
+        self.cuff.advance(self.clock.time())
+        return round(pressure_to_voltage(self.cuff.read_pressure()) / self.LSB) * self.LSB
+
+
+
+### Simulator Backend ###
+# PumpControl running on the cuff model and a simulated clock. Everything above the
+# hardware (controller, scheduler, logging, trace) is the real PumpControl code, so
+# controller and timing changes can be tried and benchmarked without a Pi.
+#   PumpControlSimulator(3, 250, 2, 5, 2, 10, speed=100).start_trials()
+# Several simulated cuffs share one sim_clock, so they run on one timeline; each has its
+# own cuff model.
+class PumpControlSimulator(PumpControl):
+    log_prefix = "Sim_"
+
+    def __init__(self,
+                desired_number_of_trials: float,
+                desired_pressure: float,
+                desired_inflate_time: float,
+                desired_hold_time: float,
+                desired_deflate_time: float,
+                desired_time_between_trials: float,
+                speed: float = None,
+                cuff: CuffModel = None,
+                seed: int = None,
+                sim_clock: SimulatedClock = None,
+                **kwargs):
+        self.sim_clock = sim_clock if sim_clock is not None else SimulatedClock(speed)
+        self.cuff = cuff if cuff is not None else CuffModel(seed=seed)
+        super().__init__(desired_number_of_trials, desired_pressure, desired_inflate_time,
+                         desired_hold_time, desired_deflate_time, desired_time_between_trials, **kwargs)
+
+    def setup_hardware(self) -> None:
+        # Input: None
+        # Return: None
+        self.clock_source_ns = self.sim_clock.time_ns
+        self.sleep = self.sim_clock.sleep
+        self.async_sleep = self.sim_clock.async_sleep
+        self.GPIO = SimulatedGPIO(self.cuff, self.sim_clock, self.InflateChannel, self.DeflateChannel, self.ValveChannel)
+        self.ads = SimulatedADS()
+        self.pressure_channel = SimulatedChannel(self.cuff, self.sim_clock)
+
+    # Simulated cuffs share the clock instead of an I2C bus
+    @classmethod
+    def shared_hardware(cls, speed: float = None, **options) -> dict:
+        # Input: optional float (speed), backend keyword arguments
+        # Return: dict (keyword arguments for every PumpControlSimulator)
+        return {'sim_clock': SimulatedClock(speed), 'bus_lock': threading.Lock()}
+
+    # The simulated ADC only has the cuff input and is read on demand, so continuous mode
+    # and scanning are ignored
+    def start_acquisition(self, data_rate: int) -> None:
+        self.acquisition = None
+
+    def start_scanning(self, channels: list) -> None:
+        self.acquisition = None
+
+    # The supervisor reads the sensor of the model directly. A conversion would advance
+    # the simulated clock from the supervisor's thread
+    def safety_pressure(self, max_age: float, bus_timeout: float) -> float:
+        # Input: float (seconds), float (seconds), both unused
+        # Return: float (mmHg)
+        return self.cuff.sensed_pressure
@@ -1,97 +1,96 @@
 #!/usr/bin/python3.9.6
-import time
-from datetime import datetime
-import csv
+import threading
 
-class PumpControlTester:
-    def __init__(self, 
+from PumpControl import PumpControl
+from PumpControlSimulator import SimulatedADS
+from PumpControlReplay import ReplayGPIO
+from sampling import pressure_to_voltage
+
+### Tester Hardware ###
+# The ADC channel reads the tester's fake pressure; the pins go to a no-op GPIO (the one
+# replays use), so nothing is driven.
+class TesterChannel:
+    def __init__(self, tester: "PumpControlTester") -> None:
+        self.tester = tester
+
+    @property
+    def voltage(self) -> float:
+        return pressure_to_voltage(self.tester.current_pressure)
+
+
+
+### Tester Backend ###
+# PumpControl without hardware, for debugging the GUI and the session files. The pressure
+# follows the setpoint exactly: inflation and deflation move it in 1 mmHg steps, hold and
+# rest only sample it. Everything else (logging, phases, shutoff) is PumpControl's own.
+class PumpControlTester(PumpControl):
+    def __init__(self,
                 desired_number_of_trials: float,
                 desired_pressure: float,
                 desired_inflate_time: float,
                 desired_hold_time: float,
                 desired_deflate_time: float,
-                desired_time_between_trials: float):
-        
-        ### Trial Settings ###
-        self.desired_number_of_trials = desired_number_of_trials
-        self.desired_pressure = desired_pressure
-        self.desired_inflate_time = desired_inflate_time
-        self.desired_hold_time = desired_hold_time
-        self.desired_deflate_time = desired_deflate_time
-        self.desired_time_between_trials = desired_time_between_trials
-
+                desired_time_between_trials: float,
+                **kwargs):
         ### Test Variables ###
         # Only used for program debugging
         self.current_pressure = 0.0
+        # The tester drives no hardware, so it runs without a safety supervisor by default
+        kwargs.setdefault('safety_limits', None)
+        super().__init__(desired_number_of_trials, desired_pressure, desired_inflate_time,
+                         desired_hold_time, desired_deflate_time, desired_time_between_trials, **kwargs)
 
-        ### Data Logging ###
-        # 2 dimensional array that stores device activity for debugging
-        self.activity_log = [['Time', 'Object', 'Activity', 'Details']]
+    def setup_hardware(self) -> None:
+        # Input: None
+        # Return: None
+        self.GPIO = ReplayGPIO()
+        self.ads = SimulatedADS()
+        self.pressure_channel = TesterChannel(self)
 
-    ### File Handling ###
-    class FileHandler:
-        # Data source indicates what generated the data being written to the file.
-        # Default is set to pressure
-        def __init__(self, data_source: str = "Log_") -> None:
-            # File name is source + current time (YYYY-MM-DD_HH_mm_ss)
-            # ex. "pressure_2023-2-19_11-32-55.csv"
-            self.__file_name = data_source + datetime.now().strftime("%Y-%m-%d_%H-%M-%S") + ".csv"
-        
-        def write_session(self, output: list[list]) -> None:
-            with open(self.__file_name, 'w') as file:
-                writer = csv.writer(file)
-                for row in output:
-                    writer.writerow(row)
+    # Testers have nothing to share but the bus lock, so a DeviceManager can run several
+    @classmethod
+    def shared_hardware(cls, **options) -> dict:
+        # Input: backend keyword arguments
+        # Return: dict (keyword arguments for every PumpControlTester)
+        return {'bus_lock': threading.Lock()}
 
-        def read_file(self):
-            with open(self.__file_name, 'r') as file:
-                reader = csv.reader(file)
-                for row in reader:
-                    print('#' + str(reader.line_num) + ' ' + str(row))
+    def start_acquisition(self, data_rate: int) -> None:
+        self.acquisition = None
 
-    # Trigger emergency shutoff of pumps, opens valves to vent system
-    def emergency_shutoff(self) -> None:
-        # Input: None
-        # Return: None
-        self.log_activity([datetime.now().strftime("%H:%M:%S"), "Emergency Shutoff"])
+    def start_scanning(self, channels: list) -> None:
+        self.acquisition = None
 
     def raise_pressure(self, target_pressure: float) -> None:
-        # Input: float 
+        # Input: float
         # Return: None
         # Turn on inflation pump while current pressure below threshold
         while self.current_pressure < target_pressure:
             self.current_pressure += 1
-            self.get_pressure
+            self.get_pressure()
 
     def lower_pressure(self, target_pressure: float) -> None:
-        # Input: float 
+        # Input: float
         # Return: None
-        # Turn on inflation pump while current pressure below threshold
+        # Turn on deflation pump while current pressure above threshold
         while self.current_pressure > target_pressure:
             self.current_pressure -= 1
-        self.get_pressure
-
-    def inflation_line_pressure(self, target_pressure: float, inflate_time_elapsed: float, desired_inflate_time: float) -> float:
-        ## finds slope of inflation by dividing target pressure by total inflation time, then multiplies
-        ## by current time so the function can return what the pressure should be along the line
-        return ((target_pressure // desired_inflate_time) * inflate_time_elapsed)
+        self.get_pressure()
 
-    def deflation_line_pressure(self, target_pressure: float, deflate_start_time: float, desired_deflate_time: float) -> float:
-        ## finds slope of deflation by dividing target pressure by total inflation time, then multiplies
-        ## by current time. This value is how much the pressure should have dropped in the time elapsed, this is then
-        ## subtracted from the target pressure to provide a slope downward rather than upward like inflation_line_pressure
-        return (target_pressure - ((target_pressure // desired_deflate_time) * (time.perf_counter() - deflate_start_time)))
-    
-    ### Pressure Sensor Querying Function ###
-    def get_pressure(self) -> float:
-        # Input: None
-        # Return: Float (in mmHg)
+    ### Control Steps ###
+    # Called once per tick by the TickScheduler with the time elapsed in the current phase
+    def inflate_step(self, inflate_time_elapsed: float) -> None:
+        # Input: float (seconds since inflation started)
+        # Return: None
+        self.setpoint = self.phase_spec.setpoint(inflate_time_elapsed)
+        self.raise_pressure(self.setpoint)
 
-        # Adds current pressure, timestamp, and voltage to pressure log
-        self.log_activity([datetime.now().strftime("%H:%M:%S"), self.current_pressure, self.current_pressure*0.0001067])
+    def deflate_step(self, deflate_time_elapsed: float) -> None:
+        # Input: float (seconds since deflation started)
+        # Return: None
+        self.setpoint = self.phase_spec.setpoint(deflate_time_elapsed)
+        self.lower_pressure(self.setpoint)
 
-        return self.current_pressure
-    
-    ### Logging Function ###
-    def log_activity(self, entry: list):
-        self.activity_log.append(entry)
\ No newline at end of file
+    def hold_step(self, hold_time_elapsed: float) -> None:
+        # Input: float (seconds since the phase started)
+        # Return: None
+        self.get_pressure()
@@ -0,0 +1,363 @@
+#!/usr/bin/python3.9.6
+import threading
+import time
+from array import array
+
+from sampling import PressureSample, voltage_to_pressure
+from metrics import clock_ns
+
+# Data rates (samples per second) the ADS1115 supports that are fast enough for pressure control
+CONTINUOUS_DATA_RATES = (128, 250, 475, 860)
+
+# All data rates and gains of the ADS1115
+DATA_RATES = (8, 16, 32, 64, 128, 250, 475, 860)
+GAINS = (2 / 3, 1, 2, 4, 8, 16)
+
+# Time for one single-shot conversion read over I2C: the conversion itself plus the
+# configuration write, ready polling and result read
+I2C_OVERHEAD = 0.0005
+
+### Sample Ring Buffer ###
+# Fixed-size ring buffer of pressure samples stored in flat typed arrays.
+# There is exactly one writer (the acquisition thread). Readers never take a lock:
+# a slot is fully written before the write counter is advanced, and advancing the
+# counter is a single attribute assignment, so a reader only ever sees finished samples.
+class RingBuffer:
+    def __init__(self, capacity: int = 4096) -> None:
+        # Input: int (number of samples kept)
+        # Return: None
+        self.capacity = capacity
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.voltages = array('d', bytes(8 * capacity))
+        self.pressures = array('d', bytes(8 * capacity))
+        # Total number of samples ever written. Slot of sample n is n % capacity
+        self.count = 0
+
+    # Store a sample. Must only be called from the writer thread
+    def append(self, sample: PressureSample) -> None:
+        # Input: PressureSample
+        # Return: None
+        index = self.count % self.capacity
+        self.timestamps[index] = sample.timestamp
+        self.voltages[index] = sample.voltage
+        self.pressures[index] = sample.pressure
+        self.count += 1
+
+    # Get the newest sample, or None if nothing has been written yet
+    def latest(self) -> PressureSample:
+        # Input: None
+        # Return: PressureSample or None
+        count = self.count
+        if count == 0:
+            return None
+        index = (count - 1) % self.capacity
+        return PressureSample(self.timestamps[index], self.voltages[index], self.pressures[index])
+
+    # Get up to the newest n samples, oldest first
+    def last(self, n: int) -> list:
+        # Input: int (number of samples)
+        # Return: list[PressureSample]
+        count = self.count
+        n = min(n, count, self.capacity)
+        samples = []
+        for position in range(count - n, count):
+            index = position % self.capacity
+            samples.append(PressureSample(self.timestamps[index], self.voltages[index], self.pressures[index]))
+        return samples
+
+
+
+# Raise the error that ended an acquisition thread, if there was one
+def check_error(acquisition) -> None:
+    # Input: ContinuousAcquisition or ScanningAcquisition
+    # Return: None
+    if acquisition.error is not None:
+        raise RuntimeError(acquisition.name + " stopped: " + repr(acquisition.error)) from acquisition.error
+
+
+
+### Continuous Acquisition Thread ###
+# Reads an ADS1115 channel that is running in continuous conversion mode at a fixed
+# rate and writes every sample into a RingBuffer. The control loop reads the latest
+# sample from the buffer and never waits on the I2C bus.
+# The ADC must already be configured for continuous mode at the same data rate.
+# Every read holds lock, the lock of the I2C bus when several ADCs share it.
+# Conversions skipped to catch up after falling behind are counted in missed.
+# A read that raises, i.e. an I2C error, ends the thread. The error is kept in error and
+# raised again by latest() and wait_for_sample(), so the control loop does not go on with
+# the last sample.
+class ContinuousAcquisition(threading.Thread):
+    def __init__(self, channel, data_rate: int = 860, buffer_size: int = 4096, clock=time.perf_counter,
+                 lock=None, conversion_time=None, convert=voltage_to_pressure) -> None:
+        # Input: AnalogIn (channel to read), int (samples per second), int (ring buffer capacity),
+        #        callable (sample timestamps in seconds, i.e. the session clock), optional lock (I2C bus),
+        #        optional metrics.Histogram (receives the time of every read in nanoseconds),
+        #        callable (voltage to mmHg, i.e. CalibrationProfile.to_pressure)
+        # Return: None
+        super().__init__(name='ads-acquisition', daemon=True)
+        if data_rate not in CONTINUOUS_DATA_RATES:
+            raise ValueError("data_rate must be one of " + str(CONTINUOUS_DATA_RATES))
+        self.channel = channel
+        self.data_rate = data_rate
+        self.period = 1.0 / data_rate
+        self.clock = clock
+        self.lock = lock if lock is not None else threading.Lock()
+        self.conversion_time = conversion_time
+        self.convert = convert
+        self.buffer = RingBuffer(buffer_size)
+        self.missed = 0
+        self.error = None
+        self.__first_sample = threading.Event()
+        self.__stop = threading.Event()
+
+    def run(self) -> None:
+        # Input: None
+        # Return: None
+        try:
+            self.acquire()
+        except Exception as error:
+            self.error = error
+            # Wake wait_for_sample, which raises the error
+            self.__first_sample.set()
+
+    def acquire(self) -> None:
+        # Input: None
+        # Return: None
+        next_read = time.perf_counter()
+        conversion_time = self.conversion_time
+        while not self.__stop.is_set():
+            with self.lock:
+                start = clock_ns()
+                voltage = self.channel.voltage
+            if conversion_time is not None:
+                conversion_time.record(clock_ns() - start)
+            self.buffer.append(PressureSample(self.clock(), voltage, self.convert(voltage)))
+            self.__first_sample.set()
+
+            # Wait for the next conversion using absolute deadlines so the rate does not drift.
+            # If the thread fell behind by more than one period, skip ahead instead of bursting.
+            next_read += self.period
+            delay = next_read - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -self.period:
+                self.missed += int(-delay / self.period)
+                next_read = time.perf_counter()
+
+    # Get the newest sample without touching the I2C bus
+    def latest(self) -> PressureSample:
+        # Input: None
+        # Return: PressureSample or None
+        check_error(self)
+        return self.buffer.latest()
+
+    # Block until the first sample is available
+    def wait_for_sample(self, timeout: float = 1.0) -> bool:
+        # Input: float (seconds)
+        # Return: bool (True if a sample is available)
+        available = self.__first_sample.wait(timeout)
+        check_error(self)
+        return available
+
+    def stop(self) -> None:
+        # Input: None
+        # Return: None
+        self.__stop.set()
+        if self.is_alive():
+            self.join(timeout=1.0)
+
+
+
+### Scanning Acquisition Thread ###
+# Reads several ADS1115 inputs (P0-P3) in single-shot mode, switching the multiplexer
+# between them. Every channel has its own data rate, gain and ring buffer.
+#
+# A channel either has a fixed rate in samples per second, or rate=None to take all the
+# time the fixed-rate channels leave free. Fixed-rate channels are served earliest
+# deadline first. Between deadlines the free-running channels are read in turn, as long
+# as a conversion (including settling) fits before the next deadline, so the ADC is only
+# idle when nothing fits.
+#
+# Switching the multiplexer costs settle_conversions discarded conversions on the new
+# channel, i.e. when the input has an RC filter that needs time to settle. A channel that
+# is read again right after itself does not pay this, so a channel that has fallen behind
+# catches up with back to back reads.
+# Every conversion, with its gain and data rate changes, holds lock, the lock of the I2C
+# bus when several ADCs share it. Samples a fixed-rate channel skipped are counted in missed.
+# Like ContinuousAcquisition, an error ends the thread and is raised by latest().
+class ScanChannel:
+    def __init__(self, name: str, pin: int, data_rate: int = 860, gain: float = 1, rate: float = None,
+                 convert=voltage_to_pressure, settle_conversions: int = 0, buffer_size: int = 4096) -> None:
+        # Input: str (name), int (ADS input 0-3, i.e. ADS.P1), int (samples per second of one conversion),
+        #        float (ADS gain), optional float (samples per second, None to fill free time),
+        #        optional callable (voltage to value, None keeps volts), int (conversions discarded
+        #        after switching to this channel), int (ring buffer capacity)
+        # Return: None
+        if pin not in (0, 1, 2, 3):
+            raise ValueError("pin must be one of the ADS1115 inputs 0-3")
+        if data_rate not in DATA_RATES:
+            raise ValueError("data_rate must be one of " + str(DATA_RATES))
+        if gain not in GAINS:
+            raise ValueError("gain must be one of " + str(GAINS))
+        self.name = name
+        self.pin = pin
+        self.data_rate = data_rate
+        self.gain = gain
+        self.rate = rate
+        self.convert = convert
+        self.settle_conversions = settle_conversions
+        self.buffer_size = buffer_size
+
+    # Seconds one conversion of this channel takes
+    @property
+    def conversion_time(self) -> float:
+        return 1.0 / self.data_rate + I2C_OVERHEAD
+
+    # Seconds lost to settling when the multiplexer switches to this channel
+    @property
+    def switch_time(self) -> float:
+        return self.settle_conversions * self.conversion_time
+
+# Cuff pressure as fast as possible, line pressure and a second cuff at 100 SPS and
+# the supply voltage (through a divider to stay under 6.144 V) once a second
+PRESSURE_SCAN = (ScanChannel('cuff', 0),
+                 ScanChannel('line', 1, rate=100),
+                 ScanChannel('cuff2', 2, rate=100),
+                 ScanChannel('supply', 3, data_rate=128, gain=2 / 3, rate=1, convert=None))
+
+class ScanningAcquisition(threading.Thread):
+    def __init__(self, ads, channels, make_input, clock=time.perf_counter, sleep=time.sleep, lock=None,
+                 conversion_time=None) -> None:
+        # Input: ADS1115, list of ScanChannel (the first is the one latest() returns by default),
+        #        callable (ADS input -> AnalogIn), callable (timestamps in seconds), callable (sleep),
+        #        optional lock (I2C bus), optional metrics.Histogram (time of every conversion in nanoseconds)
+        # Return: None
+        super().__init__(name='ads-scan', daemon=True)
+        if not channels:
+            raise ValueError("At least one channel must be scanned")
+        names = [channel.name for channel in channels]
+        if len(set(names)) != len(names):
+            raise ValueError("Channel names must be unique")
+        self.ads = ads
+        self.channels = list(channels)
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = lock if lock is not None else threading.Lock()
+        self.inputs = [make_input(channel.pin) for channel in self.channels]
+        self.buffers = {channel.name: RingBuffer(channel.buffer_size) for channel in self.channels}
+        self.conversion_time = conversion_time
+        self.switches = 0
+        self.missed = 0
+        self.error = None
+
+        # Fixed-rate channels must fit in the ADC's time. Every conversion is counted with
+        # its settling, since channels are interleaved
+        self.utilization = sum(channel.rate * (channel.conversion_time + channel.switch_time)
+                               for channel in self.channels if channel.rate)
+        if self.utilization > 1.0:
+            raise ValueError("Scan needs " + format(self.utilization * 100, ".0f")
+                             + "% of the ADC time; lower the channel rates or raise their data rates")
+        self.__first_sample = threading.Event()
+        self.__stop = threading.Event()
+
+    # Read one conversion of channel index into its buffer
+    def convert(self, index: int, last: int) -> None:
+        # Input: int (channel index), int (index of the previously read channel, -1 for none)
+        # Return: None
+        channel = self.channels[index]
+        analog_in = self.inputs[index]
+        ads = self.ads
+        with self.lock:
+            if ads.gain != channel.gain:
+                ads.gain = channel.gain
+            if ads.data_rate != channel.data_rate:
+                ads.data_rate = channel.data_rate
+            if index != last:
+                self.switches += 1
+                for _ in range(channel.settle_conversions):
+                    analog_in.voltage
+            start = clock_ns()
+            voltage = analog_in.voltage
+        if self.conversion_time is not None:
+            self.conversion_time.record(clock_ns() - start)
+        value = channel.convert(voltage) if channel.convert is not None else voltage
+        self.buffers[channel.name].append(PressureSample(self.clock(), voltage, value))
+
+    def run(self) -> None:
+        # Input: None
+        # Return: None
+        try:
+            self.scan()
+        except Exception as error:
+            self.error = error
+            self.__first_sample.set()
+
+    def scan(self) -> None:
+        # Input: None
+        # Return: None
+        clock = self.clock
+        channels = self.channels
+        fixed = [index for index, channel in enumerate(channels) if channel.rate]
+        free = [index for index, channel in enumerate(channels) if not channel.rate]
+        periods = {index: 1.0 / channels[index].rate for index in fixed}
+        next_due = {index: clock() for index in fixed}
+        free_turn = 0
+        last = -1
+        while not self.__stop.is_set():
+            now = clock()
+            index = None
+            if fixed:
+                earliest = min(fixed, key=next_due.__getitem__)
+                if next_due[earliest] <= now:
+                    index = earliest
+                    # A channel more than one period behind skips the missed samples
+                    due = next_due[index] + periods[index]
+                    if due < now:
+                        self.missed += int((now - due) / periods[index])
+                        due = now
+                    next_due[index] = due
+            if index is None and free:
+                slack = min(next_due.values()) - now if fixed else float('inf')
+                for turn in range(len(free)):
+                    candidate = free[(free_turn + turn) % len(free)]
+                    cost = channels[candidate].conversion_time
+                    if candidate != last:
+                        cost += channels[candidate].switch_time
+                    if cost <= slack:
+                        index = candidate
+                        free_turn = (free_turn + turn + 1) % len(free)
+                        break
+            if index is None:
+                self.sleep(max(min(next_due.values()) - now, 0.0))
+                continue
+            self.convert(index, last)
+            last = index
+            if index == 0:
+                self.__first_sample.set()
+
+    # Get the newest sample of a channel without touching the I2C bus
+    def latest(self, name: str = None) -> PressureSample:
+        # Input: optional str (channel name, default the first channel)
+        # Return: PressureSample (value in the channel's unit) or None
+        check_error(self)
+        return self.buffers[name or self.channels[0].name].latest()
+
+    def buffer(self, name: str) -> RingBuffer:
+        # Input: str (channel name)
+        # Return: RingBuffer
+        return self.buffers[name]
+
+    # Block until the first sample of the first channel is available
+    def wait_for_sample(self, timeout: float = 1.0) -> bool:
+        # Input: float (seconds)
+        # Return: bool (True if a sample is available)
+        available = self.__first_sample.wait(timeout)
+        check_error(self)
+        return available
+
+    def stop(self) -> None:
+        # Input: None
+        # Return: None
+        self.__stop.set()
+        if self.is_alive():
+            self.join(timeout=1.0)
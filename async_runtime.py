@@ -0,0 +1,276 @@
+#!/usr/bin/python3.9.6
+import argparse
+import asyncio
+import json
+import signal
+import time
+
+from backends import BACKENDS, create_pump_control
+from controller import CONTROLLERS, make_controller
+from filters import FILTERS, make_filter
+from events import EventKind
+from metrics import MetricsServer
+from protocol import PhaseSpec
+from scheduler import PhaseStats, TickScheduler
+
+### Asyncio Control Runtime ###
+# Runs a session as asyncio tasks on one event loop instead of a trial thread:
+#
+#   control  runs the compiled protocol, one control step (one ADC read and one actuation
+#            decision) per tick. Reading and acting stay in the same step so the controller
+#            never acts on a sample older than the tick
+#   logging  flushes the pressure trace every log_interval, so a crash loses at most that much
+#   ui       calls on_update every ui_interval, i.e. to publish status to a front-end
+#   monitor  measures how late the event loop wakes a task, the scheduling overhead of the
+#            runtime and of everything else sharing the loop (i.e. Tk)
+#
+# stop() cancels the control task. Steps are synchronous, so the cancellation lands at the
+# await between two ticks: the step in progress finishes, the running phase is ended (which
+# stops the pumps after a ramp) and every actuator is switched off, then the logs are closed.
+# A STOP therefore takes effect within one control tick and always at the same point.
+#
+# The backend's async_sleep is used between ticks, so simulated backends keep their
+# simulated clock.
+#
+#   python3 async_runtime.py --backend sim --speed 10
+
+### Event Loop Lag ###
+class LoopLag:
+    def __init__(self) -> None:
+        self.samples = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, lag: float) -> None:
+        # Input: float (seconds late)
+        # Return: None
+        self.samples += 1
+        self.total += lag
+        if lag > self.max:
+            self.max = lag
+
+    def metrics(self) -> dict:
+        # Input: None
+        # Return: dict (samples, mean and max lag in seconds)
+        return {'loop_lag.samples': self.samples,
+                'loop_lag.mean': self.total / self.samples if self.samples else 0.0,
+                'loop_lag.max': self.max}
+
+
+
+### Async Tick Scheduler ###
+# The tick loop of TickScheduler (TickScheduler.ticks) with the sleep between ticks awaited,
+# so other tasks run while the control loop waits and a cancellation is delivered at the
+# next tick boundary.
+class AsyncTickScheduler(TickScheduler):
+    def __init__(self, frequency: float = 100.0, clock=time.perf_counter, sleep=asyncio.sleep,
+                 period_histogram=None) -> None:
+        # Input: float (ticks per second), callable (clock in seconds), coroutine function (sleep in seconds),
+        #        optional metrics.Histogram (time between step starts)
+        # Return: None
+        super().__init__(frequency, clock, sleep, period_histogram)
+
+    async def run_phase(self, phase, duration: float, step, keep_running=None) -> PhaseStats:
+        # Input: Phase, float (seconds), callable (step taking elapsed seconds), optional callable (returns bool)
+        # Return: PhaseStats
+        stats = PhaseStats(phase, duration)
+        start = self.clock()
+        self.phase_start = start
+        try:
+            for delay in self.ticks(stats, start, step, keep_running):
+                await self.sleep(delay)
+        finally:
+            # A cancelled phase still reports how long it ran
+            stats.duration = self.clock() - start
+            self.history.append(stats)
+        return stats
+
+
+
+### Runtime ###
+class AsyncRuntime:
+    COMPLETE = 'COMPLETE'
+    HALTED = 'HALTED'
+    TRIPPED = 'TRIPPED'
+
+    def __init__(self, pump_control, on_sample=None, on_update=None,
+                 ui_interval: float = 0.05, log_interval: float = 1.0, monitor_interval: float = 0.01) -> None:
+        # Input: backend with the PumpControl interface, optional callable (receives the sample of
+        #        every control step), optional callable (receives the runtime every ui_interval),
+        #        float (seconds), float (seconds), float (seconds)
+        # Return: None
+        self.pump_control = pump_control
+        self.on_sample = on_sample
+        self.on_update = on_update
+        self.ui_interval = ui_interval
+        self.log_interval = log_interval
+        self.monitor_interval = monitor_interval
+        self.scheduler = AsyncTickScheduler(pump_control.control_frequency, pump_control.clock,
+                                            getattr(pump_control, 'async_sleep', asyncio.sleep),
+                                            pump_control.period_histogram())
+        self.loop_lag = LoopLag()
+        self.loop_lag_histogram = pump_control.metrics.histogram('event_loop_lag_seconds', "How late the event loop woke a sleeping task")
+        # Phase running now, None between phases
+        self.spec = None
+        self.outcome = None
+        self.__stopping = False
+        self.__control = None
+        self.__loop = None
+        # A safety trip (safety_supervisor.py) ends the session like stop()
+        if pump_control.supervisor is not None:
+            pump_control.supervisor.on_trip.append(lambda trip: self.stop_threadsafe())
+
+    # Cancel the session. Must be called on the event loop's thread, see stop_threadsafe
+    def stop(self) -> None:
+        # Input: None
+        # Return: None
+        self.__stopping = True
+        if self.__control is not None:
+            self.__control.cancel()
+
+    def stop_threadsafe(self) -> None:
+        # Input: None
+        # Return: None
+        if self.__loop is not None:
+            self.__loop.call_soon_threadsafe(self.stop)
+
+    ### Tasks ###
+    async def control(self) -> None:
+        pump_control = self.pump_control
+        pump_control.log_parameters()
+        for spec in pump_control.protocol.phases:
+            await self.run_phase(spec)
+
+    async def run_phase(self, spec: PhaseSpec) -> PhaseStats:
+        # Input: PhaseSpec
+        # Return: PhaseStats
+        pump_control = self.pump_control
+        step = pump_control.step_for(spec.phase)
+        if self.on_sample is not None:
+            step = pump_control.sampling_step(step, self.on_sample)
+        pump_control.begin_phase(spec)
+        self.spec = spec
+        try:
+            await self.scheduler.run_phase(spec.phase, spec.duration, step)
+        finally:
+            self.spec = None
+            # The scheduler records the stats of the phase whether it finished or was cancelled
+            stats = self.scheduler.history[-1]
+            pump_control.end_phase(spec, stats)
+        return stats
+
+    async def logging(self) -> None:
+        trace = self.pump_control.trace
+        while True:
+            await asyncio.sleep(self.log_interval)
+            trace.flush()
+
+    async def ui(self) -> None:
+        while True:
+            self.on_update(self)
+            await asyncio.sleep(self.ui_interval)
+
+    async def monitor(self) -> None:
+        interval = self.monitor_interval
+        histogram = self.loop_lag_histogram
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            lag = max(time.perf_counter() - start - interval, 0.0)
+            self.loop_lag.record(lag)
+            histogram.record(int(lag * 1e9))
+
+    # Run the session. Returns COMPLETE, HALTED after stop() or TRIPPED after a safety trip;
+    # errors in the control task are raised after the pumps were shut off and the logs closed
+    async def run(self) -> str:
+        # Input: None
+        # Return: str (COMPLETE, HALTED or TRIPPED)
+        self.__loop = asyncio.get_running_loop()
+        self.__control = asyncio.create_task(self.control())
+        helpers = [asyncio.create_task(self.logging()), asyncio.create_task(self.monitor())]
+        if self.on_update is not None:
+            helpers.append(asyncio.create_task(self.ui()))
+        pump_control = self.pump_control
+        try:
+            await self.__control
+            self.outcome = self.COMPLETE
+        except asyncio.CancelledError:
+            if not self.__stopping:
+                raise
+            self.outcome = self.TRIPPED if pump_control.safety_trip is not None else self.HALTED
+        finally:
+            # If run() itself was cancelled, let the control task end its phase first
+            if not self.__control.done():
+                self.__control.cancel()
+                await asyncio.wait([self.__control])
+            for task in helpers:
+                task.cancel()
+            await asyncio.gather(*helpers, return_exceptions=True)
+
+            pump_control.emergency_shutoff()
+            for name, value in self.loop_lag.metrics().items():
+                pump_control.log_event(EventKind.METRIC, 0, value, name)
+            pump_control.close_log()
+            if self.on_update is not None:
+                self.on_update(self)
+        return self.outcome
+
+
+
+# Headless session. Ctrl+C stops it like the STOP button. Prints the phases as they start
+# and the timing metrics at the end as JSON
+async def run_headless(pump_control) -> str:
+    # Input: backend with the PumpControl interface
+    # Return: str (COMPLETE, HALTED or TRIPPED)
+    shown = [None]
+
+    def show_phase(runtime: AsyncRuntime) -> None:
+        spec = runtime.spec
+        if spec is not None and spec is not shown[0]:
+            shown[0] = spec
+            print("Trial " + str(spec.trial + 1) + ": " + spec.phase.name.title(), flush=True)
+
+    runtime = AsyncRuntime(pump_control, on_update=show_phase)
+    loop = asyncio.get_running_loop()
+    try:
+        loop.add_signal_handler(signal.SIGINT, runtime.stop)
+    except NotImplementedError:
+        # Windows has no signal handlers on the event loop; Ctrl+C then raises KeyboardInterrupt
+        pass
+    outcome = await runtime.run()
+    history = runtime.scheduler.history
+    print(json.dumps({'outcome': outcome, 'log': pump_control.log_file.file_name,
+                      'ticks': sum(stats.ticks for stats in history),
+                      'overruns': sum(stats.overruns for stats in history),
+                      'max_jitter': max((stats.max_jitter for stats in history), default=0.0),
+                      'safety_trip': pump_control.safety_trip._asdict() if pump_control.safety_trip is not None else None,
+                      **runtime.loop_lag.metrics()}))
+    return outcome
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a session on the asyncio runtime without the GUI")
+    parser.add_argument('--backend', choices=sorted(BACKENDS), help="defaults to $PUMP_BACKEND or pi")
+    parser.add_argument('--settings', type=float, nargs=6, default=[3, 250, 2, 5, 2, 10],
+                        metavar=('TRIALS', 'PRESSURE', 'INFLATE', 'HOLD', 'DEFLATE', 'REST'))
+    parser.add_argument('--controller', choices=sorted(CONTROLLERS), default=None)
+    parser.add_argument('--filter', choices=sorted(FILTERS), default=None, help="pressure filter, see filters.py")
+    parser.add_argument('--speed', type=float, default=None, help="speed of the sim and replay backends")
+    parser.add_argument('--trace', help="recorded pressure trace for the replay backend")
+    parser.add_argument('--metrics-port', type=int, default=None, help="serve live metrics on localhost at this port")
+    args = parser.parse_args()
+
+    options = {}
+    if args.controller is not None:
+        options['controller'] = make_controller(args.controller)
+    if args.filter is not None:
+        options['pressure_filter'] = make_filter(args.filter)
+    if args.speed is not None:
+        options['speed'] = args.speed
+    if args.trace is not None:
+        options['trace_file'] = args.trace
+    pump_control = create_pump_control(args.backend, *args.settings, **options)
+    if args.metrics_port is not None:
+        MetricsServer([pump_control.metrics], args.metrics_port).start()
+    asyncio.run(run_headless(pump_control))
@@ -0,0 +1,53 @@
+#!/usr/bin/python3.9.6
+import importlib
+import os
+
+### Backend Registry ###
+# A backend is a class with the PumpControl interface. Backends are registered by module
+# and class name and only imported when chosen, so hardware libraries (RPi.GPIO, board,
+# busio, adafruit_ads1x15) are never imported unless the Pi backend is used.
+#
+# Each entry is (module, class name, default keyword arguments).
+BACKENDS = {
+    # Loads or measures the pressure sensor calibration at startup, see calibration.py
+    'pi': ('PumpControl', 'PumpControl', {'calibration_cache': 'calibration.json'}),
+    # Real time by default so the GUI shows the simulation as it happens
+    'sim': ('PumpControlSimulator', 'PumpControlSimulator', {'speed': 1.0}),
+    'tester': ('PumpControlTester', 'PumpControlTester', {}),
+    # Needs trace_file, the recorded session to play back. Real time by default like 'sim'
+    'replay': ('PumpControlReplay', 'PumpControlReplay', {'speed': 1.0}),
+}
+
+# Backend used when none is given. Can be changed with the PUMP_BACKEND environment variable
+DEFAULT_BACKEND = 'pi'
+
+def register_backend(name: str, module: str, class_name: str, defaults: dict = None) -> None:
+    # Input: str (backend name), str (module), str (class name), optional dict (default keyword arguments)
+    # Return: None
+    BACKENDS[name] = (module, class_name, defaults or {})
+
+# Name of the backend to use: the explicit choice, then PUMP_BACKEND, then DEFAULT_BACKEND
+def backend_name(name: str = None) -> str:
+    # Input: optional str (backend name)
+    # Return: str
+    if name is None:
+        name = os.environ.get('PUMP_BACKEND', DEFAULT_BACKEND)
+    if name not in BACKENDS:
+        raise ValueError("Unknown backend " + name + ", expected one of " + ", ".join(BACKENDS))
+    return name
+
+# Import and return the backend class
+def get_backend(name: str = None):
+    # Input: optional str (backend name)
+    # Return: class with the PumpControl interface
+    module, class_name, _ = BACKENDS[backend_name(name)]
+    return getattr(importlib.import_module(module), class_name)
+
+# Create a backend for the six trial settings. Keyword arguments override the backend defaults
+def create_pump_control(name: str = None, *settings, **kwargs):
+    # Input: optional str (backend name), six trial settings, keyword arguments for the backend
+    # Return: backend instance
+    name = backend_name(name)
+    options = dict(BACKENDS[name][2])
+    options.update(kwargs)
+    return get_backend(name)(*settings, **options)
@@ -0,0 +1,234 @@
+#!/usr/bin/python3.9.6
+import argparse
+import json
+import math
+import os
+import time
+
+from backends import BACKENDS, backend_name, get_backend, create_pump_control
+from metrics import MetricsServer
+from protocol import compile_protocol
+
+### Headless Batch Runner ###
+# Runs a queue of sessions from a protocol file back to back, without the GUI. Only the
+# backend's own modules are imported: no Tk, no matplotlib, and no YAML or TOML parser
+# unless the file needs one.
+#
+# A protocol file holds optional defaults and a list of sessions. Every session needs the
+# six trial settings, under the names used in the trace header; anything else is passed to
+# the backend (control_frequency, pwm_frequency, continuous_data_rate, speed, seed, ...).
+# A null value overrides a backend default (speed: null runs the simulator as fast as
+# possible) and otherwise unsets the key, i.e. a controller given in the defaults.
+#   controller  name of a controller in controller.CONTROLLERS, i.e. "pid"
+#   filter      name of a pressure filter in filters.FILTERS, i.e. "median"
+#   repeat      run the session this many times (default 1)
+#   pause       seconds to wait after the session (default 0)
+#
+#   # overnight.yaml
+#   defaults:
+#     backend: sim
+#     controller: pid
+#     pause: 60
+#   sessions:
+#     - name: baseline
+#       number_of_trials: 3
+#       pressure: 250
+#       inflate_time: 2
+#       hold_time: 5
+#       deflate_time: 2
+#       time_between_trials: 10
+#       repeat: 4
+#
+# The same structure can be written as JSON or TOML ([defaults] and [[sessions]]).
+# Every session is checked before the first one starts, so a typo cannot stop a batch
+# half way through the night. Each session streams its own session CSV and trace, named
+# <output>/<backend prefix><number>_<name>_<time>, and one JSON line per session is printed.
+#
+#   python3 batch_runner.py overnight.yaml -o Logs/
+
+# Trial settings in the order PumpControl takes them
+SETTINGS = ('number_of_trials', 'pressure', 'inflate_time', 'hold_time', 'deflate_time', 'time_between_trials')
+
+# Keys the runner handles itself; everything else goes to the backend
+RUNNER_KEYS = ('name', 'backend', 'controller', 'filter', 'repeat', 'pause')
+
+### Loading ###
+def parse_protocol_file(file_name: str) -> dict:
+    # Input: str (.json, .yaml, .yml or .toml file name)
+    # Return: dict
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension == '.json':
+        with open(file_name, 'r') as file:
+            return json.load(file)
+    if extension in ('.yaml', '.yml'):
+        try:
+            import yaml
+        except ImportError:
+            raise ValueError("Reading " + file_name + " needs PyYAML (pip install pyyaml)")
+        with open(file_name, 'r') as file:
+            return yaml.safe_load(file) or {}
+    if extension == '.toml':
+        try:
+            import tomllib
+        except ImportError:
+            # Python before 3.11
+            try:
+                import tomli as tomllib
+            except ImportError:
+                raise ValueError("Reading " + file_name + " needs Python 3.11 or tomli (pip install tomli)")
+        with open(file_name, 'rb') as file:
+            return tomllib.load(file)
+    raise ValueError(file_name + ": protocol files must be .json, .yaml, .yml or .toml")
+
+# Sessions of a protocol file with the defaults applied, repeats expanded and every
+# setting checked
+def load_batch(file_name: str) -> list:
+    # Input: str (protocol file name)
+    # Return: list of dict (one per session run, in order)
+    content = parse_protocol_file(file_name)
+    if isinstance(content, list):
+        content = {'sessions': content}
+    if not isinstance(content, dict) or not isinstance(content.get('sessions'), list) or not content['sessions']:
+        raise ValueError(file_name + ": expected a list of sessions")
+    defaults = content.get('defaults') or {}
+
+    batch = []
+    for index, entry in enumerate(content['sessions']):
+        session = {**defaults, **entry}
+        session.setdefault('name', 'session' + str(index + 1))
+        check_session(session)
+        for _ in range(int(session.get('repeat', 1))):
+            batch.append(session)
+    return batch
+
+def check_session(session: dict) -> None:
+    # Input: dict (session)
+    # Return: None
+    name = str(session['name'])
+    missing = [setting for setting in SETTINGS if setting not in session]
+    if missing:
+        raise ValueError(name + ": missing " + ", ".join(missing))
+    for setting in SETTINGS:
+        value = session[setting]
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value) or value < 0:
+            raise ValueError(name + ": " + setting + " must be a number of at least 0, not " + repr(value))
+    for setting in ('number_of_trials', 'pressure', 'inflate_time', 'deflate_time'):
+        if session[setting] <= 0:
+            raise ValueError(name + ": " + setting + " must be more than 0")
+    repeat = session.get('repeat', 1)
+    if isinstance(repeat, bool) or not isinstance(repeat, int) or repeat < 1:
+        raise ValueError(name + ": repeat must be a whole number of at least 1")
+    pause = session.get('pause', 0)
+    if isinstance(pause, bool) or not isinstance(pause, (int, float)) or pause < 0:
+        raise ValueError(name + ": pause must be a number of at least 0")
+    backend_name(session.get('backend'))
+    if session.get('controller') is not None:
+        from controller import CONTROLLERS
+        if session['controller'] not in CONTROLLERS:
+            raise ValueError(name + ": controller must be one of " + ", ".join(sorted(CONTROLLERS)))
+    if session.get('filter') is not None:
+        from filters import FILTERS
+        if session['filter'] not in FILTERS:
+            raise ValueError(name + ": filter must be one of " + ", ".join(sorted(FILTERS)))
+
+def settings_of(session: dict) -> tuple:
+    # Input: dict (session)
+    # Return: tuple (the six trial settings)
+    return tuple(float(session[setting]) for setting in SETTINGS)
+
+# Seconds the protocol of a session takes, without its pause
+def session_duration(session: dict) -> float:
+    # Input: dict (session)
+    # Return: float (seconds)
+    return compile_protocol(*settings_of(session), session.get('control_frequency', 100.0)).total_duration
+
+
+
+### Running ###
+def run_session(session: dict, number: int, output: str = '.', on_start=None) -> dict:
+    # Input: dict (session), int (position in the batch, 1 based), str (output directory),
+    #        optional callable (receives the backend before the session runs)
+    # Return: dict (name, outcome, log and trace file names, seconds, error if the backend could not start)
+    name = str(session['name'])
+    backend = backend_name(session.get('backend'))
+    result = {'session': number, 'name': name, 'backend': backend}
+    backend_defaults = BACKENDS[backend][2]
+    options = {key: value for key, value in session.items()
+               if key not in RUNNER_KEYS and key not in SETTINGS and (value is not None or key in backend_defaults)}
+    started = time.perf_counter()
+    try:
+        if session.get('controller') is not None:
+            from controller import make_controller
+            options['controller'] = make_controller(session['controller'])
+        if session.get('filter') is not None:
+            from filters import make_filter
+            options['pressure_filter'] = make_filter(session['filter'])
+        prefix = get_backend(backend).log_prefix + format(number, '02d') + "_" + name + "_"
+        options['log_prefix'] = os.path.join(output, prefix)
+        pump_control = create_pump_control(backend, *settings_of(session), **options)
+    except Exception as error:
+        # i.e. an option the backend does not take, or missing hardware
+        return {**result, 'outcome': 'ERROR', 'error': repr(error), 'seconds': time.perf_counter() - started}
+    if on_start is not None:
+        on_start(pump_control)
+    outcome = pump_control.run_trials()
+    return {**result,
+            'outcome': outcome,
+            'log': pump_control.log_file.file_name,
+            'trace': pump_control.log_file.trace_file_name,
+            'seconds': time.perf_counter() - started}
+
+# Run every session in order. A session that ends in an error is reported and the batch
+# goes on; Ctrl+C halts the running session and stops the batch, and so does a safety trip
+def run_batch(batch: list, output: str = '.', report=print, on_start=None) -> list:
+    # Input: list of dict (from load_batch), str (output directory), callable (receives each result as a JSON line),
+    #        optional callable (receives each backend before its session runs)
+    # Return: list of dict (results)
+    os.makedirs(output, exist_ok=True)
+    results = []
+    for number, session in enumerate(batch, start=1):
+        result = run_session(session, number, output, on_start)
+        results.append(result)
+        report(json.dumps(result))
+        if result['outcome'] in ('HALTED', 'TRIPPED'):
+            break
+        pause = session.get('pause', 0)
+        if pause and number < len(batch):
+            try:
+                time.sleep(pause)
+            except KeyboardInterrupt:
+                break
+    return results
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a queue of sessions from a protocol file without the GUI")
+    parser.add_argument('protocol', help="protocol file (.json, .yaml, .yml or .toml)")
+    parser.add_argument('-o', '--output', default='.', help="directory for the session files")
+    parser.add_argument('--backend', choices=sorted(BACKENDS), help="backend for sessions that do not name one")
+    parser.add_argument('--dry-run', action='store_true', help="check the file and list the sessions without running them")
+    parser.add_argument('--metrics-port', type=int, default=None, help="serve live metrics of the running session on localhost at this port")
+    args = parser.parse_args()
+
+    batch = load_batch(args.protocol)
+    if args.backend is not None:
+        batch = [{'backend': args.backend, **session} for session in batch]
+    if args.dry_run:
+        total = 0.0
+        for number, session in enumerate(batch, start=1):
+            duration = session_duration(session)
+            total += duration + (session.get('pause', 0) if number < len(batch) else 0)
+            print(format(number, '3d') + "  " + str(session['name']) + "  " + backend_name(session.get('backend'))
+                  + "  " + format(duration, '.1f') + " s")
+        print(str(len(batch)) + " sessions, " + format(total / 60, '.1f') + " min")
+    else:
+        # The endpoint always serves the session that is running, or the last one
+        running = []
+
+        def serve(pump_control) -> None:
+            running[:] = [pump_control.metrics]
+
+        if args.metrics_port is not None:
+            MetricsServer(lambda: running, args.metrics_port).start()
+        run_batch(batch, args.output, on_start=serve)
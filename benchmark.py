@@ -0,0 +1,336 @@
+#!/usr/bin/python3.9.6
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from PumpControl import PumpControl
+from PumpControlSimulator import PumpControlSimulator, SimulatedADS
+from PumpControlReplay import ReplayGPIO
+from controller import make_controller
+from events import EventKind
+from sampling import make_sample, pressure_to_voltage
+from ui_bridge import UiBridge
+
+### Control Loop Benchmarks ###
+# Times the pieces of the control loop and whole protocols, and saves the results as JSON
+# so runs on different commits can be compared:
+#
+#   python3 benchmark.py -o bench.json
+#   python3 benchmark.py --quick --compare bench.json
+#
+# Latencies are per call, in microseconds, as percentiles over many calls. Two backends:
+#   mocked     PumpControl on no-op GPIO and an ADC channel that returns at once, so only
+#              the Python cost of the control code is measured
+#   simulator  PumpControlSimulator as fast as possible, for loops that need the pressure
+#              to respond (raise_pressure, lower_pressure) and for long protocols
+#
+# Protocol timing error is how far each phase's actual duration was from its desired
+# duration. On the mocked backend the protocol runs in real time on the real clock, so this
+# includes OS sleep jitter. On the simulator the clock is simulated, which measures phase
+# boundary handling over many ticks and how fast a session can be simulated.
+
+# Standard protocols: six trial settings each
+PROTOCOLS = {'3x250': (3, 250, 2, 5, 2, 10),
+             '30x360_hold': (30, 250, 2, 360, 2, 10)}
+
+# Short stand-in for the real time run with --quick
+QUICK_PROTOCOL = (1, 250, 1, 1, 1, 0)
+
+# A p50 this much slower than in the compared file is reported as a regression
+REGRESSION_RATIO = 1.2
+
+### Mocked Hardware ###
+class ConstantChannel:
+    def __init__(self, pressure: float) -> None:
+        self.voltage = pressure_to_voltage(pressure)
+
+class MockedPumpControl(PumpControl):
+    log_prefix = "Bench_"
+
+    def __init__(self, *settings, pressure: float = 100.0, **kwargs):
+        self.mocked_pressure = pressure
+        super().__init__(*settings, **kwargs)
+
+    def setup_hardware(self) -> None:
+        self.GPIO = ReplayGPIO()
+        self.ads = SimulatedADS()
+        self.pressure_channel = ConstantChannel(self.mocked_pressure)
+
+    def start_acquisition(self, data_rate: int) -> None:
+        self.acquisition = None
+
+    def start_scanning(self, channels: list) -> None:
+        self.acquisition = None
+
+
+
+### Statistics ###
+# Nearest rank percentiles of call times in nanoseconds, reported in microseconds
+def latency_summary(samples_ns: list) -> dict:
+    # Input: list of int (nanoseconds)
+    # Return: dict (count, mean, p50, p90, p99, max in microseconds)
+    if not samples_ns:
+        return {'count': 0}
+    ordered = sorted(samples_ns)
+    count = len(ordered)
+
+    def percentile(fraction: float) -> float:
+        return ordered[min(int(fraction * count), count - 1)] / 1000
+
+    return {'count': count,
+            'mean': sum(ordered) / count / 1000,
+            'p50': percentile(0.50),
+            'p90': percentile(0.90),
+            'p99': percentile(0.99),
+            'max': ordered[-1] / 1000}
+
+# Time function() n times, one call at a time
+def time_calls(function, n: int) -> dict:
+    # Input: callable (no arguments), int (calls)
+    # Return: dict (see latency_summary)
+    clock = time.perf_counter_ns
+    samples = []
+    append = samples.append
+    for _ in range(n):
+        start = clock()
+        function()
+        append(clock() - start)
+    return latency_summary(samples)
+
+
+
+### Benchmarks ###
+def bench_steps(make, n: int) -> dict:
+    # Input: callable (returns a PumpControl), int (calls)
+    # Return: dict of name -> latency summary
+    results = {}
+    for controller in ('bang_bang', 'pid'):
+        pump_control = make(controller=make_controller(controller))
+        for spec in pump_control.protocol.phases[:3]:
+            pump_control.begin_phase(spec)
+            step = pump_control.step_for(spec.phase)
+            elapsed = spec.duration / 2
+            results['step.' + spec.phase.name.lower() + '.' + controller] = time_calls(lambda: step(elapsed), n)
+        pump_control.run_trials(keep_running=lambda: False)
+    return results
+
+def bench_sensor(make, n: int) -> dict:
+    # Input: callable (returns a PumpControl), int (calls)
+    # Return: dict of name -> latency summary
+    pump_control = make()
+    results = {'read_sample.mocked': time_calls(pump_control.read_sample, n),
+               'get_pressure.mocked': time_calls(pump_control.get_pressure, n)}
+    pump_control.run_trials(keep_running=lambda: False)
+    return results
+
+def bench_logging(make, n: int) -> dict:
+    # Input: callable (returns a PumpControl), int (calls)
+    # Return: dict of name -> latency summary
+    pump_control = make()
+    sample = make_sample(pressure_to_voltage(120.0), 1.0)
+    trace = pump_control.trace
+    results = {'log.event': time_calls(lambda: pump_control.log_event(EventKind.NOTE, 0, 1.0, 'benchmark'), n),
+               'log.actuator': time_calls(lambda: pump_control.inflation_pump.set_state(not pump_control.inflation_pump.get_state()), n),
+               'log.trace_write': time_calls(lambda: trace.write(sample, 1, 0), n)}
+    start = time.perf_counter_ns()
+    pump_control.run_trials(keep_running=lambda: False)
+    results['log.close_ms'] = (time.perf_counter_ns() - start) / 1e6
+    return results
+
+# Intervals between the pressure reads of raise_pressure and lower_pressure, the time one
+# iteration of their loop takes
+def bench_pressure_loops(make_simulator, target: float) -> dict:
+    # Input: callable (returns a PumpControlSimulator), float (mmHg)
+    # Return: dict of name -> latency summary
+    pump_control = make_simulator()
+    reads = []
+    get_sample = pump_control.get_sample
+
+    def timed_get_sample():
+        reads.append(time.perf_counter_ns())
+        return get_sample()
+
+    pump_control.get_sample = timed_get_sample
+    results = {}
+    for name, loop, setpoint in (('raise_pressure', pump_control.raise_pressure, target),
+                                 ('lower_pressure', pump_control.lower_pressure, target * 0.1)):
+        reads.clear()
+        loop(setpoint)
+        results[name + '.iteration'] = latency_summary([b - a for a, b in zip(reads, reads[1:])])
+        pump_control.stop_pumps()
+    pump_control.run_trials(keep_running=lambda: False)
+    return results
+
+def bench_ui(n: int) -> dict:
+    # Input: int (samples)
+    # Return: dict of name -> latency summary, or the reason the GUI was skipped
+    bridge = UiBridge()
+    results = {'ui.bridge_push': time_calls(lambda: bridge.push_sample(1.0, 120.0), n)}
+    start = time.perf_counter_ns()
+    samples, events = bridge.drain()
+    results['ui.bridge_drain_us_per_sample'] = (time.perf_counter_ns() - start) / max(len(samples), 1) / 1000
+
+    # show_status needs a display; a batch of 5 samples is what one 50 ms poll gets at 100 Hz
+    try:
+        from guiWindow import GuiWindow
+        window = GuiWindow('tester')
+    except Exception as error:
+        results['gui.show_status'] = {'skipped': repr(error)}
+        return results
+    try:
+        window.live_plot.reset(60.0, 300.0)
+        batch = [(0.0, 120.0, 0)] * 5
+        elapsed = [0.0]
+
+        def show_status():
+            elapsed[0] += 0.05
+            window.show_status([(elapsed[0], pressure, series) for _, pressure, series in batch])
+
+        results['gui.show_status'] = time_calls(show_status, min(n, 2000))
+        results['gui.redraw'] = time_calls(lambda: (show_status(), window.live_plot.redraw()), min(n, 200))
+    finally:
+        window.destroy()
+    return results
+
+# Run a whole protocol and compare every phase's actual duration to its desired duration
+def bench_protocol(pump_control) -> dict:
+    # Input: PumpControl
+    # Return: dict (phase timing error in ms, ticks, overruns, jitter, wall seconds)
+    start = time.perf_counter()
+    outcome = pump_control.run_trials()
+    wall = time.perf_counter() - start
+    starts = pump_control.events.columns(EventKind.PHASE_START)
+    ends = pump_control.events.columns(EventKind.PHASE_END)
+    errors = [abs(actual - desired) * 1000 for desired, actual in zip(starts.value, ends.value)]
+    metrics = pump_control.events.columns(EventKind.METRIC)
+    ticks = sum(value for name, value in zip(metrics.text, metrics.value) if name == 'ticks')
+    overruns = sum(value for name, value in zip(metrics.text, metrics.value) if name == 'overruns')
+    max_jitter = max((value for name, value in zip(metrics.text, metrics.value) if name == 'max_jitter'), default=0.0)
+    return {'outcome': outcome,
+            'phases': len(errors),
+            'mean_phase_error_ms': sum(errors) / len(errors) if errors else 0.0,
+            'max_phase_error_ms': max(errors, default=0.0),
+            'ticks': int(ticks),
+            'overruns': int(overruns),
+            'max_jitter_ms': max_jitter * 1000,
+            'wall_seconds': wall}
+
+
+
+### Suite ###
+def git_commit() -> str:
+    # Input: None
+    # Return: str (commit hash, or '' outside a git checkout)
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, timeout=5).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ''
+
+# Without an output directory the session files go to a temporary directory that is
+# removed when the suite ends
+def run_suite(quick: bool = False, output_directory: str = None) -> dict:
+    # Input: bool (fewer calls and short protocols), optional str (directory for session files)
+    # Return: dict (results and run information)
+    if output_directory is not None:
+        return run_benchmarks(quick, output_directory)
+    with tempfile.TemporaryDirectory(prefix='pump_benchmark_') as directory:
+        return run_benchmarks(quick, directory)
+
+def run_benchmarks(quick: bool, directory: str) -> dict:
+    # Input: bool (fewer calls and short protocols), str (directory for session files)
+    # Return: dict (results and run information)
+    n = 2000 if quick else 20000
+    step_protocol = (1, 250, 2, 5, 2, 0)
+
+    def mocked(*settings, **kwargs):
+        return MockedPumpControl(*(settings or step_protocol), log_prefix=os.path.join(directory, 'Bench_'), **kwargs)
+
+    def simulator(*settings, **kwargs):
+        return PumpControlSimulator(*(settings or step_protocol), speed=None, seed=1,
+                                    log_prefix=os.path.join(directory, 'Sim_'), **kwargs)
+
+    results = {}
+    results.update(bench_steps(mocked, n))
+    results.update(bench_sensor(mocked, n))
+    results.update(bench_logging(mocked, n))
+    results.update(bench_pressure_loops(simulator, 250.0))
+    results.update(bench_ui(n))
+
+    real_time = QUICK_PROTOCOL if quick else PROTOCOLS['3x250']
+    results['protocol.3x250.mocked_real_time'] = bench_protocol(mocked(*real_time, pressure=250.0))
+    for name, settings in PROTOCOLS.items():
+        if quick and name != '3x250':
+            continue
+        results['protocol.' + name + '.simulated'] = bench_protocol(simulator(*settings))
+
+    return {'commit': git_commit(),
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'quick': quick,
+            'results': results}
+
+# p50 and phase timing error of every benchmark in both runs, with the ratio new / old
+def compare(old: dict, new: dict) -> list:
+    # Input: dict (earlier run), dict (this run)
+    # Return: list of (name, field, old value, new value, ratio)
+    rows = []
+    for name, result in new['results'].items():
+        previous = old.get('results', {}).get(name)
+        if not isinstance(result, dict) or not isinstance(previous, dict):
+            continue
+        for field in ('p50', 'max_phase_error_ms'):
+            if field in result and previous.get(field):
+                rows.append((name, field, previous[field], result[field], result[field] / previous[field]))
+    return rows
+
+# Fixed width table for the terminal
+def format_results(results: dict) -> str:
+    # Input: dict (results of run_suite)
+    # Return: str
+    lines = []
+    for name, result in results.items():
+        if not isinstance(result, dict):
+            lines.append(name.ljust(40) + format(result, '.3f'))
+        elif 'p50' in result:
+            lines.append(name.ljust(40) + '  '.join(field + ' ' + format(result[field], '8.2f') for field in ('p50', 'p90', 'p99', 'max')) + ' us')
+        elif 'max_phase_error_ms' in result:
+            lines.append(name.ljust(40) + 'phase error mean ' + format(result['mean_phase_error_ms'], '.2f')
+                         + ' max ' + format(result['max_phase_error_ms'], '.2f') + ' ms, overruns ' + str(result['overruns'])
+                         + ', ' + format(result['wall_seconds'], '.1f') + ' s')
+        else:
+            lines.append(name.ljust(40) + json.dumps(result))
+    return '\n'.join(lines)
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the control loop on the simulator and a mocked backend")
+    parser.add_argument('-o', '--output', help="write the results to this JSON file")
+    parser.add_argument('--quick', action='store_true', help="fewer calls and no long protocols")
+    parser.add_argument('--compare', help="earlier results (JSON) to compare against")
+    parser.add_argument('--logs', help="keep the session files in this directory")
+    args = parser.parse_args()
+
+    report = run_suite(args.quick, args.logs)
+    print(format_results(report['results']))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            rows = compare(json.load(file), report)
+        regressions = 0
+        for name, field, before, after, ratio in rows:
+            flag = '  REGRESSION' if ratio > REGRESSION_RATIO else ''
+            regressions += bool(flag)
+            print(name.ljust(40) + field.ljust(20) + format(before, '10.2f') + ' -> ' + format(after, '10.2f')
+                  + '  x' + format(ratio, '.2f') + flag)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,232 @@
+#!/usr/bin/python3.9.6
+import argparse
+import json
+import math
+import os
+import time
+from typing import NamedTuple
+
+from sampling import ADS_OFFSET, PRESSURE_PER_VOLT
+
+### Pressure Sensor Calibration ###
+# pressure = (voltage + offset) * gain
+#
+# The op-amp adds a bias of a few mV that differs between boards and drifts with
+# temperature, and the sensor gain differs a little between sensors. Instead of the
+# constants in sampling.py, every ADS1115 gets a calibration profile:
+#   zero       offset from the mean of many readings of the vented cuff, gain unchanged
+#   two_point  also the gain, from a second reading at a pressure measured with a reference
+#              manometer
+#
+# Profiles are cached in a JSON file keyed by ADC address. At startup a fresh cached profile
+# is used as it is, so a session starts without reading the sensor. A stale one is zeroed
+# again and keeps its gain, since the gain hardly drifts. The cuff must be vented (no
+# pressure applied) when a profile is zeroed; a zero reading too far from the expected op-amp
+# bias is rejected.
+#
+#   python3 calibration.py --backend pi --address 0x48                  zero now
+#   python3 calibration.py --backend pi --address 0x48 --reference 200  zero and gain
+#   python3 calibration.py --show                                       list cached profiles
+
+# Seconds a cached profile is used before it is zeroed again
+DEFAULT_MAX_AGE = 8 * 3600
+
+# Readings averaged for a zero or reference point
+DEFAULT_SAMPLES = 64
+
+# Largest accepted difference between a measured offset and ADS_OFFSET in V, about 47 mmHg.
+# The op-amp bias is 4-6 mV, anything further means the cuff was not vented
+MAX_ZERO_SHIFT = 0.005
+
+class CalibrationProfile(NamedTuple):
+    ads_address: int = 0x48
+    offset: float = ADS_OFFSET       # V added to a reading
+    gain: float = PRESSURE_PER_VOLT  # mmHg per V
+    noise: float = 0.0               # standard deviation of the zero readings in mmHg
+    samples: int = 0                 # readings averaged for the zero point
+    method: str = 'default'          # default, zero or two_point
+    created: float = 0.0             # Unix time the profile was measured
+
+    def to_pressure(self, voltage: float) -> float:
+        # Input: float (V)
+        # Return: float (mmHg)
+        return (voltage + self.offset) * self.gain
+
+    def to_voltage(self, pressure: float) -> float:
+        # Input: float (mmHg)
+        # Return: float (V)
+        return pressure / self.gain - self.offset
+
+    # Seconds since the profile was measured
+    def age(self, now: float = None) -> float:
+        # Input: optional float (Unix time, default now)
+        # Return: float (seconds, inf for the default profile)
+        if self.method == 'default':
+            return math.inf
+        return (time.time() if now is None else now) - self.created
+
+    def as_dict(self) -> dict:
+        return self._asdict()
+
+    @classmethod
+    def from_dict(cls, entry: dict) -> "CalibrationProfile":
+        # Input: dict (from as_dict, the address may be a string such as "0x48")
+        # Return: CalibrationProfile
+        entry = {name: value for name, value in entry.items() if name in cls._fields}
+        if isinstance(entry.get('ads_address'), str):
+            entry['ads_address'] = int(entry['ads_address'], 0)
+        return cls(**entry)
+
+
+
+### Measurement ###
+# Mean and standard deviation of n readings
+def average_voltage(read_voltage, samples: int = DEFAULT_SAMPLES) -> tuple:
+    # Input: callable (one ADC reading in V), int (readings)
+    # Return: tuple (mean V, standard deviation V)
+    if samples < 1:
+        raise ValueError("samples must be at least 1")
+    total = 0.0
+    square = 0.0
+    for _ in range(samples):
+        voltage = read_voltage()
+        total += voltage
+        square += voltage * voltage
+    mean = total / samples
+    return mean, math.sqrt(max(square / samples - mean * mean, 0.0))
+
+# Zero the profile on the vented cuff: the mean reading becomes 0 mmHg
+def zero_calibration(read_voltage, profile: CalibrationProfile, samples: int = DEFAULT_SAMPLES,
+                     max_shift: float = MAX_ZERO_SHIFT) -> CalibrationProfile:
+    # Input: callable (one ADC reading in V), CalibrationProfile (gain to keep), int (readings),
+    #        float (V, largest accepted distance of the offset from ADS_OFFSET)
+    # Return: CalibrationProfile
+    mean, deviation = average_voltage(read_voltage, samples)
+    offset = -mean
+    if abs(offset - ADS_OFFSET) > max_shift:
+        raise ValueError("The vented cuff reads " + format((ADS_OFFSET - offset) * profile.gain, '.1f')
+                         + " mmHg, more than the op-amp bias explains; vent the cuff and calibrate again")
+    method = 'two_point' if profile.method == 'two_point' else 'zero'
+    return profile._replace(offset=offset, noise=deviation * profile.gain, samples=samples,
+                            method=method, created=time.time())
+
+# Gain and offset through two points, i.e. the vented cuff at 0 mmHg and a reference pressure
+def two_point_calibration(low_voltage: float, low_pressure: float, high_voltage: float, high_pressure: float,
+                          profile: CalibrationProfile) -> CalibrationProfile:
+    # Input: float (V), float (mmHg), float (V), float (mmHg), CalibrationProfile (address and noise to keep)
+    # Return: CalibrationProfile
+    if high_voltage == low_voltage or high_pressure == low_pressure:
+        raise ValueError("The two calibration points must differ in voltage and pressure")
+    gain = (high_pressure - low_pressure) / (high_voltage - low_voltage)
+    if gain <= 0:
+        raise ValueError("Pressure must rise with the voltage; check the reference reading")
+    return profile._replace(offset=low_pressure / gain - low_voltage, gain=gain, method='two_point',
+                            created=time.time())
+
+
+
+### Profile Cache ###
+# Profiles of every ADC in one JSON file, by address as "0x48". Written to a temporary
+# file and renamed, so an interrupted save never leaves a broken cache.
+class ProfileCache:
+    def __init__(self, file_name: str = 'calibration.json', max_age: float = DEFAULT_MAX_AGE) -> None:
+        # Input: str (JSON file name), float (seconds a profile stays fresh)
+        # Return: None
+        self.file_name = file_name
+        self.max_age = max_age
+
+    def profiles(self) -> dict:
+        # Input: None
+        # Return: dict of int (address) -> CalibrationProfile
+        try:
+            with open(self.file_name, 'r') as file:
+                entries = json.load(file)
+        except (OSError, ValueError):
+            return {}
+        profiles = {}
+        for entry in entries.values():
+            try:
+                profile = CalibrationProfile.from_dict(entry)
+            except (TypeError, ValueError):
+                continue
+            profiles[profile.ads_address] = profile
+        return profiles
+
+    def load(self, ads_address: int) -> CalibrationProfile:
+        # Input: int (I2C address)
+        # Return: CalibrationProfile or None
+        return self.profiles().get(ads_address)
+
+    def save(self, profile: CalibrationProfile) -> None:
+        # Input: CalibrationProfile
+        # Return: None
+        profiles = self.profiles()
+        profiles[profile.ads_address] = profile
+        entries = {hex(address): profiles[address].as_dict() for address in sorted(profiles)}
+        temporary = self.file_name + '.tmp'
+        with open(temporary, 'w') as file:
+            json.dump(entries, file, indent=2)
+        os.replace(temporary, self.file_name)
+
+    def is_fresh(self, profile: CalibrationProfile, now: float = None) -> bool:
+        # Input: CalibrationProfile, optional float (Unix time)
+        # Return: bool
+        return profile.age(now) <= self.max_age
+
+# Profile for an ADC at startup: the cached one while it is fresh, otherwise a new zero
+# (keeping a cached gain), which is saved. Returns the profile and whether it came from the cache
+def load_or_calibrate(read_voltage, ads_address: int, cache: ProfileCache, samples: int = DEFAULT_SAMPLES) -> tuple:
+    # Input: callable (one ADC reading in V), int (I2C address), ProfileCache, int (readings)
+    # Return: tuple (CalibrationProfile, bool)
+    cached = cache.load(ads_address)
+    if cached is not None and cache.is_fresh(cached):
+        return cached, True
+    profile = zero_calibration(read_voltage, cached or CalibrationProfile(ads_address), samples)
+    cache.save(profile)
+    return profile, False
+
+
+
+if __name__ == "__main__":
+    from backends import BACKENDS, create_pump_control
+
+    parser = argparse.ArgumentParser(description="Calibrate the pressure sensor of one ADS1115 and cache the profile")
+    parser.add_argument('--backend', choices=sorted(BACKENDS), help="defaults to $PUMP_BACKEND or pi")
+    parser.add_argument('--address', default='0x48', help="I2C address of the ADS1115 (0x48-0x4B)")
+    parser.add_argument('--cache', default='calibration.json', help="profile cache file")
+    parser.add_argument('--samples', type=int, default=256, help="readings averaged per point")
+    parser.add_argument('--reference', type=float, default=None,
+                        help="also calibrate the gain: inflate to about this many mmHg and enter the reference reading")
+    parser.add_argument('--show', action='store_true', help="list the cached profiles and exit")
+    args = parser.parse_args()
+
+    cache = ProfileCache(args.cache)
+    if args.show:
+        for profile in cache.profiles().values():
+            print(json.dumps({**profile.as_dict(), 'ads_address': hex(profile.ads_address),
+                              'age_hours': profile.age() / 3600, 'fresh': cache.is_fresh(profile)}))
+    else:
+        address = int(args.address, 0)
+        # The default profile is passed so the backend does not load or zero one itself.
+        # Calibrating is not a session, so no log or trace is written
+        pump_control = create_pump_control(args.backend, 1, args.reference or 100, 1, 1, 1, 0, ads_address=address,
+                                           calibration=CalibrationProfile(address), calibration_cache=None,
+                                           session_files=False)
+        try:
+            input("Vent the cuff, then press Enter")
+            profile = zero_calibration(pump_control.read_voltage, cache.load(address) or CalibrationProfile(address),
+                                       args.samples)
+            if args.reference is not None:
+                low_voltage = -profile.offset
+                pump_control.raise_pressure(args.reference)
+                # Read the sensor as soon as the reference pressure is reached, before the cuff
+                # leaks down, and ask for the manometer reading of the same moment
+                print("Read the reference manometer now")
+                high_voltage, _ = average_voltage(pump_control.read_voltage, args.samples)
+                reading = pump_control.input_sanitizer(input("Reference reading in mmHg: "))
+                profile = two_point_calibration(low_voltage, 0.0, high_voltage, reading, profile)
+        finally:
+            pump_control.emergency_shutoff()
+            pump_control.close_log()
+        cache.save(profile)
+        print(json.dumps({**profile.as_dict(), 'ads_address': hex(profile.ads_address)}))
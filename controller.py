@@ -0,0 +1,112 @@
+#!/usr/bin/python3.9.6
+from sampling import PressureSample
+
+### Pressure Controllers ###
+# A controller turns the setpoint of the current tick into a pump command between -1 and 1.
+#   command > 0: inflation pump at that duty, deflation pump off
+#   command < 0: deflation pump at that duty, inflation pump off
+#   command = 0: both pumps off
+# setpoint_rate is the slope of the ramp profile in mmHg/s and is used for feed-forward.
+# Controllers keep their own state between ticks; reset() is called at the start of every phase.
+
+
+
+### Bang-Bang Controller ###
+# Pumps run at full duty. A pump turns on once the error exceeds `hysteresis` mmHg and turns
+# off when the pressure reaches the setpoint, so a small band around the setpoint does not
+# make the pumps chatter. With a hysteresis of 0, the default and the original behaviour,
+# a pump runs whenever the pressure is on the wrong side of the setpoint.
+class BangBangController:
+    def __init__(self, hysteresis: float = 0.0) -> None:
+        # Input: float (mmHg)
+        # Return: None
+        self.hysteresis = hysteresis
+        self.__command = 0.0
+
+    def reset(self) -> None:
+        self.__command = 0.0
+
+    def update(self, setpoint: float, setpoint_rate: float, sample: PressureSample) -> float:
+        # Input: float (mmHg), float (mmHg/s, unused), PressureSample
+        # Return: float (pump command, -1, 0 or 1)
+        error = setpoint - sample.pressure
+        if error > self.hysteresis or (self.__command > 0 and error > 0):
+            self.__command = 1.0
+        elif error < -self.hysteresis or (self.__command < 0 and error < 0):
+            self.__command = -1.0
+        else:
+            self.__command = 0.0
+        return self.__command
+
+
+
+### PID + Feed-Forward Controller ###
+# command = kff * setpoint_rate + kp * error + ki * integral(error) - kd * d(pressure)/dt
+#
+# The feed-forward term drives the pump at the duty the ramp needs, so the PID terms only
+# correct the remaining error. The derivative acts on the measured pressure, not the error,
+# so setpoint steps at phase boundaries do not kick the output. Anti-windup: the integral
+# stops growing while the output is saturated in the direction of the error, and is
+# clamped to +/- integral_limit of output.
+# Commands smaller than min_duty are treated as 0, because the pumps stall at low duty.
+class PidController:
+    def __init__(self,
+                 kp: float = 0.05,
+                 ki: float = 0.02,
+                 kd: float = 0.0,
+                 kff: float = 0.008,
+                 integral_limit: float = 0.5,
+                 min_duty: float = 0.15) -> None:
+        # Input: float (duty per mmHg), float (duty per mmHg*s), float (duty per mmHg/s),
+        #        float (duty per mmHg/s of ramp), float (max integral contribution), float (min duty)
+        # Return: None
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.kff = kff
+        self.integral_limit = integral_limit
+        self.min_duty = min_duty
+        self.reset()
+
+    def reset(self) -> None:
+        self.integral = 0.0
+        self.__last_sample = None
+
+    def update(self, setpoint: float, setpoint_rate: float, sample: PressureSample) -> float:
+        # Input: float (mmHg), float (mmHg/s), PressureSample
+        # Return: float (pump command between -1 and 1)
+        error = setpoint - sample.pressure
+        last = self.__last_sample
+        self.__last_sample = sample
+
+        dt = 0.0 if last is None else sample.timestamp - last.timestamp
+        derivative = 0.0
+        if dt > 0:
+            derivative = (sample.pressure - last.pressure) / dt
+
+        output = self.kff * setpoint_rate + self.kp * error - self.kd * derivative
+        if dt > 0 and self.ki != 0:
+            integral = self.integral + self.ki * error * dt
+            integral = max(-self.integral_limit, min(self.integral_limit, integral))
+            # Only integrate if it does not push an already saturated output further
+            saturated = abs(output + integral) > 1.0 and (output + integral) * error > 0
+            if not saturated:
+                self.integral = integral
+        output += self.integral
+
+        output = max(-1.0, min(1.0, output))
+        if abs(output) < self.min_duty:
+            return 0.0
+        return output
+
+
+
+# Controllers that can be chosen by name, i.e. from a config file or the CLI
+CONTROLLERS = {'bang_bang': BangBangController, 'pid': PidController}
+
+def make_controller(name: str = 'bang_bang', **gains):
+    # Input: str (controller name), keyword gains passed to the controller
+    # Return: BangBangController or PidController
+    if name not in CONTROLLERS:
+        raise ValueError("Unknown controller " + name + ", expected one of " + ", ".join(CONTROLLERS))
+    return CONTROLLERS[name](**gains)
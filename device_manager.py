@@ -0,0 +1,298 @@
+#!/usr/bin/python3.9.6
+import argparse
+import json
+from typing import NamedTuple
+
+from backends import BACKENDS, backend_name, get_backend
+from events import EventKind
+from metrics import Metrics, MetricsServer
+from scheduler import Phase, PhaseStats, TickScheduler
+
+### Multi-Cuff Orchestration ###
+# Runs several cuffs, each a pump/pump/valve set with its own ADS1115, from one process.
+#
+# All cuffs share:
+#   - one I2C bus and one lock around every read on it (PumpControl.shared_hardware), so
+#     ADCs at different addresses never talk over each other
+#   - one session clock, so samples and events of every cuff are on the same timeline
+#   - one TickScheduler. Every tick steps each cuff in turn, so each cuff reads its ADC
+#     once per tick, one after the other, instead of separate loops contending for the bus
+#
+# Every cuff runs the same compiled protocol. A cuff's offset delays its protocol on the
+# shared timeline: equal offsets run the cuffs synchronized, i.e. both arms at once, and
+# different offsets stagger them. Each cuff keeps its own controller, session CSV, trace
+# and metrics labelled with its name; the period of the shared loop is in the manager's.
+#
+#   python3 device_manager.py cuffs.json --backend sim --stagger 30
+
+### Cuff Configuration ###
+class CuffConfig(NamedTuple):
+    name: str
+    inflate_pin: int = 13     # BCM
+    deflate_pin: int = 12
+    valve_pin: int = 27
+    ads_address: int = 0x48   # 0x48-0x4B, set by the ADDR pin of the ADS1115
+    offset: float = 0.0       # seconds from the session start to the start of this cuff's protocol
+
+# I2C addresses an ADS1115 can be strapped to
+ADS_ADDRESSES = (0x48, 0x49, 0x4A, 0x4B)
+
+# Cuffs from a JSON list, i.e.
+#   [{"name": "left"},
+#    {"name": "right", "inflate_pin": 5, "deflate_pin": 6, "valve_pin": 26, "ads_address": "0x49"}]
+# Addresses may be numbers or strings such as "0x49"
+def load_cuffs(file_name: str) -> list:
+    # Input: str (JSON file name)
+    # Return: list of CuffConfig
+    with open(file_name, 'r') as file:
+        entries = json.load(file)
+    cuffs = []
+    for entry in entries:
+        entry = dict(entry)
+        if isinstance(entry.get('ads_address'), str):
+            entry['ads_address'] = int(entry['ads_address'], 0)
+        cuffs.append(CuffConfig(**entry))
+    return cuffs
+
+# The same cuffs with protocol starts interval seconds apart, in order
+def staggered(cuffs: list, interval: float) -> list:
+    # Input: list of CuffConfig, float (seconds)
+    # Return: list of CuffConfig
+    return [cuff._replace(offset=index * interval) for index, cuff in enumerate(cuffs)]
+
+def check_cuffs(cuffs: list) -> None:
+    # Input: list of CuffConfig
+    # Return: None
+    if not cuffs:
+        raise ValueError("At least one cuff is needed")
+    names = [cuff.name for cuff in cuffs]
+    if len(set(names)) != len(names):
+        raise ValueError("Cuff names must be unique")
+    pins = [pin for cuff in cuffs for pin in (cuff.inflate_pin, cuff.deflate_pin, cuff.valve_pin)]
+    if len(set(pins)) != len(pins):
+        raise ValueError("Every pump and valve needs its own pin")
+    addresses = [cuff.ads_address for cuff in cuffs]
+    if len(set(addresses)) != len(addresses):
+        raise ValueError("Every cuff needs its own ADS1115 address")
+    for cuff in cuffs:
+        if cuff.ads_address not in ADS_ADDRESSES:
+            raise ValueError(cuff.name + ": ads_address must be one of " + ", ".join(hex(address) for address in ADS_ADDRESSES))
+        if cuff.offset < 0:
+            raise ValueError(cuff.name + ": offset must not be negative")
+
+
+
+### Cuff Phase Timing ###
+# A cuff only counts the ticks of its phases. Jitter and overruns belong to the shared
+# scheduler, so they are logged once per session as the scheduler.* metrics instead of as
+# zeros for every phase
+class CuffPhaseStats(PhaseStats):
+    def metrics(self) -> dict:
+        # Input: None
+        # Return: dict (ticks)
+        return {'ticks': self.ticks}
+
+
+
+### Cuff Timeline ###
+# Follows one cuff through its protocol on the shared tick. A phase starts on the first
+# tick at or after offset + spec.start and ends on the first tick past its end, so phase
+# boundaries stay on the same timeline for every cuff. Before its offset and after its
+# last phase the cuff is not stepped.
+class CuffRunner:
+    def __init__(self, config: CuffConfig, pump_control) -> None:
+        # Input: CuffConfig, PumpControl
+        # Return: None
+        self.config = config
+        self.pump_control = pump_control
+        self.phases = pump_control.protocol.phases
+        self.index = -1
+        self.spec = None
+        self.step = None
+        self.stats = None
+        self.phase_started = 0.0
+
+    @property
+    def finished(self) -> bool:
+        return self.index >= len(self.phases)
+
+    # One control step at elapsed seconds into the session
+    def tick(self, elapsed: float) -> None:
+        # Input: float (seconds since the shared scheduler started)
+        # Return: None
+        t = elapsed - self.config.offset
+        if t < 0 or self.finished:
+            return
+        # A cuff vented by its safety supervisor is not stepped again, the others go on
+        if self.pump_control.safety_trip is not None:
+            self.stop()
+            return
+        while self.spec is None or t >= self.spec.end:
+            if self.spec is not None:
+                self.end_phase()
+            self.index += 1
+            if self.finished:
+                return
+            self.begin_phase()
+        self.step(t - self.spec.start)
+        self.stats.ticks += 1
+
+    def begin_phase(self) -> None:
+        spec = self.phases[self.index]
+        pump_control = self.pump_control
+        pump_control.begin_phase(spec)
+        self.spec = spec
+        self.step = pump_control.step_for(spec.phase)
+        self.stats = CuffPhaseStats(spec.phase, spec.duration)
+        self.phase_started = pump_control.clock()
+
+    def end_phase(self) -> None:
+        self.stats.duration = self.pump_control.clock() - self.phase_started
+        self.pump_control.end_phase(self.spec, self.stats)
+        self.spec = None
+
+    # End the running phase, i.e. when the session was stopped
+    def stop(self) -> None:
+        # Input: None
+        # Return: None
+        if self.spec is not None:
+            self.end_phase()
+
+
+
+### Device Manager ###
+# Creates one backend per cuff with the hardware the backend shares between cuffs, and
+# runs them all on one scheduler. Backends that can share hardware (pi and sim) define
+# shared_hardware().
+#   DeviceManager(load_cuffs("cuffs.json"), 3, 250, 2, 5, 2, 10, backend='sim').run()
+class DeviceManager:
+    def __init__(self, cuffs: list, *settings, backend: str = None, **kwargs) -> None:
+        # Input: list of CuffConfig, the six trial settings, optional str (backend name),
+        #        keyword arguments for every backend (i.e. controller_factory, filter_factory, pwm_frequency)
+        # Return: None
+        check_cuffs(cuffs)
+        name = backend_name(backend)
+        backend_class = get_backend(name)
+        if not hasattr(backend_class, 'shared_hardware'):
+            raise ValueError("The " + name + " backend cannot run several cuffs")
+        # Every cuff needs its own controller and pressure filter, they keep state between ticks
+        if 'controller' in kwargs:
+            raise ValueError("Pass controller_factory instead of controller, every cuff needs its own controller")
+        if 'pressure_filter' in kwargs:
+            raise ValueError("Pass filter_factory instead of pressure_filter, every cuff needs its own filter")
+        controller_factory = kwargs.pop('controller_factory', None)
+        filter_factory = kwargs.pop('filter_factory', None)
+        options = dict(BACKENDS[name][2])
+        options.update(kwargs)
+        options.update(backend_class.shared_hardware(**options))
+        self.bus_lock = options['bus_lock']
+
+        self.runners = []
+        for config in cuffs:
+            if controller_factory is not None:
+                options['controller'] = controller_factory()
+            if filter_factory is not None:
+                options['pressure_filter'] = filter_factory()
+            pump_control = backend_class(*settings,
+                                         pins=(config.inflate_pin, config.deflate_pin, config.valve_pin),
+                                         ads_address=config.ads_address,
+                                         log_prefix=backend_class.log_prefix + config.name + "_",
+                                         metrics=Metrics({'cuff': config.name}),
+                                         **options)
+            # Later cuffs join the session clock of the first one
+            options['session_clock'] = pump_control.session_clock
+            self.runners.append(CuffRunner(config, pump_control))
+
+        first = self.runners[0].pump_control
+        self.session_clock = first.session_clock
+        self.clock = first.clock
+        self.sleep = first.sleep
+        self.control_frequency = first.control_frequency
+        self.total_duration = max(runner.config.offset + runner.pump_control.protocol.total_duration
+                                  for runner in self.runners)
+        self.desired_pressure = first.desired_pressure
+        self.metrics = Metrics()
+
+    @property
+    def names(self) -> list:
+        return [runner.config.name for runner in self.runners]
+
+    @property
+    def pump_controls(self) -> list:
+        return [runner.pump_control for runner in self.runners]
+
+    # The manager's metrics and those of every cuff, for a metrics.MetricsServer
+    def registries(self) -> list:
+        # Input: None
+        # Return: list of Metrics
+        return [self.metrics] + [pump_control.metrics for pump_control in self.pump_controls]
+
+    # Run every cuff's protocol to the end, or until keep_running() returns False.
+    # on_tick(elapsed) is called after all cuffs were stepped, i.e. to pass samples to the GUI.
+    # However the session ends, every cuff is shut off and its log closed
+    def run(self, keep_running=None, on_tick=None) -> PhaseStats:
+        # Input: optional callable (returns bool), optional callable (takes elapsed seconds)
+        # Return: PhaseStats (timing of the shared scheduler)
+        runners = self.runners
+        for runner in runners:
+            runner.pump_control.log_parameters()
+            runner.pump_control.log_event(EventKind.PARAMETER, 0, runner.config.offset, 'offset')
+
+        def tick(elapsed: float) -> None:
+            for runner in runners:
+                runner.tick(elapsed)
+            if on_tick is not None:
+                on_tick(elapsed)
+
+        # The whole session is one run of the scheduler; each cuff tracks its own phases
+        scheduler = TickScheduler(self.control_frequency, self.clock, self.sleep,
+                                  self.metrics.histogram('control_loop_period_seconds', "Time between the starts of two control steps"))
+        stats = None
+        try:
+            stats = scheduler.run_phase(Phase.IDLE, self.total_duration, tick, keep_running)
+        finally:
+            for runner in runners:
+                runner.stop()
+            self.emergency_shutoff()
+            for runner in runners:
+                if stats is not None:
+                    for name, value in stats.metrics().items():
+                        runner.pump_control.log_event(EventKind.METRIC, 0, value, 'scheduler.' + name)
+                runner.pump_control.close_log()
+        return stats
+
+    def emergency_shutoff(self) -> None:
+        # Input: None
+        # Return: None
+        for pump_control in self.pump_controls:
+            pump_control.emergency_shutoff()
+
+    # Session CSV of every cuff, by cuff name
+    def log_files(self) -> dict:
+        # Input: None
+        # Return: dict of str -> str
+        return {runner.config.name: runner.pump_control.log_file.file_name for runner in self.runners}
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run several cuffs from one process")
+    parser.add_argument('cuffs', help="JSON list of cuffs, see load_cuffs")
+    parser.add_argument('--backend', choices=sorted(BACKENDS), help="defaults to $PUMP_BACKEND or pi")
+    parser.add_argument('--settings', type=float, nargs=6, default=[3, 250, 2, 5, 2, 10],
+                        metavar=('TRIALS', 'PRESSURE', 'INFLATE', 'HOLD', 'DEFLATE', 'REST'))
+    parser.add_argument('--stagger', type=float, default=None, help="start each cuff this many seconds after the previous one")
+    parser.add_argument('--speed', type=float, default=None, help="speed of the sim backend")
+    parser.add_argument('--metrics-port', type=int, default=None, help="serve live metrics on localhost at this port")
+    args = parser.parse_args()
+
+    cuffs = load_cuffs(args.cuffs)
+    if args.stagger is not None:
+        cuffs = staggered(cuffs, args.stagger)
+    options = {} if args.speed is None else {'speed': args.speed}
+    manager = DeviceManager(cuffs, *args.settings, backend=args.backend, **options)
+    if args.metrics_port is not None:
+        MetricsServer(manager.registries, args.metrics_port).start()
+    manager.run()
+    for name, file_name in manager.log_files().items():
+        print(name + ": " + file_name)
@@ -0,0 +1,165 @@
+#!/usr/bin/python3.9.6
+import csv
+import heapq
+import math
+from array import array
+from enum import IntEnum
+
+from scheduler import Phase
+
+### Session Events ###
+# Everything that happens in a session apart from pressure samples is recorded as a typed
+# event. Pressure samples go to the binary trace instead (pressure_trace.py).
+#
+#   kind     EventKind
+#   t_ns     nanoseconds since the session started, on the session clock (session_clock.py)
+#   source   what the event is about: an Actuator for ACTUATOR, a scheduler.Phase for
+#            PHASE_START, PHASE_END and phase METRIC events, otherwise 0
+#   trial    trial number, 0 based
+#   value    numeric payload, see below
+#   text     name of a PARAMETER or METRIC, text of a NOTE, otherwise ''
+#
+# Values:
+#   PARAMETER    the parameter value, text is its name
+#   ACTUATOR     duty cycle after the transition, 0 = off
+#   PHASE_START  desired phase duration in seconds
+#   PHASE_END    actual phase duration in seconds
+#   METRIC       the metric value, text is its name
+#   NOTE         optional value, i.e. the pressure when the note was made, otherwise nan
+class EventKind(IntEnum):
+    PARAMETER = 1
+    ACTUATOR = 2
+    PHASE_START = 3
+    PHASE_END = 4
+    METRIC = 5
+    NOTE = 6
+
+class Actuator(IntEnum):
+    NONE = 0
+    INFLATION_PUMP = 1
+    DEFLATION_PUMP = 2
+    VALVE = 3
+
+# Columns of the event CSV
+EVENT_FIELDS = ['t_ns', 'kind', 'source', 'trial', 'value', 'text']
+
+class Event:
+    __slots__ = ('t_ns', 'kind', 'source', 'trial', 'value', 'text')
+
+    def __init__(self, t_ns: int, kind: EventKind, source: int = 0, trial: int = 0,
+                 value: float = math.nan, text: str = '') -> None:
+        self.t_ns = t_ns
+        self.kind = kind
+        self.source = source
+        self.trial = trial
+        self.value = value
+        self.text = text
+
+    # CSV row with enum names, i.e. [12000000, 'ACTUATOR', 'INFLATION_PUMP', 0, 1.0, '']
+    def row(self) -> list:
+        # Input: None
+        # Return: list
+        if self.kind == EventKind.ACTUATOR:
+            source = Actuator(self.source).name
+        elif self.kind in (EventKind.PHASE_START, EventKind.PHASE_END) or (self.kind == EventKind.METRIC and self.source):
+            source = Phase(self.source).name
+        else:
+            source = self.source
+        return [self.t_ns, self.kind.name, source, self.trial, self.value, self.text]
+
+    def __repr__(self) -> str:
+        return "Event(" + ", ".join(repr(value) for value in self.row()) + ")"
+
+
+
+### Columnar Event Storage ###
+# One set of typed arrays per kind, so recording an event appends four numbers and a string
+# reference instead of building a row, and selecting one kind reads its columns directly
+# instead of scanning the whole session.
+class EventColumns:
+    __slots__ = ('kind', 't_ns', 'source', 'trial', 'value', 'text')
+
+    def __init__(self, kind: EventKind) -> None:
+        self.kind = kind
+        self.t_ns = array('q')
+        self.source = array('H')
+        self.trial = array('H')
+        self.value = array('d')
+        self.text = []
+
+    def __len__(self) -> int:
+        return len(self.t_ns)
+
+    def event(self, index: int) -> Event:
+        # Input: int (index)
+        # Return: Event
+        return Event(self.t_ns[index], self.kind, self.source[index], self.trial[index],
+                     self.value[index], self.text[index])
+
+    def __iter__(self):
+        for index in range(len(self.t_ns)):
+            yield self.event(index)
+
+class EventLog:
+    def __init__(self, clock_ns, listener=None) -> None:
+        # Input: callable (monotonic nanoseconds), optional callable (receives every Event)
+        # Return: None
+        self.clock_ns = clock_ns
+        self.listener = listener
+        self.trial = 0
+        self.__columns = {kind: EventColumns(kind) for kind in EventKind}
+
+    def record(self, kind: EventKind, source: int = 0, value: float = math.nan, text: str = '') -> None:
+        # Input: EventKind, int (Actuator or Phase), float (payload), str (name or note)
+        # Return: None
+        t_ns = self.clock_ns()
+        columns = self.__columns[kind]
+        columns.t_ns.append(t_ns)
+        columns.source.append(source)
+        columns.trial.append(self.trial)
+        columns.value.append(value)
+        columns.text.append(text)
+        if self.listener is not None:
+            self.listener(Event(t_ns, kind, source, self.trial, value, text))
+
+    ### Queries ###
+    # Columns of one kind. The arrays are the log's own storage, not copies
+    def columns(self, kind: EventKind) -> EventColumns:
+        # Input: EventKind
+        # Return: EventColumns
+        return self.__columns[kind]
+
+    def count(self, kind: EventKind = None) -> int:
+        # Input: optional EventKind
+        # Return: int
+        if kind is not None:
+            return len(self.__columns[kind])
+        return sum(len(columns) for columns in self.__columns.values())
+
+    # Events of the given kinds (default all) in time order
+    def events(self, *kinds: EventKind):
+        # Input: EventKind...
+        # Yields: Event
+        kinds = kinds or tuple(EventKind)
+        yield from heapq.merge(*(iter(self.__columns[kind]) for kind in kinds), key=lambda event: event.t_ns)
+
+    # Parameter or metric values by name, i.e. values()['pressure']. A name recorded more than once keeps its last value
+    def values(self, kind: EventKind = EventKind.PARAMETER) -> dict:
+        # Input: EventKind (PARAMETER or METRIC)
+        # Return: dict of str -> float
+        columns = self.__columns[kind]
+        return dict(zip(columns.text, columns.value))
+
+    # Export events as CSV. With the session clock each row also gets its wall clock time;
+    # this is the only place event times are formatted
+    def write_csv(self, file_name: str, *kinds: EventKind, session_clock=None) -> None:
+        # Input: str (CSV file name), EventKind... (default all), optional SessionClock
+        # Return: None
+        with open(file_name, 'w', newline='') as file:
+            writer = csv.writer(file)
+            if session_clock is None:
+                writer.writerow(EVENT_FIELDS)
+                writer.writerows(event.row() for event in self.events(*kinds))
+            else:
+                writer.writerow(['wall_time'] + EVENT_FIELDS)
+                writer.writerows([session_clock.format(event.t_ns)] + event.row() for event in self.events(*kinds))
@@ -0,0 +1,217 @@
+#!/usr/bin/python3.9.6
+import bisect
+import math
+from array import array
+
+from sampling import PressureSample, pressure_to_voltage
+
+### Pressure Filters ###
+# Streaming filters between the ADC and the controller. A filter takes every new sample
+# and returns the pressure estimate the controller acts on, so single noisy conversions
+# do not toggle the pumps near the setpoint.
+#   update(pressure, timestamp)  new raw reading, returns the filtered pressure in mmHg
+#   rate                         pressure slope in mmHg/s, finite differences unless the
+#                                filter estimates it itself
+#   reset()                      forget all state, i.e. at the start of a session
+#
+# Every filter keeps a fixed amount of state allocated up front, and update() does a fixed
+# amount of work per sample (the median of a small window sorts at most `size` values).
+# Filters add lag: a moving average or median of n samples lags by about n / 2 ticks and
+# an EMA by its time constant. The alpha-beta filter follows ramps without lag once its
+# rate estimate has settled.
+# Filtering does not remove the op-amp bias, that is a calibration offset.
+
+class PressureFilter:
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self.value = math.nan
+        self.rate = 0.0
+        self.timestamp = None
+
+    def update(self, pressure: float, timestamp: float) -> float:
+        # Input: float (mmHg), float (seconds)
+        # Return: float (filtered mmHg)
+        raise NotImplementedError
+
+    # Rate as the slope between the previous and the new filtered value
+    def track_rate(self, value: float, timestamp: float) -> float:
+        # Input: float (filtered mmHg), float (seconds)
+        # Return: float (filtered mmHg)
+        if self.timestamp is not None and timestamp > self.timestamp:
+            self.rate = (value - self.value) / (timestamp - self.timestamp)
+        self.value = value
+        self.timestamp = timestamp
+        return value
+
+    # The sample the controller sees: raw timestamp, filtered pressure
+    def filter_sample(self, sample: PressureSample) -> PressureSample:
+        # Input: PressureSample (raw)
+        # Return: PressureSample (filtered, voltage converted back from the filtered pressure)
+        pressure = self.update(sample.pressure, sample.timestamp)
+        return PressureSample(sample.timestamp, pressure_to_voltage(pressure), pressure)
+
+
+
+### No Filter ###
+# The raw reading, as without a filter, with the rate by finite differences
+class RawFilter(PressureFilter):
+    def update(self, pressure: float, timestamp: float) -> float:
+        return self.track_rate(pressure, timestamp)
+
+
+
+### Moving Average ###
+# Mean of the last `size` readings, from a running sum over a ring of readings. The sum is
+# recomputed once per pass over the ring so rounding errors cannot build up
+class MovingAverage(PressureFilter):
+    def __init__(self, size: int = 8) -> None:
+        # Input: int (readings averaged)
+        # Return: None
+        if size < 1:
+            raise ValueError("size must be at least 1")
+        self.size = size
+        self.window = array('d', bytes(8 * size))
+        super().__init__()
+
+    def reset(self) -> None:
+        super().reset()
+        self.count = 0
+        self.total = 0.0
+
+    def update(self, pressure: float, timestamp: float) -> float:
+        # Input: float (mmHg), float (seconds)
+        # Return: float (filtered mmHg)
+        size = self.size
+        index = self.count % size
+        if self.count >= size:
+            self.total -= self.window[index]
+        self.window[index] = pressure
+        self.total += pressure
+        self.count += 1
+        if index == size - 1:
+            self.total = sum(self.window)
+        return self.track_rate(self.total / min(self.count, size), timestamp)
+
+
+
+### Exponential Moving Average ###
+# First order low-pass with a time constant in seconds. The weight of each reading follows
+# the time since the previous one, so the response does not change with the sample rate
+class ExponentialAverage(PressureFilter):
+    def __init__(self, time_constant: float = 0.05) -> None:
+        # Input: float (seconds)
+        # Return: None
+        if time_constant <= 0:
+            raise ValueError("time_constant must be positive")
+        self.time_constant = time_constant
+        super().__init__()
+
+    def update(self, pressure: float, timestamp: float) -> float:
+        # Input: float (mmHg), float (seconds)
+        # Return: float (filtered mmHg)
+        if self.timestamp is None:
+            return self.track_rate(pressure, timestamp)
+        alpha = 1.0 - math.exp(-max(timestamp - self.timestamp, 0.0) / self.time_constant)
+        return self.track_rate(self.value + alpha * (pressure - self.value), timestamp)
+
+
+
+### Median of N ###
+# Median of the last `size` readings. Removes single-sample spikes (i.e. an I2C glitch)
+# without averaging them into the estimate. Keeps the window in arrival order and sorted
+class MedianFilter(PressureFilter):
+    def __init__(self, size: int = 5) -> None:
+        # Input: int (readings, odd sizes have a true middle)
+        # Return: None
+        if size < 1:
+            raise ValueError("size must be at least 1")
+        self.size = size
+        self.window = array('d', bytes(8 * size))
+        super().__init__()
+
+    def reset(self) -> None:
+        super().reset()
+        self.count = 0
+        self.ordered = []
+
+    def update(self, pressure: float, timestamp: float) -> float:
+        # Input: float (mmHg), float (seconds)
+        # Return: float (filtered mmHg)
+        size = self.size
+        index = self.count % size
+        ordered = self.ordered
+        if self.count >= size:
+            del ordered[bisect.bisect_left(ordered, self.window[index])]
+        self.window[index] = pressure
+        bisect.insort(ordered, pressure)
+        self.count += 1
+        middle = len(ordered) // 2
+        median = ordered[middle] if len(ordered) % 2 else (ordered[middle - 1] + ordered[middle]) / 2
+        return self.track_rate(median, timestamp)
+
+
+
+### Alpha-Beta Estimator ###
+# Tracks pressure and its rate with a constant-rate model:
+#   predict  value += rate * dt
+#   correct  residual = reading - value
+#            value += alpha * residual, rate += beta * residual / dt
+# This is the steady-state Kalman filter of that model. from_noise picks alpha and beta
+# from the sensor noise and how fast the rate can change, using the tracking index
+# (Kalata 1984). The rate estimate is much smoother than finite differences of the raw
+# readings.
+class AlphaBetaFilter(PressureFilter):
+    def __init__(self, alpha: float = 0.3, beta: float = 0.05) -> None:
+        # Input: float (0-1, weight of the residual on the value), float (0-2, on the rate)
+        # Return: None
+        if not 0 < alpha <= 1 or not 0 <= beta < 2 or beta > 4 - 2 * alpha:
+            raise ValueError("alpha must be in (0, 1] and beta in [0, 4 - 2 * alpha)")
+        self.alpha = alpha
+        self.beta = beta
+        super().__init__()
+
+    @classmethod
+    def from_noise(cls, measurement_noise: float = 1.0, rate_noise: float = 50.0, period: float = 0.01) -> "AlphaBetaFilter":
+        # Input: float (mmHg, std of a reading), float (mmHg/s^2, std of the change in slope),
+        #        float (seconds between readings)
+        # Return: AlphaBetaFilter
+        tracking = rate_noise * period * period / measurement_noise
+        r = (4 + tracking - math.sqrt(8 * tracking + tracking * tracking)) / 4
+        alpha = 1 - r * r
+        beta = 2 * (2 - alpha) - 4 * math.sqrt(1 - alpha)
+        return cls(alpha, beta)
+
+    def update(self, pressure: float, timestamp: float) -> float:
+        # Input: float (mmHg), float (seconds)
+        # Return: float (filtered mmHg)
+        if self.timestamp is None:
+            self.value = pressure
+            self.timestamp = timestamp
+            return pressure
+        dt = timestamp - self.timestamp
+        if dt <= 0:
+            return self.value
+        predicted = self.value + self.rate * dt
+        residual = pressure - predicted
+        self.value = predicted + self.alpha * residual
+        self.rate += self.beta * residual / dt
+        self.timestamp = timestamp
+        return self.value
+
+
+
+# Filters that can be chosen by name, i.e. from a protocol file or the CLI
+FILTERS = {'raw': RawFilter,
+           'moving_average': MovingAverage,
+           'ema': ExponentialAverage,
+           'median': MedianFilter,
+           'alpha_beta': AlphaBetaFilter}
+
+def make_filter(name: str = 'raw', **options) -> PressureFilter:
+    # Input: str (filter name), keyword options passed to the filter
+    # Return: PressureFilter
+    if name not in FILTERS:
+        raise ValueError("Unknown filter " + name + ", expected one of " + ", ".join(FILTERS))
+    return FILTERS[name](**options)
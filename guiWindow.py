@@ -1,19 +1,33 @@
 import tkinter as tk
 from tkinter import ttk, filedialog
-from tkinter.messagebox import askyesno
-import threading, time
-from datetime import datetime
+from tkinter.messagebox import askyesno, showerror
+import argparse, asyncio, threading, time, traceback
 
-import matplotlib.pyplot as plt
-from matplotlib.animation import FuncAnimation
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-
-#from PumpControl import PumpControl
-from PumpControlTester import PumpControlTester as PumpControl
+from live_plot import LivePlot
+from ui_bridge import UiBridge
+from backends import BACKENDS, backend_name, create_pump_control
+from device_manager import DeviceManager, load_cuffs, staggered
+from async_runtime import AsyncRuntime
+from metrics import MetricsServer
+from filters import FILTERS, make_filter
 
 class GuiWindow(tk.Tk):
-    def __init__(self):
+    def __init__(self, backend: str = None, backend_options: dict = None, cuffs: list = None, runtime: str = 'thread'):
         super().__init__()
+        # Pump control backend (pi, sim, tester...), see backends.py.
+        # It is only imported when trials are started
+        self.backend = backend_name(backend)
+        # Extra keyword arguments for the backend, i.e. trace_file for replay
+        self.backend_options = backend_options or {}
+        # With a list of device_manager.CuffConfig every cuff runs from one DeviceManager
+        # and gets its own line in the plot
+        self.cuffs = cuffs
+        # 'thread' runs trials on a trial thread. 'async' runs them as asyncio tasks on the
+        # same event loop that drives Tk, see run_async and async_runtime.py
+        self.runtime_kind = runtime
+        self.runtime = None
+        # Backend or DeviceManager of the last session started, None before the first
+        self.pump_control = None
         ### Main window ###
         self.title('Automated Blood Pressure Occlusion')
         self.geometry('800x480')
@@ -34,31 +48,25 @@ class GuiWindow(tk.Tk):
         # Which in turn allows the GUI to interrupt pump operations
         self.running = False
 
-        # Current trial variables that are updated during the cycle
-        self.pressure: list[float] = [0.0]
-        self.elapsed_time: list[float] = [0.0]
-
         # Shows status of trial program
         self.trial_status = tk.StringVar(value='Ready')
-        self.current_pressure = tk.DoubleVar(value=0.0)
+        # Newest pressure of every cuff, i.e. '120.4 / 98.2'
+        self.current_pressure = tk.StringVar(value='0.0')
         self.current_time = tk.DoubleVar(value=0.0)
 
         # Current save directory
         self.directory = tk.StringVar(value='~/Desktop')
 
-        # matplotlib objects
-        # TODO: Fix graph constraints
-        self.fig, self.axis = plt.subplots(figsize=(5,3.6), dpi=80)
-        self.fig.set_facecolor('#eeebe2')
-        self.axis.grid(color='darkgrey', alpha=0.65, linestyle='-')
-        self.axis.set_facecolor('#eeebe2')
-        self.axis.margins(0)
-        self.axis.set_xlabel("Number of Samples")
-        self.axis.set_ylabel("Pressure (mmHg)")
-        #self.animation = FuncAnimation(self.fig, self.animate, interval=400, cache_frame_data=False)
-        plt.subplots_adjust(left=0.15, bottom=0.15, right=0.99, top=0.99)
-        self.canvas = FigureCanvasTkAgg(self.fig, master=self.output_frame)
-        self.canvas.get_tk_widget().grid(column=0, row=5, **options)
+        # Live pressure plot. Redraws itself at a fixed frame rate from the Tk mainloop
+        self.live_plot = LivePlot(self.output_frame, series=tuple(cuff.name for cuff in cuffs) if cuffs else ('Current Pressure',))
+        self.live_plot.widget.grid(column=0, row=5, **options)
+        self.live_plot.start()
+
+        # The trial thread never touches widgets. It pushes samples and events to the bridge,
+        # which is drained on the Tk thread every bridge_interval ms
+        self.bridge = UiBridge()
+        self.bridge_interval = 50
+        self.after(self.bridge_interval, self.poll_bridge)
 
         ### Settings Labels ###
         #label_settings = ttk.Label(self.settings_frame, text='Trial Parameters', bg='grey', font=('Arial', 16, 'bold'))
@@ -135,7 +143,7 @@ class GuiWindow(tk.Tk):
         label_current_time.configure(background='#eeebe2')
         label_current_time.place(relx=0.55, rely=0.28, relheight=0.05, relwidth=0.35, bordermode='ignore')
 
-        label_current_time_state = ttk.Label(self, text= str(self.trial_status.get()))
+        label_current_time_state = ttk.Label(self, textvariable = self.trial_status)
         label_current_time_state.configure(background='#eeebe2')
         label_current_time_state.place(relx=0.7, rely=0.28, relheight=0.05, relwidth=0.35, bordermode='ignore')
         ### Buttons ###
@@ -144,7 +152,7 @@ class GuiWindow(tk.Tk):
         # Number of Trials
         self.desired_number_of_trials = tk.StringVar(value='3')
         trials_spin_button = ttk.Spinbox(self,
-                                            from_ = 0, to = 30,
+                                            from_ = 1, to = 30,
                                             textvariable = self.desired_number_of_trials,
                                             state='readonly',
                                             width=7,
@@ -270,117 +278,238 @@ class GuiWindow(tk.Tk):
     def confirm(self):
         answer = askyesno(title = "Start trials?", message = f"""Number of trials: {self.desired_number_of_trials.get()}\nTarget pressure: {self.desired_pressure.get()}\nInflate time: {self.desired_inflate_time.get()}\nHold time: {self.desired_hold_time.get()}\nDeflate time: {self.desired_deflate_time.get()}\nReset time: {self.desired_time_between_trials.get()}\nStart trials with these settings?\n""")
         if answer:
-            self.stop_button['state'] = 'enabled'
-            self.pump_control = PumpControl(float(self.desired_number_of_trials.get()),
-                                                    float(self.desired_pressure.get()),
-                                                    float(self.desired_inflate_time.get()),
-                                                    float(self.desired_hold_time.get()),
-                                                    float(self.desired_deflate_time.get()),
-                                                    float(self.desired_time_between_trials.get()))
+            # Building the backend opens the hardware and, on the Pi, calibrates the sensor.
+            # If that fails the session never starts, and the buttons are left for a retry
+            try:
+                settings = (float(self.desired_number_of_trials.get()),
+                            float(self.desired_pressure.get()),
+                            float(self.desired_inflate_time.get()),
+                            float(self.desired_hold_time.get()),
+                            float(self.desired_deflate_time.get()),
+                            float(self.desired_time_between_trials.get()))
+                if self.cuffs:
+                    self.pump_control = DeviceManager(self.cuffs, *settings, backend=self.backend, **self.backend_options)
+                    total_duration = self.pump_control.total_duration
+                else:
+                    self.pump_control = create_pump_control(self.backend, *settings, **self.backend_options)
+                    total_duration = self.pump_control.protocol.total_duration
+            except Exception as error:
+                traceback.print_exc()
+                showerror(title = "Cannot start trials", message = str(error))
+                self.trial_status.set('ERROR')
+                self.start_button['state'] = 'enabled'
+                self.stop_button['state'] = 'disabled'
+                return
             # Disable start button when trials have successfully begun
             self.start_button['state'] = 'disabled'
-            self.trials = threading.Thread(target = self.start_trials)
+            self.stop_button['state'] = 'enabled'
+            PC = self.pump_control
+            self.live_plot.reset(total_duration, PC.desired_pressure * 1.2)
+            if self.cuffs:
+                self.trials = threading.Thread(target = self.start_cuffs)
+            else:
+                if self.runtime_kind == 'async':
+                    # confirm() runs inside run_async, so the event loop is the running one
+                    asyncio.get_running_loop().create_task(self.run_runtime())
+                    return
+                self.trials = threading.Thread(target = self.start_trials)
             self.trials.start()
+    # Metrics of the running (or last) session, for a metrics.MetricsServer
+    def metrics_registries(self) -> list:
+        # Input: None
+        # Return: list of Metrics
+        PC = self.pump_control
+        if PC is None:
+            return []
+        if isinstance(PC, DeviceManager):
+            return PC.registries()
+        return [PC.metrics]
+
     # Directory chooser for CSV file output
     # Will not work without a mouse. See line 72
     #def choose_directory(self):
     #    self.directory.set(filedialog.askdirectory(initialdir = self.directory.get(), mustexist=True))
 
-    def show_status(self, pressure:float, start_time:float):
-            self.pressure.append(pressure)
-            self.current_pressure.set(pressure)
-            self.elapsed_time.append(time.perf_counter() - start_time)
-            self.current_time.set(self.elapsed_time[-1])
-            # Plotting
-            self.axis.clear()
-            self.axis.set_xlabel("Number of Samples")
-            self.axis.set_ylabel("Pressure (mmHg)")
-            self.axis.plot(self.pressure, label = 'Current Pressure')
-            self.axis.legend(loc=0)
-            self.canvas = FigureCanvasTkAgg(self.fig, master=self.output_frame)
-            self.canvas.get_tk_widget().grid(column=0, row=5, padx= 5, pady= 5, sticky='W')
+    # Apply everything the trial thread pushed since the last poll as one UI update
+    def poll_bridge(self):
+        samples, events = self.bridge.drain()
+        if samples:
+            self.show_status(samples)
+        for name, value in events:
+            if name == 'status':
+                self.trial_status.set(value)
+            elif name == 'finished':
+                self.trial_status.set(value)
+                # Enable start button when trials have completed
+                self.start_button['state'] = 'enabled'
+                self.stop_button['state'] = 'disabled'
+        self.after(self.bridge_interval, self.poll_bridge)
+
+    def show_status(self, samples: list):
+            # Labels only show the newest sample of each series, the plot buffers all of them
+            latest = {}
+            for elapsed_time, pressure, series in samples:
+                latest[series] = pressure
+            self.current_pressure.set(' / '.join(format(latest[series], '.1f') for series in sorted(latest)))
+            self.current_time.set(samples[-1][0])
+            self.live_plot.extend(samples)
 
     def stop_trials(self):
         self.running = False
+        # The async runtime is cancelled at once instead of at the next check of self.running
+        if self.runtime is not None:
+            self.runtime.stop()
         # START/STOP buttons disabled when cancelling trials
         self.start_button['state'] = 'disabled'
         self.stop_button['state'] = 'disabled'
 
 
+    # Runs on the trial thread. Only talks to the GUI through self.bridge
     def start_trials(self):
         # Set running marker to True
         self.running = True
         PC = self.pump_control
-        ## Total trial time equation.
-        # Total = (# of Trials)*(Inflate time + Hold time + Deflate time) + ((Rest time )*(# of Trials))
-        total_trial_time = PC.desired_number_of_trials * (PC.desired_inflate_time + PC.desired_hold_time + PC.desired_deflate_time) + (PC.desired_time_between_trials * (PC.desired_number_of_trials - 1))
-        self.pressure, self.elapsed_time = [0.0], [0.0]
+        bridge = self.bridge
+        start_time = PC.clock()
+        protocol = PC.protocol
+        shown = [None]
+
+        # Every sample goes to the GUI, and the status changes with the phase
+        def on_sample(sample) -> None:
+            bridge.push_sample(sample.timestamp - start_time, sample.pressure)
+            spec = PC.phase_spec
+            if spec is not shown[0]:
+                shown[0] = spec
+                bridge.push_event('status', 'Trial ' + str(spec.trial + 1) + '/' + str(protocol.number_of_trials) + ': ' + spec.phase.name.title())
+
+        ## Runs the protocol the same way as a headless session. The scheduler sleeps between
+        ## ticks and stops a phase as soon as STOP clears self.running
+        bridge.push_event('status', 'Running Trials...')
+        outcome = PC.run_trials(lambda: self.running, on_sample)
+
+        if outcome == 'TRIPPED':
+            outcome = 'TRIPPED: ' + PC.safety_trip.reason
+        bridge.push_event('finished', outcome)
+        self.running = False
 
+    # Runs the trials as asyncio tasks, see async_runtime.py. Samples and status still go
+    # through the bridge, so the display code is the same as for the trial thread
+    async def run_runtime(self):
+        self.running = True
+        PC = self.pump_control
+        bridge = self.bridge
+        start_time = PC.clock()
+        protocol = PC.protocol
+        shown = [None]
+
+        def on_sample(sample) -> None:
+            bridge.push_sample(sample.timestamp - start_time, sample.pressure)
+
+        def on_update(runtime: AsyncRuntime) -> None:
+            spec = runtime.spec
+            if spec is not None and spec is not shown[0]:
+                shown[0] = spec
+                bridge.push_event('status', 'Trial ' + str(spec.trial + 1) + '/' + str(protocol.number_of_trials) + ': ' + spec.phase.name.title())
+
+        self.runtime = AsyncRuntime(PC, on_sample, on_update)
+        bridge.push_event('status', 'Running Trials...')
         try:
-            self.trial_status.set('Running Trials...')
-            start_time = time.perf_counter()
-            while self.running and (time.perf_counter() - start_time) < total_trial_time:
-                ## Inflation cycle. Starting time for inflation is recorded, and a function is called to compare current pressure
-                ## to desired pressure at the current time. While loop keeps this running for as long as desired inflate time
-                ## has not been reached
-                PC.log_activity([datetime.now().strftime("%H:%M:%S"), "Raise Pressure Start", PC.current_pressure])
-                inflate_start_time = time.perf_counter()
-                while self.running and ((time.perf_counter() - PC.desired_inflate_time - inflate_start_time) < 0):
-                    PC.raise_pressure(PC.inflation_line_pressure(PC.desired_pressure, (time.perf_counter() - inflate_start_time), PC.desired_inflate_time))
-                    self.show_status(PC.current_pressure, start_time)
-
-                PC.log_activity([datetime.now().strftime("%H:%M:%S"), "Actual inflate time", str(time.perf_counter() - inflate_start_time)])
-                self.show_status(PC.current_pressure, start_time)
-
-                ## While loop essentially waits the program for the hold time requested
-                hold_start_time = time.perf_counter()
-                while self.running and ((time.perf_counter() - hold_start_time) < PC.desired_hold_time):
-                    PC.get_pressure()
-                    self.show_status(PC.current_pressure, start_time)
-
-                PC.log_activity([datetime.now().strftime("%H:%M:%S"), "Actual hold time", str(time.perf_counter() - hold_start_time)])
-                self.show_status(PC.current_pressure, start_time)
-
-                ## Deflation cycle. Essentially the same as inflation cycle
-                deflate_start_time = time.perf_counter()
-                PC.log_activity([datetime.now().strftime("%H:%M:%S"), "Lower Pressure Start", PC.current_pressure])
-                while self.running and ((time.perf_counter() - PC.desired_deflate_time - deflate_start_time) < 0):
-                    PC.lower_pressure(PC.deflation_line_pressure(PC.desired_pressure, deflate_start_time, PC.desired_deflate_time))
-                    self.show_status(PC.current_pressure, start_time)
-
-                PC.log_activity([datetime.now().strftime("%H:%M:%S"), "Actual deflate time", str(time.perf_counter() - deflate_start_time)])
-                self.show_status(PC.current_pressure, start_time)
-
-                rest_start_time = time.perf_counter()
-                while self.running and ((time.perf_counter() - rest_start_time) < PC.desired_time_between_trials):
-                    self.show_status(PC.current_pressure, start_time)
-        except:
-            PC.emergency_shutoff
-            self.trial_status.set("ERROR")
-
-        PC.log_activity([datetime.now().strftime("%H:%M:%S"), 'All trials completed'])
-        PC.emergency_shutoff
-        log_file = PC.FileHandler()
-        log_file.write_session(PC.activity_log)
-
-        # Enable start button when trials have successfully completed
-        self.start_button['state'] = 'enabled'
-        self.stop_button['state'] = 'disabled'
+            outcome = await self.runtime.run()
+        except Exception:
+            traceback.print_exc()
+            outcome = 'ERROR'
+        self.runtime = None
+        bridge.push_event('finished', outcome)
+        self.running = False
 
+    # Drives Tk from an asyncio event loop instead of mainloop(), so the async runtime and
+    # the window share one thread. Tk is updated every interval seconds; the time this
+    # takes shows up in the runtime's loop lag metrics
+    async def run_async(self, interval: float = 1 / 60):
+        closed = asyncio.Event()
+        self.protocol('WM_DELETE_WINDOW', closed.set)
+        while not closed.is_set():
+            self.update()
+            await asyncio.sleep(interval)
+        if self.runtime is not None:
+            self.runtime.stop()
+            while self.runtime is not None:
+                await asyncio.sleep(interval)
+        self.destroy()
+
+    # Runs every cuff of the DeviceManager on the trial thread. The status shows the
+    # phase of each cuff, and every cuff's samples go to its own line of the plot
+    def start_cuffs(self):
+        self.running = True
+        manager = self.pump_control
+        bridge = self.bridge
+        runners = manager.runners
+        error = False
+        status = [None]
+
+        def on_tick(elapsed: float) -> None:
+            for series, runner in enumerate(runners):
+                bridge.push_sample(elapsed, runner.pump_control.last_sample.pressure, series)
+            phases = ', '.join(runner.config.name + ': ' + (runner.spec.phase.name.title() if runner.spec is not None else '-')
+                               for runner in runners)
+            if phases != status[0]:
+                status[0] = phases
+                bridge.push_event('status', phases)
 
-        if self.running:
-            self.trial_status.set('COMPLETE')
-            self.running = False
+        try:
+            bridge.push_event('status', 'Running Trials...')
+            manager.run(lambda: self.running, on_tick)
+        except Exception:
+            traceback.print_exc()
+            error = True
+
+        tripped = [name for name, pump_control in zip(manager.names, manager.pump_controls)
+                   if pump_control.safety_trip is not None]
+        if error:
+            bridge.push_event('finished', 'ERROR')
+        elif tripped:
+            bridge.push_event('finished', 'TRIPPED: ' + ', '.join(tripped))
+        elif self.running:
+            bridge.push_event('finished', 'COMPLETE')
         else:
-            self.trial_status.set('HALTED')
-
-
-# Initialize main window
-root_window = GuiWindow()
+            bridge.push_event('finished', 'HALTED')
+        self.running = False
 
-# Start trial by pressing start button (Set to RETURN key during development)
-# TODO: Tie stop button to self.running, and turn it to False when pressed
-#root_window.bind_all('<space>', lambda event: root_window.confirm())
 
 if __name__ == '__main__':
-    root_window.mainloop()
+    parser = argparse.ArgumentParser(description='Automated Blood Pressure Occlusion')
+    parser.add_argument('--backend', choices=sorted(BACKENDS),
+                        help='pump control backend, defaults to $PUMP_BACKEND or pi')
+    parser.add_argument('--trace', help='recorded pressure trace for the replay backend')
+    parser.add_argument('--cuffs', help='JSON list of cuffs to run together, see device_manager.py')
+    parser.add_argument('--stagger', type=float, default=None, help='start each cuff this many seconds after the previous one')
+    parser.add_argument('--runtime', choices=('thread', 'async'), default='thread',
+                        help='run trials on a thread or as asyncio tasks sharing the event loop with Tk')
+    parser.add_argument('--metrics-port', type=int, default=None, help='serve live metrics on localhost at this port')
+    parser.add_argument('--filter', choices=sorted(FILTERS), default=None, help='pressure filter, see filters.py')
+    args = parser.parse_args()
+    backend_options = {}
+    if args.trace is not None:
+        backend_options['trace_file'] = args.trace
+    cuffs = load_cuffs(args.cuffs) if args.cuffs else None
+    if cuffs and args.stagger is not None:
+        cuffs = staggered(cuffs, args.stagger)
+    # Every session resets its filter; several cuffs need one filter each
+    if args.filter is not None and cuffs:
+        backend_options['filter_factory'] = lambda: make_filter(args.filter)
+    elif args.filter is not None:
+        backend_options['pressure_filter'] = make_filter(args.filter)
+
+    # Initialize main window
+    root_window = GuiWindow(args.backend, backend_options, cuffs, args.runtime)
+    if args.metrics_port is not None:
+        MetricsServer(root_window.metrics_registries, args.metrics_port).start()
+
+    # Start trial by pressing start button (Set to RETURN key during development)
+    # TODO: Tie stop button to self.running, and turn it to False when pressed
+    #root_window.bind_all('<space>', lambda event: root_window.confirm())
+
+    if args.runtime == 'async':
+        asyncio.run(root_window.run_async())
+    else:
+        root_window.mainloop()
@@ -27,4 +27,6 @@ python3 -m pip install board
 python3 -m pip install adafruit-blinka
 
 # Install python module ads1x15 for ADC
-python3 -m pip install adafruit-circuitpython-ads1x15
\ No newline at end of file
+python3 -m pip install adafruit-circuitpython-ads1x15
+# Install python module numpy for reading pressure traces and session analysis
+python3 -m pip install numpy
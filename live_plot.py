@@ -0,0 +1,196 @@
+#!/usr/bin/python3.9.6
+from array import array
+from collections import deque
+
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+
+### Live Pressure Plot ###
+# One canvas and one Line2D per series are created up front. Samples are only appended to
+# buffers; the lines are redrawn at a fixed frame rate on the Tk mainloop by restoring a cached
+# background and blitting the line, so redraw cost does not grow with the session length
+# or the sample rate.
+#
+# Two views, toggled by clicking the plot:
+#   window  - the last `window` seconds of raw samples, x axis in seconds before now
+#   session - the whole session reduced to `bins` min/max pairs, x axis in seconds since start
+# Axis limits are fixed in both views so the cached background stays valid between frames.
+# Every series, i.e. every cuff of a DeviceManager, has its own line and buffers.
+# All methods must be called from the Tk thread, see ui_bridge.py.
+class LivePlot:
+    def __init__(self, master, window: float = 30.0, frame_rate: float = 20.0, bins: int = 400,
+                 figsize: tuple = (5, 3.6), dpi: int = 80, background: str = '#eeebe2',
+                 series: tuple = ('Current Pressure',)) -> None:
+        # Input: tk widget (parent), float (window seconds), float (frames per second),
+        #        int (min/max bins for the session view), figure size, dpi, str (background colour),
+        #        tuple of str (line labels)
+        # Return: None
+        self.window = window
+        self.frame_interval = int(1000 / frame_rate)
+        self.bins = bins
+        self.full_session = False
+
+        # Samples inside the sliding window, per series
+        self.times = []
+        self.pressures = []
+        self.latest_time = 0.0
+
+        # Min/max of every bin of the session view, per series, updated per sample
+        self.session_duration = 1.0
+        self.bin_width = self.session_duration / bins
+        self.bin_min = []
+        self.bin_max = []
+        self.y_max = 300.0
+
+        self.__dirty = False
+        self.__background = None
+
+        # matplotlib objects
+        self.fig = Figure(figsize=figsize, dpi=dpi)
+        self.fig.set_facecolor(background)
+        self.fig.subplots_adjust(left=0.15, bottom=0.15, right=0.99, top=0.99)
+        self.axis = self.fig.add_subplot()
+        self.axis.grid(color='darkgrey', alpha=0.65, linestyle='-')
+        self.axis.set_facecolor(background)
+        self.axis.margins(0)
+        self.axis.set_ylabel("Pressure (mmHg)")
+        self.lines = []
+        self.set_series(series)
+        self.set_limits()
+
+        self.canvas = FigureCanvasTkAgg(self.fig, master=master)
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+        self.canvas.mpl_connect('button_press_event', self.toggle_view)
+        self.widget = self.canvas.get_tk_widget()
+
+    # Start redrawing at the frame rate
+    def start(self) -> None:
+        self.canvas.draw()
+        self.widget.after(self.frame_interval, self.animate)
+
+    # One line per label. Clears all samples
+    def set_series(self, series: tuple) -> None:
+        # Input: tuple of str (line labels)
+        # Return: None
+        for line in self.lines:
+            line.remove()
+        self.lines = [self.axis.plot([], [], animated=True, label=label)[0] for label in series]
+        self.axis.legend(handles=self.lines, loc=2)
+        self.clear()
+
+    def clear(self) -> None:
+        count = len(self.lines)
+        self.times = [deque() for _ in range(count)]
+        self.pressures = [deque() for _ in range(count)]
+        self.bin_min = [array('d') for _ in range(count)]
+        self.bin_max = [array('d') for _ in range(count)]
+        self.latest_time = 0.0
+
+    # Clear all samples and size the axes for a new session. series replaces the lines
+    def reset(self, session_duration: float, y_max: float, series: tuple = None) -> None:
+        # Input: float (expected session length in seconds), float (top of the y axis in mmHg),
+        #        optional tuple of str (line labels)
+        # Return: None
+        if series is not None and tuple(series) != tuple(line.get_label() for line in self.lines):
+            self.set_series(series)
+        self.clear()
+        self.session_duration = max(session_duration, 1.0)
+        self.bin_width = self.session_duration / self.bins
+        self.y_max = y_max
+        self.__dirty = True
+        self.set_limits()
+        self.canvas.draw()
+
+    # Add a sample. Cheap enough to call for every sample
+    def append(self, elapsed: float, pressure: float, series: int = 0) -> None:
+        # Input: float (seconds since session start), float (mmHg), int (series index)
+        # Return: None
+        times = self.times[series]
+        pressures = self.pressures[series]
+        times.append(elapsed)
+        pressures.append(pressure)
+        if elapsed > self.latest_time:
+            self.latest_time = elapsed
+        cutoff = self.latest_time - self.window
+        while times[0] < cutoff:
+            times.popleft()
+            pressures.popleft()
+
+        bin_min = self.bin_min[series]
+        bin_max = self.bin_max[series]
+        index = int(elapsed / self.bin_width)
+        while len(bin_min) <= index:
+            bin_min.append(pressure)
+            bin_max.append(pressure)
+        if pressure < bin_min[index]:
+            bin_min[index] = pressure
+        elif pressure > bin_max[index]:
+            bin_max[index] = pressure
+        self.__dirty = True
+
+    # Add a batch of (elapsed, pressure, series) samples
+    def extend(self, samples: list) -> None:
+        # Input: list of (float, float, int)
+        # Return: None
+        for elapsed, pressure, series in samples:
+            self.append(elapsed, pressure, series)
+
+    def set_limits(self) -> None:
+        if self.full_session:
+            self.axis.set_xlim(0, self.session_duration)
+            self.axis.set_xlabel("Session Time (s)")
+        else:
+            self.axis.set_xlim(-self.window, 0)
+            self.axis.set_xlabel("Time (s)")
+        self.axis.set_ylim(0, self.y_max)
+
+    def toggle_view(self, event=None) -> None:
+        self.full_session = not self.full_session
+        self.set_limits()
+        self.__dirty = True
+        self.canvas.draw()
+
+    # Cache everything except the animated lines after a full draw
+    def on_draw(self, event=None) -> None:
+        self.__background = self.canvas.copy_from_bbox(self.axis.bbox)
+        for line in self.lines:
+            self.axis.draw_artist(line)
+
+    # Line data of a series for the current view
+    def line_data(self, series: int = 0) -> tuple:
+        # Input: int (series index)
+        # Return: tuple (list of x, list of y)
+        if not self.full_session:
+            now = self.latest_time
+            return [t - now for t in self.times[series]], list(self.pressures[series])
+        # Each bin is drawn as a vertical segment from its minimum to its maximum
+        bin_min = self.bin_min[series]
+        bin_max = self.bin_max[series]
+        x, y = [], []
+        for index in range(len(bin_min)):
+            center = (index + 0.5) * self.bin_width
+            x += (center, center)
+            y += (bin_min[index], bin_max[index])
+        return x, y
+
+    # Redraw the lines if new samples arrived since the last frame
+    def redraw(self) -> None:
+        if not self.__dirty or self.__background is None:
+            return
+        self.__dirty = False
+        data = [self.line_data(series) for series in range(len(self.lines))]
+        # Rescale once if the pressure leaves the plot, this needs a full draw
+        y_max = max((max(y) for x, y in data if y), default=0.0)
+        if y_max > self.y_max:
+            self.y_max = y_max * 1.1
+            self.set_limits()
+            self.canvas.draw()
+        self.canvas.restore_region(self.__background)
+        for line, (x, y) in zip(self.lines, data):
+            line.set_data(x, y)
+            self.axis.draw_artist(line)
+        self.canvas.blit(self.axis.bbox)
+
+    def animate(self) -> None:
+        self.redraw()
+        self.widget.after(self.frame_interval, self.animate)
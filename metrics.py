@@ -0,0 +1,307 @@
+#!/usr/bin/python3.9.6
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+### Hot Path Metrics ###
+# Counters and histograms kept by the control stack while a session runs, so a slow
+# inflation can be traced to the pumps, the I2C bus or the Python loop:
+#
+#   control_loop_period_seconds   time between the starts of two control steps
+#   adc_conversion_seconds        one ADC read, from holding the bus lock to the result
+#   gpio_write_seconds            one pin or PWM duty write
+#   log_queue_depth               rows waiting for the session CSV, seen by its writer thread
+#   adc_missed_samples_total      conversions the acquisition thread skipped to catch up
+#   log_rows_dropped_total        session CSV rows dropped because the queue was full
+#
+# Recording costs one integer bit_length and one list increment (well under a microsecond),
+# against a 10 ms control tick. Each histogram has a single writer thread; a scrape reads
+# the counts without a lock and at worst misses a sample that is being recorded.
+#
+# MetricsServer serves every registry in the Prometheus text format on localhost:
+#   python3 async_runtime.py --backend sim --metrics-port 9105
+#   curl localhost:9105/metrics
+
+# Nanoseconds of the monotonic clock used to time hot path calls. Timings are wall time,
+# also on the simulated backends, since they measure what a call really costs
+clock_ns = time.perf_counter_ns
+
+### Histogram ###
+# Log-linear buckets over nanoseconds, like an HDR histogram: every power of two is split
+# into SUB_BUCKETS equal buckets, so a recorded value is off by at most 1/SUB_BUCKETS
+# (12.5%) from 1 ns to MAX_EXPONENT (about 18 minutes) with a fixed 300 buckets.
+# Buckets include their upper bound, like Prometheus' le: 0 has its own bucket, and a
+# power of two is the highest value of the bucket it falls in.
+SUB_BITS = 3
+SUB_BUCKETS = 1 << SUB_BITS
+MAX_EXPONENT = 40
+
+# Bucket bounds published to Prometheus, as powers of two: from about 1 us to 17 s for
+# histograms of nanoseconds, from 1 to 16384 for counts (unit 1, i.e. log_queue_depth).
+# Every power of two is a bucket edge, so their cumulative counts are exact
+EXPORT_EXPONENTS = range(10, 35)
+COUNT_EXPORT_EXPONENTS = range(0, 15)
+
+def bucket_index(value: int) -> int:
+    # Input: int (nanoseconds, at least 0)
+    # Return: int (bucket)
+    if value == 0:
+        return 0
+    value -= 1
+    shift = value.bit_length() - SUB_BITS - 1
+    if shift <= 0:
+        return value + 1
+    return (shift << SUB_BITS) + (value >> shift) + 1
+
+def bucket_bounds(index: int) -> tuple:
+    # Input: int (bucket)
+    # Return: tuple (lowest value, value past the highest) in nanoseconds
+    if index < 2 * SUB_BUCKETS + 1:
+        return index, index + 1
+    index -= 1
+    shift = (index >> SUB_BITS) - 1
+    mantissa = (index & (SUB_BUCKETS - 1)) + SUB_BUCKETS
+    return (mantissa << shift) + 1, ((mantissa + 1) << shift) + 1
+
+class Histogram:
+    # Values above the range are counted in the last bucket
+    SIZE = bucket_index((1 << MAX_EXPONENT) - 1) + 1
+
+    def __init__(self, name: str, help: str = '', unit: float = 1e-9, export_exponents: range = None) -> None:
+        # Input: str (metric name), str (description), float (exported unit per recorded
+        #        unit, 1e-9 for nanoseconds to seconds, 1 for plain counts),
+        #        optional range (powers of two exported as bucket edges, default by unit)
+        # Return: None
+        self.name = name
+        self.help = help
+        self.unit = unit
+        if export_exponents is None:
+            export_exponents = COUNT_EXPORT_EXPONENTS if unit == 1 else EXPORT_EXPONENTS
+        self.export_exponents = export_exponents
+        self.counts = [0] * self.SIZE
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value: int) -> None:
+        # Input: int (nanoseconds, or a count when unit is 1)
+        # Return: None
+        if value < 0:
+            value = 0
+        index = bucket_index(value)
+        if index >= self.SIZE:
+            index = self.SIZE - 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    # Value below which fraction of the recorded values fall, as the middle of its bucket
+    def percentile(self, fraction: float) -> float:
+        # Input: float (0-1)
+        # Return: float (exported unit, 0 when empty)
+        if self.count == 0:
+            return 0.0
+        rank = max(int(fraction * self.count + 0.5), 1)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                low, high = bucket_bounds(index)
+                return min((low + high - 1) / 2, self.max) * self.unit
+        return self.max * self.unit
+
+    # Cumulative counts at the exported bucket edges
+    def cumulative(self) -> list:
+        # Input: None
+        # Return: list of (edge in the exported unit, count of values up to and including it)
+        counts = self.counts
+        edges = []
+        seen = 0
+        index = 0
+        for exponent in self.export_exponents:
+            edge = bucket_index((1 << exponent) + 1)
+            seen += sum(counts[index:edge])
+            index = edge
+            edges.append(((1 << exponent) * self.unit, seen))
+        return edges
+
+    def reset(self) -> None:
+        self.counts = [0] * self.SIZE
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+
+
+### Counters and Gauges ###
+# A counter is increased by the code it counts. A gauge, or a counter kept elsewhere
+# (i.e. SessionLogger.dropped), is read from function when it is exported
+class Counter:
+    __slots__ = ('name', 'help', 'value', 'function')
+
+    def __init__(self, name: str, help: str = '', function=None) -> None:
+        # Input: str (metric name), str (description), optional callable (returns the value)
+        # Return: None
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.function = function
+
+    def inc(self, amount: int = 1) -> None:
+        self.value += amount
+
+    def get(self) -> float:
+        return self.function() if self.function is not None else self.value
+
+class Gauge(Counter):
+    __slots__ = ()
+
+
+
+### Registry ###
+# Metrics of one cuff. labels are added to every exported sample, i.e. {'cuff': 'left'}
+# when a DeviceManager runs several cuffs
+class Metrics:
+    def __init__(self, labels: dict = None) -> None:
+        # Input: optional dict (label name -> value)
+        # Return: None
+        self.labels = dict(labels or {})
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    # The histogram called name, created on first use
+    def histogram(self, name: str, help: str = '', unit: float = 1e-9, export_exponents: range = None) -> Histogram:
+        # Input: str (metric name), str (description), float and optional range (see Histogram)
+        # Return: Histogram
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(name, help, unit, export_exponents)
+        return self.histograms[name]
+
+    def counter(self, name: str, help: str = '', function=None) -> Counter:
+        # Input: str (metric name), str (description), optional callable (returns the value)
+        # Return: Counter
+        if name not in self.counters:
+            self.counters[name] = Counter(name, help, function)
+        elif function is not None:
+            self.counters[name].function = function
+        return self.counters[name]
+
+    def gauge(self, name: str, function, help: str = '') -> Gauge:
+        # Input: str (metric name), callable (returns the value), str (description)
+        # Return: Gauge
+        self.gauges[name] = Gauge(name, help, function)
+        return self.gauges[name]
+
+    # Percentiles and counts as flat name -> value pairs, recorded as METRIC events when a
+    # session closes
+    def summary(self) -> dict:
+        # Input: None
+        # Return: dict of str -> float
+        summary = {}
+        for name, histogram in self.histograms.items():
+            if histogram.count:
+                summary[name + '.count'] = histogram.count
+                summary[name + '.p50'] = histogram.percentile(0.50)
+                summary[name + '.p99'] = histogram.percentile(0.99)
+                summary[name + '.max'] = histogram.max * histogram.unit
+        for name, counter in self.counters.items():
+            summary[name] = counter.get()
+        return summary
+
+
+
+### Prometheus Text Format ###
+def format_labels(labels: dict, extra: str = '') -> str:
+    # Input: dict (label name -> value), str (one more label, already formatted)
+    # Return: str (i.e. '{cuff="left",le="0.001"}', or '' without labels)
+    pairs = [name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+             for name, value in labels.items()]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+# Every metric of every registry, one family per name with a sample per registry
+def render(registries: list) -> str:
+    # Input: list of Metrics
+    # Return: str (Prometheus text exposition format 0.0.4)
+    families = {}
+    for registry in registries:
+        for histogram in registry.histograms.values():
+            families.setdefault((histogram.name, 'histogram', histogram.help), []).append((registry.labels, histogram))
+        for counter in registry.counters.values():
+            families.setdefault((counter.name, 'counter', counter.help), []).append((registry.labels, counter))
+        for gauge in registry.gauges.values():
+            families.setdefault((gauge.name, 'gauge', gauge.help), []).append((registry.labels, gauge))
+
+    lines = []
+    for (name, kind, help), members in families.items():
+        if help:
+            lines.append('# HELP ' + name + ' ' + help)
+        lines.append('# TYPE ' + name + ' ' + kind)
+        for labels, metric in members:
+            if kind != 'histogram':
+                lines.append(name + format_labels(labels) + ' ' + repr(float(metric.get())))
+                continue
+            for edge, count in metric.cumulative():
+                lines.append(name + '_bucket' + format_labels(labels, 'le="' + repr(edge) + '"') + ' ' + str(count))
+            lines.append(name + '_bucket' + format_labels(labels, 'le="+Inf"') + ' ' + str(metric.count))
+            lines.append(name + '_sum' + format_labels(labels) + ' ' + repr(metric.total * metric.unit))
+            lines.append(name + '_count' + format_labels(labels) + ' ' + str(metric.count))
+    return '\n'.join(lines) + '\n'
+
+
+
+### Metrics Endpoint ###
+# Serves GET /metrics on a background thread. registries is a list of Metrics, or a
+# callable returning one, so a front-end can serve the registries of whichever session
+# is running. Binds to localhost only; put a reverse proxy in front to expose it.
+class MetricsServer:
+    def __init__(self, registries, port: int = 9105, host: str = '127.0.0.1') -> None:
+        # Input: list of Metrics or callable (returns a list of Metrics), int (TCP port, 0 picks a free one),
+        #        str (address to bind)
+        # Return: None
+        self.registries = registries
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = render(server.current()).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            # Scrapes are not printed
+            def log_message(self, format: str, *args) -> None:
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.__thread = threading.Thread(target=self.httpd.serve_forever, name='metrics-server', daemon=True)
+
+    def current(self) -> list:
+        # Input: None
+        # Return: list of Metrics
+        registries = self.registries() if callable(self.registries) else self.registries
+        return list(registries or [])
+
+    def start(self) -> "MetricsServer":
+        # Input: None
+        # Return: MetricsServer (self)
+        self.__thread.start()
+        return self
+
+    def stop(self) -> None:
+        # Input: None
+        # Return: None
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
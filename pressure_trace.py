@@ -0,0 +1,109 @@
+#!/usr/bin/python3.9.6
+import csv
+import json
+import struct
+
+from sampling import PressureSample
+
+### Binary Pressure Trace Format ###
+# A trace file is a small header followed by fixed-width little-endian records.
+#
+#   header:  8 byte magic | uint32 parameter length | parameters as UTF-8 JSON
+#   record:  float64 time (seconds since session start) | float32 voltage (V) | float32 pressure (mmHg)
+#            | uint16 phase (scheduler.Phase) | uint16 trial (0 based)
+#
+# The parameters include the session clock anchor (session_clock.py), so record times can be
+# turned back into wall clock times.
+# Records are 20 bytes, so a trace is roughly a tenth of the size of the equivalent CSV and
+# keeps full timestamp resolution. A record only depends on its own bytes, so a trace cut
+# short by a crash can still be read up to the last complete record.
+TRACE_MAGIC = b'PTRACE01'
+TRACE_RECORD = struct.Struct('<dffHH')
+TRACE_FIELDS = ['time', 'voltage', 'pressure', 'phase', 'trial']
+
+# NumPy dtype matching TRACE_RECORD, used by read_trace
+def trace_dtype():
+    import numpy as np
+    return np.dtype([('time', '<f8'), ('voltage', '<f4'), ('pressure', '<f4'), ('phase', '<u2'), ('trial', '<u2')])
+
+
+
+### Trace Writer ###
+# Records are packed into a buffered file, so writing a sample does not make a system
+# call. flush() pushes buffered records to disk and is called at the end of every phase.
+class TraceWriter:
+    def __init__(self, file_name: str, parameters: dict, buffer_size: int = 65536) -> None:
+        # Input: str (file name), dict (trial parameters stored in the header), int (write buffer in bytes)
+        # Return: None
+        self.file_name = file_name
+        self.records = 0
+        self.__pack = TRACE_RECORD.pack
+        self.__file = open(file_name, 'wb', buffering=buffer_size)
+        header = json.dumps(parameters).encode('utf-8')
+        self.__file.write(TRACE_MAGIC + struct.pack('<I', len(header)) + header)
+        self.__file.flush()
+
+    def write(self, sample: PressureSample, phase: int, trial: int) -> None:
+        # Input: PressureSample, int (phase id), int (trial number)
+        # Return: None
+        self.__file.write(self.__pack(sample.timestamp, sample.voltage, sample.pressure, phase, trial))
+        self.records += 1
+
+    def flush(self) -> None:
+        if not self.__file.closed:
+            self.__file.flush()
+
+    def close(self) -> None:
+        if not self.__file.closed:
+            self.__file.close()
+
+
+
+### Trace Reader ###
+def read_trace_header(file_name: str) -> tuple:
+    # Input: str (file name)
+    # Return: tuple (dict of trial parameters, int byte offset of the first record)
+    with open(file_name, 'rb') as file:
+        if file.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+            raise ValueError(file_name + " is not a pressure trace")
+        (length,) = struct.unpack('<I', file.read(4))
+        parameters = json.loads(file.read(length).decode('utf-8'))
+    return parameters, len(TRACE_MAGIC) + 4 + length
+
+# Memory-maps the records of a trace as a NumPy structured array. Nothing is copied, so
+# loading a multi-hour session only costs the header parse. Fields are TRACE_FIELDS.
+def read_trace(file_name: str) -> tuple:
+    # Input: str (file name)
+    # Return: tuple (dict of trial parameters, numpy structured array of records)
+    import os
+    import numpy as np
+    parameters, offset = read_trace_header(file_name)
+    dtype = trace_dtype()
+    # Ignore a partially written last record
+    count = (os.path.getsize(file_name) - offset) // dtype.itemsize
+    if count == 0:
+        return parameters, np.zeros(0, dtype=dtype)
+    return parameters, np.memmap(file_name, dtype=dtype, mode='r', offset=offset, shape=(count,))
+
+# Reads records one at a time without NumPy, i.e. for CSV export on the Pi
+def iter_trace(file_name: str):
+    # Input: str (file name)
+    # Yields: tuple (time, voltage, pressure, phase, trial)
+    _, offset = read_trace_header(file_name)
+    with open(file_name, 'rb') as file:
+        file.seek(offset)
+        while True:
+            chunk = file.read(TRACE_RECORD.size * 4096)
+            usable = len(chunk) - len(chunk) % TRACE_RECORD.size
+            yield from TRACE_RECORD.iter_unpack(chunk[:usable])
+            if len(chunk) < TRACE_RECORD.size * 4096:
+                return
+
+# Write the records of a trace as CSV rows with a header
+def export_trace_csv(trace_file_name: str, csv_file_name: str) -> None:
+    # Input: str (trace file), str (CSV file)
+    # Return: None
+    with open(csv_file_name, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(TRACE_FIELDS)
+        writer.writerows(iter_trace(trace_file_name))
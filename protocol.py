@@ -0,0 +1,154 @@
+#!/usr/bin/python3.9.6
+import bisect
+import math
+from array import array
+from typing import NamedTuple
+
+from scheduler import Phase
+
+### Trial Protocol ###
+# The six trial settings are compiled once, before the session starts, into a fixed
+# timeline of phases. Every phase carries a table with the setpoint of each control tick,
+# so the control loop only indexes into a table instead of evaluating the ramp.
+#
+#   trial 0: INFLATE  HOLD  DEFLATE  REST
+#   trial 1: INFLATE  HOLD  DEFLATE  REST
+#   ...
+#   trial n: INFLATE  HOLD  DEFLATE           (no rest after the last trial)
+#
+# Setpoints:
+#   INFLATE  ramps from 0 to the desired pressure over the inflate time
+#   HOLD     the desired pressure
+#   DEFLATE  ramps from the desired pressure to 0 over the deflate time
+#   REST     0, the pumps are not driven while resting
+#
+# All setpoints live in one float64 array for the whole protocol; each phase holds a
+# read-only slice of it, so np.asarray(protocol.setpoints) gives the whole timeline
+# without copying. The same Protocol drives PumpControl, the simulator, replay and the
+# GUI progress display.
+
+def inflation_line_pressure(target_pressure: float, inflate_time_elapsed: float, desired_inflate_time: float) -> float:
+    ## finds slope of inflation by dividing target pressure by total inflation time, then multiplies
+    ## by current time so the function can return what the pressure should be along the line
+    return (target_pressure / desired_inflate_time) * inflate_time_elapsed
+
+def deflation_line_pressure(target_pressure: float, deflate_time_elapsed: float, desired_deflate_time: float) -> float:
+    ## the pressure drop over the time elapsed is subtracted from the target pressure, so the
+    ## line slopes down from the target pressure to 0
+    return target_pressure - (target_pressure / desired_deflate_time) * deflate_time_elapsed
+
+
+
+### Compiled Phase ###
+class PhaseSpec(NamedTuple):
+    index: int              # position in the protocol
+    trial: int              # 0 based
+    phase: Phase
+    start: float            # seconds from the start of the protocol
+    duration: float         # seconds
+    frequency: float        # control ticks per second
+    setpoint_rate: float    # slope of the setpoint in mmHg/s, used for feed-forward
+    setpoints: memoryview   # read-only float64 setpoint of every tick in mmHg
+
+    @property
+    def end(self) -> float:
+        return self.start + self.duration
+
+    # Setpoint of the tick nearest to elapsed seconds into the phase
+    def setpoint(self, elapsed: float) -> float:
+        # Input: float (seconds since the phase started)
+        # Return: float (mmHg)
+        index = int(elapsed * self.frequency + 0.5)
+        setpoints = self.setpoints
+        if index >= len(setpoints):
+            index = len(setpoints) - 1
+        return setpoints[index]
+
+
+
+### Compiled Protocol ###
+class Protocol(NamedTuple):
+    phases: tuple           # PhaseSpec, in order
+    starts: tuple           # start of every phase in seconds, for lookups by time
+    setpoints: memoryview   # read-only float64 setpoints of the whole protocol
+    frequency: float
+    number_of_trials: int
+    pressure: float
+    total_duration: float   # seconds
+
+    # Phase running at t seconds into the protocol, the last phase once it has ended
+    def phase_at(self, t: float) -> PhaseSpec:
+        # Input: float (seconds since the start of the protocol)
+        # Return: PhaseSpec
+        return self.phases[max(bisect.bisect_right(self.starts, t) - 1, 0)]
+
+    # Fraction of the protocol done after t seconds, between 0 and 1
+    def progress(self, t: float) -> float:
+        # Input: float (seconds since the start of the protocol)
+        # Return: float
+        if self.total_duration <= 0:
+            return 1.0
+        return min(max(t / self.total_duration, 0.0), 1.0)
+
+def compile_protocol(desired_number_of_trials: float,
+                     desired_pressure: float,
+                     desired_inflate_time: float,
+                     desired_hold_time: float,
+                     desired_deflate_time: float,
+                     desired_time_between_trials: float,
+                     frequency: float = 100.0) -> Protocol:
+    # Input: the six trial settings, float (control ticks per second)
+    # Return: Protocol
+    if frequency <= 0:
+        raise ValueError("Control frequency must be positive")
+    number_of_trials = int(desired_number_of_trials)
+    if number_of_trials < 1:
+        raise ValueError("A protocol needs at least one trial")
+    pressure = float(desired_pressure)
+
+    # Setpoint of tick n of each phase, at n / frequency seconds into the phase
+    def ticks(duration: float) -> int:
+        return max(math.ceil(duration * frequency - 1e-9), 1)
+
+    def profile(phase: Phase, duration: float) -> tuple:
+        count = ticks(duration)
+        if phase == Phase.INFLATE and duration > 0:
+            values = [min(inflation_line_pressure(pressure, n / frequency, duration), pressure) for n in range(count)]
+            return values, pressure / duration
+        if phase == Phase.DEFLATE and duration > 0:
+            values = [max(deflation_line_pressure(pressure, n / frequency, duration), 0.0) for n in range(count)]
+            return values, -pressure / duration
+        if phase == Phase.HOLD:
+            return [pressure] * count, 0.0
+        return [0.0] * count, 0.0
+
+    layout = []
+    for trial in range(number_of_trials):
+        layout += [(trial, Phase.INFLATE, float(desired_inflate_time)),
+                   (trial, Phase.HOLD, float(desired_hold_time)),
+                   (trial, Phase.DEFLATE, float(desired_deflate_time))]
+        if trial < number_of_trials - 1:
+            layout.append((trial, Phase.REST, float(desired_time_between_trials)))
+
+    # Every trial has the same profiles, so each is only computed once
+    profiles = {}
+    table = array('d')
+    offsets = []
+    for trial, phase, duration in layout:
+        key = (phase, duration)
+        if key not in profiles:
+            profiles[key] = profile(phase, duration)
+        offsets.append(len(table))
+        table.extend(profiles[key][0])
+    setpoints = memoryview(table).toreadonly()
+
+    phases = []
+    start = 0.0
+    for index, (trial, phase, duration) in enumerate(layout):
+        end = offsets[index + 1] if index + 1 < len(offsets) else len(table)
+        phases.append(PhaseSpec(index, trial, phase, start, duration, frequency,
+                                profiles[(phase, duration)][1], setpoints[offsets[index]:end]))
+        start += duration
+
+    return Protocol(tuple(phases), tuple(spec.start for spec in phases), setpoints,
+                    frequency, number_of_trials, pressure, start)
@@ -1,13 +1,9 @@
 #!/usr/bin/python3.9.6
 
-import RPi.GPIO as GPIO
 import time
-import board
-import busio
-from adafruit_ads1x15 import ads1115 as ADS
-from adafruit_ads1x15.analog_in import AnalogIn
 from datetime import datetime
-import csv
+
+from session_logger import FileHandler
 
 # Set channel to pin number for BOARD
 #InflateChannel = 33
@@ -19,59 +15,60 @@ InflateChannel = 13
 DeflateChannel = 12
 ValveChannel = 27
 
-### GPIO setup ###
-# BOARD chooses channels by printed numbers on RPi, i.e. 40
-#GPIO.setmode(GPIO.BOARD)
-
-# BCM chooses channels by Broadcom SOC channel, i.e. GPIO21
-# This project uses a module that sets mode for BCM. No other format is possible.
-GPIO.setmode(GPIO.BCM)
-
-GPIO.setup(InflateChannel, GPIO.OUT)
-GPIO.setup(DeflateChannel, GPIO.OUT)
-GPIO.setup(ValveChannel, GPIO.OUT)
-
-
-
-### ADC Control Functions ###
-# Guide - https://learn.adafruit.com/adafruit-4-channel-adc-breakouts/python-circuitpython
-i2c = busio.I2C(board.SCL, board.SDA)
-ads = ADS.ADS1115(i2c)
-# ADS gain is not used, so it is set to the default of 1
-ads.gain = 1
-
-# ADS mode set to single stream
-ads.mode = ADS.Mode.SINGLE
-# Offset is calculated at initialization to determine OpAmp bias
-ads_offset = AnalogIn(ads, ADS.P0).voltage
+# Set by setup_hardware() and setup_logging(). Importing this module does not touch
+# GPIO or I2C, and does not need the Pi libraries
+GPIO = None
+i2c = None
+ads = None
+ads_offset = None
+log_file = None
+activity_log = None
+
+def setup_hardware() -> None:
+    # Input: None
+    # Return: None
+    global GPIO, i2c, ads, ads_offset
+    import RPi.GPIO
+    import board
+    import busio
+    from adafruit_ads1x15 import ads1115 as ADS
+    from adafruit_ads1x15.analog_in import AnalogIn
+    GPIO = RPi.GPIO
+
+    ### GPIO setup ###
+    # BOARD chooses channels by printed numbers on RPi, i.e. 40
+    #GPIO.setmode(GPIO.BOARD)
+
+    # BCM chooses channels by Broadcom SOC channel, i.e. GPIO21
+    # This project uses a module that sets mode for BCM. No other format is possible.
+    GPIO.setmode(GPIO.BCM)
+
+    GPIO.setup(InflateChannel, GPIO.OUT)
+    GPIO.setup(DeflateChannel, GPIO.OUT)
+    GPIO.setup(ValveChannel, GPIO.OUT)
+
+    ### ADC Control Functions ###
+    # Guide - https://learn.adafruit.com/adafruit-4-channel-adc-breakouts/python-circuitpython
+    i2c = busio.I2C(board.SCL, board.SDA)
+    ads = ADS.ADS1115(i2c)
+    # ADS gain is not used, so it is set to the default of 1
+    ads.gain = 1
+
+    # ADS mode set to single stream
+    ads.mode = ADS.Mode.SINGLE
+    # Offset is calculated at initialization to determine OpAmp bias
+    ads_offset = AnalogIn(ads, ADS.P0).voltage
 
 
 
 ### Data Logging ###
-# 2 dimensional array that stores device activity for debugging
-activity_log = [['Time', 'Object', 'Activity', 'Details']]
-
-
-### File Handling ###
-class FileHandler:
-    # Data source indicates what generated the data being written to the file.
-    # Default is set to pressure
-    def __init__(self, data_source: str = "Log_") -> None:
-        # File name is source + current time (YYYY-MM-DD_HH_mm_ss)
-        # ex. "pressure_2023-2-19_11-32-55.csv"
-        self.__file_name = data_source + datetime.now().strftime("%Y-%m-%d_%H-%M-%S") + ".csv"
-    
-    def write_session(self, output: list[list]) -> None:
-        with open(self.__file_name, 'w') as file:
-            writer = csv.writer(file)
-            for row in output:
-                writer.writerow(row)
-
-    def read_file(self):
-        with open(self.__file_name, 'r') as file:
-            reader = csv.reader(file)
-            for row in reader:
-                print('#' + str(reader.line_num) + ' ' + str(row))
+# Device activity is streamed to the session CSV while the script runs
+def setup_logging() -> None:
+    # Input: None
+    # Return: None
+    global log_file, activity_log
+    log_file = FileHandler()
+    activity_log = log_file.open_logger(['Time', 'Object', 'Activity', 'Details'])
 
 
 
@@ -87,10 +84,13 @@ class FlowObject:
         self.__pin = pin
         self.__name = name
 
-    # Set the desired state of the pump or valve
-    def set_state(self, state: bool) -> None:
-        # Input: boolean (flow state)
+    # Set the desired state of the pump or valve. The pin is only written when the state
+    # changes, unless force is set
+    def set_state(self, state: bool, force: bool = False) -> None:
+        # Input: boolean (flow state), boolean (write even if unchanged)
         # Return: None
+        if state == self.__state and not force:
+            return
         self.__state = state
         self.set_action()
 
@@ -106,10 +106,10 @@ class FlowObject:
         # Return: None
         if not self.__state:
             GPIO.output(self.__pin, GPIO.LOW)
-            activity_log.append([datetime.now().strftime("%H:%M:%S"), "Turn off " + self.__name])
+            activity_log.log([datetime.now().strftime("%H:%M:%S"), "Turn off " + self.__name])
         else:
             GPIO.output(self.__pin, GPIO.HIGH)
-            activity_log.append([datetime.now().strftime("%H:%M:%S"), "Turn on " + self.__name])
+            activity_log.log([datetime.now().strftime("%H:%M:%S"), "Turn on " + self.__name])
 
 # Define the inflation, deflation, and valve as FlowObject state machines
 # Control pin number and object name are passed to create the state machines
@@ -119,8 +119,27 @@ valve = FlowObject(ValveChannel, 'valve')
 
 
 
+### Input Sanitization ###
+# Ensures that user input is a non-negative number, i.e. 6, 400 or 25.43.
+# For unattended runs use batch_runner.py with a protocol file instead
+def input_sanitizer(response: str) -> float:
+    # Input: String (raw user input)
+    # Return: Float (numerical user input)
+    while True:
+        try:
+            value = float(response)
+        except ValueError:
+            value = -1.0
+        if value >= 0 and value != float('inf'):
+            return value
+        response = input("Please enter numbers only (Ex. 6, 400, 25.43) without any letters or special characters.")
+
+
+
 ### Testing/Manual Runs ###
 if __name__ == '__main__':
+    setup_hardware()
+    setup_logging()
     try:
         desired_number_of_trials    = input_sanitizer(input("Please enter how many trials to run:"))
         desired_pressure            = input_sanitizer(input("Please enter the desired pressure in mmHg:"))
@@ -129,12 +148,12 @@ if __name__ == '__main__':
         desired_deflate_time        = input_sanitizer(input("Please enter deflation duration in seconds:"))
         desired_time_between_trials = input_sanitizer(input("Please enter duration of time between trials in seconds:"))
         ### Enters user input to activity log ###
-        activity_log.append([datetime.now().strftime("%H:%M:%S"), "Number of Trials", str(desired_number_of_trials)])
-        activity_log.append([datetime.now().strftime("%H:%M:%S"), "Target Pressure", str(desired_pressure)])
-        activity_log.append([datetime.now().strftime("%H:%M:%S"), "Desired inflate time", str(desired_inflate_time)])
-        activity_log.append([datetime.now().strftime("%H:%M:%S"), "Desired hold time", str(desired_hold_time)])
-        activity_log.append([datetime.now().strftime("%H:%M:%S"), "Desired deflate time", str(desired_deflate_time)])
-        activity_log.append([datetime.now().strftime("%H:%M:%S"), "Time between Trials", str(desired_time_between_trials)])
+        activity_log.log([datetime.now().strftime("%H:%M:%S"), "Number of Trials", str(desired_number_of_trials)])
+        activity_log.log([datetime.now().strftime("%H:%M:%S"), "Target Pressure", str(desired_pressure)])
+        activity_log.log([datetime.now().strftime("%H:%M:%S"), "Desired inflate time", str(desired_inflate_time)])
+        activity_log.log([datetime.now().strftime("%H:%M:%S"), "Desired hold time", str(desired_hold_time)])
+        activity_log.log([datetime.now().strftime("%H:%M:%S"), "Desired deflate time", str(desired_deflate_time)])
+        activity_log.log([datetime.now().strftime("%H:%M:%S"), "Time between Trials", str(desired_time_between_trials)])
 
         ## Total trial time equation. 
         total_trial_time = desired_number_of_trials * (desired_inflate_time + desired_hold_time + desired_deflate_time) + (desired_time_between_trials * (desired_number_of_trials - 1))
@@ -148,21 +167,21 @@ if __name__ == '__main__':
             while ((time.perf_counter() - desired_inflate_time - inflate_start_time) < 0):
                 raise_pressure(inflation_line_pressure(desired_pressure, (time.perf_counter() - inflate_start_time), desired_inflate_time))
             
-            activity_log.append([datetime.now().strftime("%H:%M:%S"), "Actual inflate time", str(time.perf_counter() - inflate_start_time)])
+            activity_log.log([datetime.now().strftime("%H:%M:%S"), "Actual inflate time", str(time.perf_counter() - inflate_start_time)])
 
             ## While loop essentially waits the program for the hold time requested            
             hold_start_time = time.perf_counter()
             while ((time.perf_counter() - hold_start_time) < desired_hold_time):
                 print("Holding at ", get_pressure())
 
-            activity_log.append([datetime.now().strftime("%H:%M:%S"), "Actual hold time", str(time.perf_counter() - hold_start_time)])
+            activity_log.log([datetime.now().strftime("%H:%M:%S"), "Actual hold time", str(time.perf_counter() - hold_start_time)])
 
             ## Deflation cycle. Essentially the same as inflation cycle            
             deflate_start_time = time.perf_counter()
             while ((time.perf_counter() - desired_deflate_time - deflate_start_time) < 0):
                 lower_pressure(deflation_line_pressure(desired_pressure, deflate_start_time, desired_deflate_time))
             
-            activity_log.append([datetime.now().strftime("%H:%M:%S"), "Actual deflate time", str(time.perf_counter() - deflate_start_time)])    
+            activity_log.log([datetime.now().strftime("%H:%M:%S"), "Actual deflate time", str(time.perf_counter() - deflate_start_time)])    
             
     except KeyboardInterrupt:
         emergency_shutoff()
@@ -175,8 +194,7 @@ if __name__ == '__main__':
     emergency_shutoff()
     GPIO.cleanup()             
 
-    log_file = FileHandler()
-    log_file.write_session(activity_log)
+    activity_log.close()
     log_file.read_file()
 
 ### ADS Test : Deprecated
@@ -0,0 +1,172 @@
+#!/usr/bin/python3.9.6
+import math
+import threading
+from typing import NamedTuple
+
+from metrics import clock_ns
+from scheduler import Phase
+
+### Safety Supervisor ###
+# A thread that watches a PumpControl independently of its control loop and vents the cuff
+# when a hard limit is crossed:
+#   overpressure  the cuff reads more than max_pressure
+#   duration      the session runs longer than the protocol plus duration_margin
+#   heartbeat     a phase is running but the control loop took no sample for heartbeat_timeout,
+#                 i.e. it is stuck in a blocking I2C read or a long pause. A slow control loop
+#                 samples only once per period, so the timeout is at least HEARTBEAT_PERIODS
+#                 control periods
+#   sensor        no pressure reading for sensor_timeout, the bus stays busy or the
+#                 acquisition thread failed
+#
+# The supervisor reads pressure through PumpControl.safety_pressure, not the control loop's
+# filtered sample: the newest buffered conversion in continuous mode, the loop's last raw
+# conversion while it is younger than sample_age, or a conversion of its own when the loop
+# stopped sampling.
+# Waiting for the bus is bounded by bus_timeout, so a stuck bus cannot stall the supervisor.
+#
+# A trip locks out both pumps and the valve (FlowObject.lock_out): their pins are written
+# off (valve open) directly from this thread, without the control thread's state, counters
+# or events, and stay off whatever the control loop asks for. The control loop sees
+# pump_control.safety_trip, ends the session and does the full emergency_shutoff. After a
+# trip the pins are written off again on every check until the supervisor is stopped.
+#
+# Trip latency is measured from the moment the limit was crossed to the last pin written:
+# the heartbeat or sensor deadline for a stall, otherwise the previous check, when the
+# pressure and duration were still within their limits. It is bounded by one
+# check interval plus the pin writes; CPython may add up to one GIL switch interval
+# (sys.getswitchinterval, 5 ms) while the control thread runs Python code. Every check
+# interval is recorded, so the bound is known even for sessions that never trip:
+#
+#   safety_check_interval_seconds  time between two checks, the worst case detection delay
+#   safety_trip_latency_seconds    limit crossed to pins written, one value per trip
+#   safety_trips_total             trips
+#   safety_bus_timeouts_total      supervisor reads that gave up waiting for the bus
+#
+# PumpControl starts its supervisor with the first phase and stops it in emergency_shutoff,
+# before the pins are released, or when the log closes.
+
+# Control periods without a sample before a heartbeat trip, whatever heartbeat_timeout says
+HEARTBEAT_PERIODS = 3
+
+class SafetyLimits(NamedTuple):
+    max_pressure: float = 300.0      # mmHg, the range of the pressure sensor
+    duration_margin: float = 30.0    # seconds allowed past the protocol's total duration
+    heartbeat_timeout: float = 0.2   # seconds without a control sample while a phase runs
+    sensor_timeout: float = 0.1      # seconds without a supervisor pressure reading
+    sample_age: float = 0.05         # seconds a control loop sample is used before reading the ADC
+    bus_timeout: float = 0.005       # seconds the supervisor waits for the I2C bus
+    period: float = 0.005            # seconds between checks
+
+# Why and when the supervisor tripped
+class SafetyTrip(NamedTuple):
+    reason: str       # overpressure, duration, heartbeat or sensor
+    value: float      # mmHg for overpressure, otherwise the seconds past the limit
+    timestamp: float  # session clock seconds
+    latency: float    # seconds from the limit crossed to the pins written
+
+class SafetySupervisor:
+    def __init__(self, pump_control, limits: SafetyLimits = SafetyLimits(), on_trip=None) -> None:
+        # Input: PumpControl, SafetyLimits, optional callable (receives the SafetyTrip, on the supervisor thread)
+        # Return: None
+        if limits.max_pressure <= pump_control.desired_pressure:
+            raise ValueError("The desired pressure of " + format(pump_control.desired_pressure, 'g') + " mmHg is not below the "
+                             + format(limits.max_pressure, 'g') + " mmHg safety limit")
+        if limits.period <= 0:
+            raise ValueError("The supervisor period must be positive")
+        self.pump_control = pump_control
+        self.limits = limits
+        self.on_trip = [on_trip] if on_trip is not None else []
+        self.max_duration = pump_control.protocol.total_duration + limits.duration_margin
+        self.heartbeat_timeout = max(limits.heartbeat_timeout, HEARTBEAT_PERIODS / pump_control.control_frequency)
+        self.trip = None
+        self.started = None
+
+        metrics = pump_control.metrics
+        self.check_interval = metrics.histogram('safety_check_interval_seconds', "Time between two safety checks")
+        self.trip_latency = metrics.histogram('safety_trip_latency_seconds', "Safety limit crossed to pumps off and valve open")
+        self.trips = metrics.counter('safety_trips_total', "Sessions vented by the safety supervisor")
+        self.bus_timeouts = metrics.counter('safety_bus_timeouts_total', "Supervisor reads that gave up waiting for the I2C bus")
+
+        self.__stopping = threading.Event()
+        self.__thread = threading.Thread(target=self.run, name='safety-supervisor', daemon=True)
+
+    @property
+    def running(self) -> bool:
+        return self.__thread.is_alive()
+
+    def start(self) -> "SafetySupervisor":
+        # Input: None
+        # Return: SafetySupervisor (self)
+        if self.started is None:
+            self.started = self.pump_control.clock()
+            self.__thread.start()
+        return self
+
+    def stop(self) -> None:
+        # Input: None
+        # Return: None
+        self.__stopping.set()
+        if self.__thread.is_alive() and self.__thread is not threading.current_thread():
+            self.__thread.join()
+
+    ### Supervisor Thread ###
+    def run(self) -> None:
+        pump_control = self.pump_control
+        limits = self.limits
+        period = limits.period
+        heartbeat_timeout = int(self.heartbeat_timeout * 1e9)
+        sensor_timeout = int(limits.sensor_timeout * 1e9)
+        deadline = self.started + self.max_duration
+        stopping = self.__stopping
+        previous = clock_ns()
+        last_reading = previous
+
+        while not stopping.wait(period):
+            now = clock_ns()
+            self.check_interval.record(now - previous)
+            if self.trip is not None:
+                # Keep the pins off in case the control thread wrote one between checks
+                pump_control.lock_out()
+                previous = now
+                continue
+
+            # Stalls and the deadline are checked before the pressure, whose read may wait for the bus
+            if pump_control.phase != Phase.IDLE and now - pump_control.heartbeat > heartbeat_timeout:
+                crossed = pump_control.heartbeat + heartbeat_timeout
+                self.vent('heartbeat', (now - crossed) * 1e-9, crossed)
+            elif pump_control.clock() > deadline:
+                self.vent('duration', pump_control.clock() - deadline, previous)
+            else:
+                pressure = pump_control.safety_pressure(limits.sample_age, limits.bus_timeout)
+                if pressure is not None:
+                    last_reading = now
+                    if pressure > limits.max_pressure:
+                        self.vent('overpressure', pressure, previous)
+                else:
+                    self.bus_timeouts.inc()
+                    if now - last_reading > sensor_timeout:
+                        crossed = last_reading + sensor_timeout
+                        self.vent('sensor', (now - crossed) * 1e-9, crossed)
+            previous = now
+
+    # Lock out the pumps and valve, then record the trip. crossed is the clock_ns time the
+    # limit was crossed
+    def vent(self, reason: str, value: float, crossed: int) -> None:
+        # Input: str (reason), float (mmHg or seconds), int (nanoseconds)
+        # Return: None
+        self.pump_control.lock_out()
+        latency = max(clock_ns() - crossed, 0)
+        self.trip_latency.record(latency)
+        self.trips.inc()
+        self.trip = SafetyTrip(reason, value, self.pump_control.clock(), latency * 1e-9)
+        self.pump_control.safety_trip = self.trip
+        for callback in self.on_trip:
+            callback(self.trip)
+
+    # Worst case trip latency seen so far: the longest check interval, or the longest trip
+    def latency_bound(self) -> float:
+        # Input: None
+        # Return: float (seconds, nan before the first check)
+        if self.check_interval.count == 0:
+            return math.nan
+        return max(self.check_interval.max, self.trip_latency.max) * 1e-9
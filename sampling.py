@@ -0,0 +1,40 @@
+#!/usr/bin/python3.9.6
+import time
+from typing import NamedTuple
+
+### Pressure Conversion ###
+# Pressure sensor outputs 0.1067 mV per mmHg
+# Multiplier is set at 1/0.1067 * 1000, or 9372, to turn the ratio into mmHg per V because the ADC returns Volts, not mV.
+# ADS_OFFSET counteracts bias introduced by an op amp, around 4-6 mV
+# 300 mmHg should output ~31.997 mV
+PRESSURE_PER_VOLT = 9372
+ADS_OFFSET = 0.0042
+
+def voltage_to_pressure(voltage: float) -> float:
+    # Input: float (ADC voltage in V)
+    # Return: float (pressure in mmHg)
+    return (voltage + ADS_OFFSET) * PRESSURE_PER_VOLT
+
+def pressure_to_voltage(pressure: float) -> float:
+    # Input: float (pressure in mmHg)
+    # Return: float (ADC voltage in V that would produce that pressure)
+    return (pressure / PRESSURE_PER_VOLT) - ADS_OFFSET
+
+
+
+### Pressure Sample ###
+# A single ADC conversion. The same sample is written to the log, handed to the
+# controller and shown on the GUI, so all three agree on what was measured. With a
+# pressure filter (filters.py) the log keeps the raw sample and the controller and GUI
+# get the filtered one.
+class PressureSample(NamedTuple):
+    timestamp: float # seconds when the conversion was read, on the session clock (session_clock.py)
+    voltage: float   # V
+    pressure: float  # mmHg
+
+def make_sample(voltage: float, timestamp: float = None) -> PressureSample:
+    # Input: float (ADC voltage), optional float (timestamp, default time.perf_counter())
+    # Return: PressureSample
+    if timestamp is None:
+        timestamp = time.perf_counter()
+    return PressureSample(timestamp, voltage, voltage_to_pressure(voltage))
@@ -0,0 +1,137 @@
+#!/usr/bin/python3.9.6
+import time
+from enum import IntEnum
+
+### Trial Phases ###
+class Phase(IntEnum):
+    IDLE = 0
+    INFLATE = 1
+    HOLD = 2
+    DEFLATE = 3
+    REST = 4
+
+
+
+### Phase Timing Statistics ###
+# Collected by TickScheduler for every phase it runs.
+# Jitter is how late the loop woke up after a tick deadline, in seconds.
+# An overrun is a tick whose step took longer than one control period.
+# A phase is stopped when keep_running ended it before its duration had passed.
+class PhaseStats:
+    def __init__(self, phase: Phase, desired_duration: float) -> None:
+        # Input: Phase, float (desired phase duration in seconds)
+        # Return: None
+        self.phase = phase
+        self.desired_duration = desired_duration
+        self.duration = 0.0
+        self.ticks = 0
+        self.overruns = 0
+        self.total_jitter = 0.0
+        self.max_jitter = 0.0
+        self.stopped = False
+
+    def record_jitter(self, jitter: float) -> None:
+        # Input: float (seconds late)
+        # Return: None
+        self.total_jitter += jitter
+        if jitter > self.max_jitter:
+            self.max_jitter = jitter
+
+    @property
+    def mean_jitter(self) -> float:
+        # Input: None
+        # Return: float (seconds)
+        return self.total_jitter / self.ticks if self.ticks else 0.0
+
+    # Timing figures recorded as METRIC events at the end of the phase
+    def metrics(self) -> dict:
+        # Input: None
+        # Return: dict (ticks, overruns, mean and max jitter in seconds)
+        return {'ticks': self.ticks,
+                'overruns': self.overruns,
+                'mean_jitter': self.mean_jitter,
+                'max_jitter': self.max_jitter}
+
+
+
+# Clocks count whole nanoseconds at best (the session clock, time.perf_counter_ns), so a
+# phase with less than this left has ended. Sleeping for less would not move the clock
+CLOCK_RESOLUTION = 1e-9
+
+### Tick Scheduler ###
+# Runs one phase of a trial at a fixed control frequency. Each tick calls step(elapsed)
+# once, then sleeps until the next absolute deadline (phase start + n * period), so
+# timing errors do not accumulate and the CPU is idle between ticks.
+# clock and sleep can be replaced, i.e. by a simulated clock.
+class TickScheduler:
+    def __init__(self, frequency: float = 100.0, clock=time.perf_counter, sleep=time.sleep,
+                 period_histogram=None) -> None:
+        # Input: float (ticks per second), callable (clock in seconds), callable (sleep in seconds),
+        #        optional metrics.Histogram (receives the time between step starts in nanoseconds)
+        # Return: None
+        if frequency <= 0:
+            raise ValueError("Control frequency must be positive")
+        self.frequency = frequency
+        self.period = 1.0 / frequency
+        self.clock = clock
+        self.sleep = sleep
+        self.period_histogram = period_histogram
+        self.phase_start = 0.0
+        # PhaseStats of every phase run by this scheduler, in order
+        self.history: list[PhaseStats] = []
+
+    # Run step(elapsed) every tick until duration has passed or keep_running() returns False
+    def run_phase(self, phase: Phase, duration: float, step, keep_running=None) -> PhaseStats:
+        # Input: Phase, float (seconds), callable (step taking elapsed seconds), optional callable (returns bool)
+        # Return: PhaseStats
+        stats = PhaseStats(phase, duration)
+        start = self.clock()
+        self.phase_start = start
+        for delay in self.ticks(stats, start, step, keep_running):
+            self.sleep(delay)
+        stats.duration = self.clock() - start
+        self.history.append(stats)
+        return stats
+
+    # The tick loop of a phase, shared by run_phase and AsyncTickScheduler.run_phase. Calls
+    # step once per tick and yields the seconds to sleep before the next tick, so the caller
+    # only sleeps, blocking or awaited. Records ticks, overruns, jitter and the period
+    def ticks(self, stats: PhaseStats, start: float, step, keep_running=None):
+        # Input: PhaseStats (of the phase, filled in), float (phase start on the clock),
+        #        callable (step taking elapsed seconds), optional callable (returns bool)
+        # Return: generator of float (seconds to sleep, never negative)
+        clock = self.clock
+        period = self.period
+        end = start + stats.desired_duration
+        tick = 0
+        record_period = self.period_histogram.record if self.period_histogram is not None else None
+        last_step = None
+
+        now = start
+        while end - now >= CLOCK_RESOLUTION:
+            if keep_running is not None and not keep_running():
+                stats.stopped = True
+                break
+            if record_period is not None:
+                if last_step is not None:
+                    record_period(int((now - last_step) * 1e9))
+                last_step = now
+            step(now - start)
+            stats.ticks += 1
+
+            tick += 1
+            deadline = start + tick * period
+            now = clock()
+            if now > deadline:
+                # Step took longer than one period. Skip the missed ticks rather than running them back to back
+                stats.overruns += 1
+                tick = int((now - start) / period) + 1
+                deadline = start + tick * period
+            # The step ran past the end of the phase, there is no tick left to wait for
+            if end - now < CLOCK_RESOLUTION:
+                break
+            # The last tick of a phase is cut short so the phase ends on time
+            deadline = min(deadline, end)
+            yield deadline - now
+            now = clock()
+            stats.record_jitter(max(now - deadline, 0.0))
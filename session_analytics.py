@@ -0,0 +1,292 @@
+#!/usr/bin/python3.9.6
+import argparse
+import csv
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
+
+import numpy as np
+
+from pressure_trace import read_trace
+from scheduler import Phase
+
+### Session Analytics ###
+# Parses a session once into NumPy arrays, splits it into trials and phases, and computes
+# per-trial metrics without looping over samples in Python.
+#
+# Two sources are read:
+#   .trace  binary pressure trace (pressure_trace.py). Every record carries its phase and
+#           trial, and times have full perf_counter resolution.
+#   .csv    session CSV from older versions, where pressure rows [time, voltage, mmHg] and
+#           event rows [time, text, ...] share one file. Rows are assigned to a phase by the
+#           "Actual <phase> time" row written when the phase ended. Times only have one
+#           second resolution, so rise time and durations are coarse.
+#
+#   python3 session_analytics.py Logs/ -o summary.csv --workers 8
+
+# Parameter names of the trace header, and the CSV rows that hold them
+SETTINGS = {'Number of Trials': 'number_of_trials',
+            'Target Pressure': 'pressure',
+            'Desired inflate time': 'inflate_time',
+            'Desired hold time': 'hold_time',
+            'Desired deflate time': 'deflate_time',
+            'Time between Trials': 'time_between_trials'}
+
+# Rise time is measured between these fractions of the desired pressure
+RISE_LOW = 0.1
+RISE_HIGH = 0.9
+
+# Columns of the summary table, one row per trial
+SUMMARY_FIELDS = ['session', 'trial', 'desired_pressure',
+                  'rise_time', 'overshoot', 'overshoot_percent',
+                  'hold_mean', 'hold_std',
+                  'deflate_slope', 'desired_deflate_slope', 'deflate_slope_error',
+                  'inflate_time', 'desired_inflate_time',
+                  'hold_time', 'desired_hold_time',
+                  'deflate_time', 'desired_deflate_time']
+
+class Session(NamedTuple):
+    name: str
+    parameters: dict
+    time: np.ndarray      # seconds since the first sample
+    pressure: np.ndarray  # mmHg
+    phase: np.ndarray     # scheduler.Phase
+    trial: np.ndarray     # 0 based
+
+
+
+### Loading ###
+def load_trace(file_name: str) -> Session:
+    # Input: str (trace file name)
+    # Return: Session
+    parameters, records = read_trace(file_name)
+    time = np.asarray(records['time'], dtype=np.float64)
+    if len(time):
+        time = time - time[0]
+    return Session(file_name, parameters, time,
+                   np.asarray(records['pressure'], dtype=np.float64),
+                   np.asarray(records['phase'], dtype=np.int64),
+                   np.asarray(records['trial'], dtype=np.int64))
+
+# Phase ended by each "Actual <phase> time" row
+PHASE_MARKERS = {'Actual ' + phase.name.lower() + ' time': phase for phase in Phase if phase != Phase.IDLE}
+
+def load_csv(file_name: str) -> Session:
+    # Input: str (session CSV file name)
+    # Return: Session
+    parameters = {}
+    times, pressures, phases, trials = [], [], [], []
+    pending = 0  # pressure rows read since the last phase marker
+    trial = -1
+    day = 0
+    last_second = None
+    with open(file_name, 'r', newline='') as file:
+        for row in csv.reader(file):
+            if len(row) < 2:
+                continue
+            label = row[1]
+            if label in PHASE_MARKERS:
+                phase = PHASE_MARKERS[label]
+                if phase == Phase.INFLATE:
+                    trial += 1
+                phases += [phase] * pending
+                trials += [max(trial, 0)] * pending
+                pending = 0
+                continue
+            if label in SETTINGS and len(row) > 2:
+                parameters[SETTINGS[label]] = float(row[2])
+                continue
+            if len(row) != 3:
+                continue
+            try:
+                voltage = float(row[1])
+                pressure = float(row[2])
+                hours, minutes, seconds = row[0].split(':')
+            except ValueError:
+                continue
+            second = int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+            # Clock times wrap at midnight
+            if last_second is not None and second < last_second:
+                day += 86400
+            last_second = second
+            times.append(second + day)
+            pressures.append(pressure)
+            pending += 1
+    # Samples after the last marker were not part of a finished phase
+    phases += [Phase.IDLE] * pending
+    trials += [max(trial, 0)] * pending
+
+    time = np.array(times, dtype=np.float64)
+    if len(time):
+        time -= time[0]
+    return Session(file_name, parameters, time, np.array(pressures, dtype=np.float64),
+                   np.array(phases, dtype=np.int64), np.array(trials, dtype=np.int64))
+
+def load_session(file_name: str) -> Session:
+    # Input: str (.trace or .csv file name)
+    # Return: Session
+    if file_name.endswith('.trace'):
+        return load_trace(file_name)
+    return load_csv(file_name)
+
+
+
+### Segmenting ###
+# Start and end index of every run of samples with the same trial and phase
+def segments(session: Session) -> dict:
+    # Input: Session
+    # Return: dict of (trial, Phase) -> (start, end)
+    if len(session.time) == 0:
+        return {}
+    key = session.trial * len(Phase) + session.phase
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(key)) + 1))
+    ends = np.concatenate((starts[1:], [len(key)]))
+    result = {}
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        # A phase that was split, i.e. by samples with another tag, spans from its first to its last run
+        segment = (int(session.trial[start]), Phase(int(session.phase[start])))
+        first = result.get(segment, (start, end))[0]
+        result[segment] = (first, end)
+    return result
+
+
+
+### Metrics ###
+def duration(time: np.ndarray) -> float:
+    return float(time[-1] - time[0]) if len(time) > 1 else math.nan
+
+def trial_metrics(session: Session, trial: int, spans: dict) -> dict:
+    # Input: Session, int (trial), dict from segments()
+    # Return: dict with SUMMARY_FIELDS
+    parameters = session.parameters
+    desired_pressure = parameters.get('pressure', math.nan)
+    desired_deflate_time = parameters.get('deflate_time', math.nan)
+    time, pressure = session.time, session.pressure
+
+    def phase_slice(phase: Phase) -> slice:
+        start, end = spans.get((trial, phase), (0, 0))
+        return slice(start, end)
+
+    inflate, hold, deflate = phase_slice(Phase.INFLATE), phase_slice(Phase.HOLD), phase_slice(Phase.DEFLATE)
+
+    # Rise time and overshoot are measured over inflation and hold together
+    rising = slice(inflate.start, hold.stop) if hold.stop > hold.start else inflate
+    rise_time = math.nan
+    overshoot = math.nan
+    if rising.stop > rising.start:
+        rise_times = time[rising]
+        rise_pressure = pressure[rising]
+        low = rise_pressure >= RISE_LOW * desired_pressure
+        high = rise_pressure >= RISE_HIGH * desired_pressure
+        if low.any() and high.any():
+            rise_time = float(rise_times[np.argmax(high)] - rise_times[np.argmax(low)])
+        overshoot = max(float(rise_pressure.max()) - desired_pressure, 0.0)
+
+    hold_pressure = pressure[hold]
+    hold_mean = float(hold_pressure.mean()) if len(hold_pressure) else math.nan
+    hold_std = float(hold_pressure.std()) if len(hold_pressure) else math.nan
+
+    # Least squares slope of the deflation, compared to the slope of the deflation line
+    deflate_time, deflate_pressure = time[deflate], pressure[deflate]
+    deflate_slope = math.nan
+    if len(deflate_time) > 1 and deflate_time[-1] > deflate_time[0]:
+        centered = deflate_time - deflate_time.mean()
+        deflate_slope = float(np.dot(centered, deflate_pressure - deflate_pressure.mean()) / np.dot(centered, centered))
+    desired_deflate_slope = -desired_pressure / desired_deflate_time if desired_deflate_time else math.nan
+
+    return {'session': os.path.basename(session.name),
+            'trial': trial,
+            'desired_pressure': desired_pressure,
+            'rise_time': rise_time,
+            'overshoot': overshoot,
+            'overshoot_percent': 100 * overshoot / desired_pressure if desired_pressure else math.nan,
+            'hold_mean': hold_mean,
+            'hold_std': hold_std,
+            'deflate_slope': deflate_slope,
+            'desired_deflate_slope': desired_deflate_slope,
+            'deflate_slope_error': deflate_slope - desired_deflate_slope,
+            'inflate_time': duration(time[inflate]),
+            'desired_inflate_time': parameters.get('inflate_time', math.nan),
+            'hold_time': duration(time[hold]),
+            'desired_hold_time': parameters.get('hold_time', math.nan),
+            'deflate_time': duration(deflate_time),
+            'desired_deflate_time': desired_deflate_time}
+
+# Metrics for every trial of a session file
+def analyse_session(file_name: str) -> list:
+    # Input: str (.trace or .csv file name)
+    # Return: list of dict, one per trial
+    session = load_session(file_name)
+    spans = segments(session)
+    trials = sorted({trial for trial, phase in spans if phase != Phase.IDLE})
+    return [trial_metrics(session, trial, spans) for trial in trials]
+
+
+
+### Batch Processing ###
+# Session files in a directory. The trace is used where a session has one; CSVs are only
+# read for sessions without a trace, and pressure exports (*_pressure.csv) are skipped.
+def session_files(directory: str) -> list:
+    # Input: str (directory)
+    # Return: list of str (file names)
+    names = sorted(os.listdir(directory))
+    traces = {name[:-len('.trace')] for name in names if name.endswith('.trace')}
+    files = []
+    for name in names:
+        if name.endswith('.trace'):
+            files.append(os.path.join(directory, name))
+        elif name.endswith('.csv') and not name.endswith('_pressure.csv') and name[:-len('.csv')] not in traces:
+            files.append(os.path.join(directory, name))
+    return files
+
+# Analyse many sessions on a process pool. Rows keep the order of the files. Every worker
+# gets about four chunks, so a worker that drew long sessions does not hold up the rest
+def analyse_sessions(file_names: list, workers: int = None) -> list:
+    # Input: list of str (file names), optional int (worker processes, default one per CPU)
+    # Return: list of dict (summary rows)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers == 1 or len(file_names) < 2:
+        results = map(analyse_session, file_names)
+        return [row for rows in results for row in rows]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(analyse_session, file_names, chunksize=max(1, len(file_names) // (4 * workers)))
+        return [row for rows in results for row in rows]
+
+def write_summary(rows: list, file_name: str) -> None:
+    # Input: list of dict (summary rows), str (CSV file name)
+    # Return: None
+    with open(file_name, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=SUMMARY_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+# Fixed width table for the terminal
+def format_summary(rows: list, fields: list = None) -> str:
+    # Input: list of dict (summary rows), optional list of str (columns)
+    # Return: str
+    fields = fields or ['session', 'trial', 'rise_time', 'overshoot', 'hold_mean', 'hold_std',
+                        'deflate_slope_error', 'inflate_time', 'hold_time', 'deflate_time']
+    def cell(value) -> str:
+        return format(value, '.3f') if isinstance(value, float) else str(value)
+    table = [fields] + [[cell(row[field]) for field in fields] for row in rows]
+    widths = [max(len(line[column]) for line in table) for column in range(len(fields))]
+    return '\n'.join('  '.join(value.rjust(width) for value, width in zip(line, widths)) for line in table)
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-trial metrics for recorded sessions")
+    parser.add_argument('paths', nargs='+', help="session files (.trace or .csv) or directories of sessions")
+    parser.add_argument('-o', '--output', help="write the summary table to this CSV file")
+    parser.add_argument('--workers', type=int, default=None, help="worker processes, default one per CPU")
+    args = parser.parse_args()
+
+    file_names = []
+    for path in args.paths:
+        file_names += session_files(path) if os.path.isdir(path) else [path]
+    rows = analyse_sessions(file_names, args.workers)
+    if args.output:
+        write_summary(rows, args.output)
+    print(format_summary(rows))
@@ -0,0 +1,54 @@
+#!/usr/bin/python3.9.6
+import time
+from datetime import datetime
+
+### Session Clock ###
+# One timebase for everything recorded in a session: pressure samples, events, phase
+# timing and actuator counters. The wall clock is read once when the session starts;
+# after that only the monotonic clock is read, and times are kept as offsets from the
+# start. Offsets are turned into wall clock times only when exporting, so nothing in the
+# control loop formats dates, and samples and events line up to the nanosecond.
+#
+# clock_ns can be replaced, i.e. by SimulatedClock.time_ns, so simulated sessions get
+# simulated offsets with a real wall clock anchor.
+class SessionClock:
+    def __init__(self, clock_ns=time.perf_counter_ns, wall_ns=time.time_ns) -> None:
+        # Input: callable (monotonic nanoseconds), callable (wall clock nanoseconds since the epoch)
+        # Return: None
+        self.clock_ns = clock_ns
+        self.start_ns = clock_ns()
+        self.wall_start_ns = wall_ns()
+
+    # Nanoseconds since the session started
+    def time_ns(self) -> int:
+        # Input: None
+        # Return: int
+        return self.clock_ns() - self.start_ns
+
+    # Seconds since the session started
+    def time(self) -> float:
+        # Input: None
+        # Return: float
+        return (self.clock_ns() - self.start_ns) / 1e9
+
+    ### Export ###
+    def wall_time_ns(self, offset_ns: int) -> int:
+        # Input: int (nanoseconds since the session started)
+        # Return: int (nanoseconds since the epoch)
+        return self.wall_start_ns + offset_ns
+
+    def wall_time(self, offset_ns: int) -> datetime:
+        # Input: int (nanoseconds since the session started)
+        # Return: datetime (local time, microsecond resolution)
+        return datetime.fromtimestamp(self.wall_time_ns(offset_ns) / 1e9)
+
+    def format(self, offset_ns: int, fmt: str = "%Y-%m-%d %H:%M:%S.%f") -> str:
+        # Input: int (nanoseconds since the session started), str (strftime format)
+        # Return: str
+        return self.wall_time(offset_ns).strftime(fmt)
+
+    # Stored in the trace header so offsets can be turned into wall clock times later
+    def anchor(self) -> dict:
+        # Input: None
+        # Return: dict
+        return {'start': self.wall_time(0).isoformat(), 'wall_start_ns': self.wall_start_ns}
@@ -0,0 +1,227 @@
+#!/usr/bin/python3.9.6
+import csv
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+from pressure_trace import TraceWriter, export_trace_csv
+
+### File Handling ###
+# CSV name for a session: stem + ".csv", or stem + "_1.csv", "_2.csv", ... when a session
+# started in the same second already has that name. The CSV is created empty here, so the
+# name is taken before the next session looks for a free one
+def reserve_file_name(stem: str) -> str:
+    # Input: str (file name without extension)
+    # Return: str (CSV file name, created empty)
+    number = 0
+    while True:
+        name = stem if number == 0 else stem + "_" + str(number)
+        if not os.path.exists(name + ".trace"):
+            try:
+                open(name + ".csv", 'x').close()
+                return name + ".csv"
+            except FileExistsError:
+                pass
+        number += 1
+
+class FileHandler:
+    # Data source indicates what generated the data being written to the file.
+    # Default is set to pressure
+    def __init__(self, data_source: str = "Log_") -> None:
+        # File name is source + current time (YYYY-MM-DD_HH_mm_ss)
+        # ex. "pressure_2023-2-19_11-32-55.csv", or "pressure_2023-2-19_11-32-55_1.csv"
+        # for a second session started in the same second
+        self.__file_name = reserve_file_name(data_source + datetime.now().strftime("%Y-%m-%d_%H-%M-%S"))
+        # Pressure samples are stored in a binary trace next to the CSV, see pressure_trace.py
+        self.__trace_file_name = self.__file_name[:-len(".csv")] + ".trace"
+
+    @property
+    def file_name(self) -> str:
+        return self.__file_name
+
+    @property
+    def trace_file_name(self) -> str:
+        return self.__trace_file_name
+
+    # Open a streaming logger that writes rows to this file while the session runs
+    def open_logger(self, header: list = None) -> "SessionLogger":
+        # Input: optional list (header row)
+        # Return: SessionLogger
+        return SessionLogger(self.__file_name, header)
+
+    # Open the binary pressure trace for this session
+    def open_trace(self, parameters: dict) -> TraceWriter:
+        # Input: dict (trial parameters stored in the trace header)
+        # Return: TraceWriter
+        return TraceWriter(self.__trace_file_name, parameters)
+
+    # Export the pressure trace as CSV. Default name is the trace name with "_pressure.csv"
+    def export_csv(self, csv_file_name: str = None) -> str:
+        # Input: optional str (CSV file name)
+        # Return: str (CSV file name)
+        if csv_file_name is None:
+            csv_file_name = self.__trace_file_name[:-len(".trace")] + "_pressure.csv"
+        export_trace_csv(self.__trace_file_name, csv_file_name)
+        return csv_file_name
+
+    # Write a complete list of rows at once
+    def write_session(self, output: list[list]) -> None:
+        with open(self.__file_name, 'w', newline='') as file:
+            writer = csv.writer(file)
+            for row in output:
+                writer.writerow(row)
+
+    # Print every row of the session CSV, i.e. at the end of a manual run
+    def read_file(self) -> None:
+        # Input: None
+        # Return: None
+        with open(self.__file_name, 'r') as file:
+            reader = csv.reader(file)
+            for row in reader:
+                print('#' + str(reader.line_num) + ' ' + str(row))
+
+
+
+### Streaming Session Logger ###
+# Rows are put on a bounded queue and written to CSV by a background thread, so the
+# control loop never waits on the SD card and memory use stays flat however long the
+# session runs. The file is opened once and flushed in batches, either when batch_size
+# rows are waiting or flush_interval seconds have passed, so an abort or power loss
+# only loses the last batch.
+# If the writer cannot keep up and the queue fills, new rows are dropped and counted
+# rather than blocking the caller. PumpControl exports the count as log_rows_dropped_total
+# and writes it as a METRIC event when the session closes. With a queue_depth histogram
+# (metrics.py) the writer records how many rows are still waiting each time it takes one,
+# off the control thread.
+class SessionLogger:
+    # Put on the queue by close() to tell the writer thread to finish
+    __CLOSE = object()
+
+    def __init__(self, file_name: str, header: list = None,
+                 batch_size: int = 256,
+                 flush_interval: float = 0.5,
+                 max_queue: int = 8192,
+                 fsync: bool = True) -> None:
+        # Input: str (file name), optional list (header row), int (rows per batch),
+        #        float (max seconds between flushes), int (queue capacity), bool (fsync after each flush)
+        # Return: None
+        self.file_name = file_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.dropped = 0
+        self.closed = False
+        self.queue_depth = None
+        self.__queue = queue.Queue(max_queue)
+        self.__file = open(file_name, 'w', newline='')
+        self.__writer = csv.writer(self.__file)
+        if header is not None:
+            self.__writer.writerow(header)
+        self.__thread = threading.Thread(target=self.__run, name='session-logger', daemon=True)
+        self.__thread.start()
+
+    # Queue a row for writing. Never blocks
+    def log(self, row: list) -> None:
+        # Input: list (CSV row)
+        # Return: None
+        try:
+            self.__queue.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+
+    # Number of rows waiting to be written
+    def pending(self) -> int:
+        return self.__queue.qsize()
+
+    # Write everything that is queued and close the file
+    def close(self) -> None:
+        # Input: None
+        # Return: None
+        if self.closed:
+            return
+        self.closed = True
+        self.__queue.put(self.__CLOSE)
+        self.__thread.join()
+        self.__file.close()
+
+    def __flush(self, batch: list) -> None:
+        if batch:
+            self.__writer.writerows(batch)
+            batch.clear()
+        self.__file.flush()
+        if self.fsync:
+            os.fsync(self.__file.fileno())
+
+    def __run(self) -> None:
+        batch = []
+        next_flush = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                row = self.__queue.get(timeout=max(next_flush - time.monotonic(), 0.0))
+            except queue.Empty:
+                row = None
+
+            if row is self.__CLOSE:
+                self.__flush(batch)
+                return
+            if row is not None:
+                batch.append(row)
+                if self.queue_depth is not None:
+                    self.queue_depth.record(self.__queue.qsize())
+
+            if len(batch) >= self.batch_size or time.monotonic() >= next_flush:
+                if batch:
+                    self.__flush(batch)
+                next_flush = time.monotonic() + self.flush_interval
+
+
+
+### Unrecorded Sessions ###
+# Stand-ins for FileHandler and the logger and trace it opens that write nothing, for a
+# PumpControl that only drives the hardware, i.e. to calibrate the sensor (calibration.py)
+class DiscardingLogger:
+    def __init__(self) -> None:
+        self.dropped = 0
+        self.closed = False
+        self.queue_depth = None
+
+    def log(self, row: list) -> None:
+        pass
+
+    def pending(self) -> int:
+        return 0
+
+    def close(self) -> None:
+        self.closed = True
+
+class DiscardingTrace:
+    def __init__(self) -> None:
+        self.records = 0
+
+    def write(self, sample, phase: int, trial: int) -> None:
+        pass
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+class NoFileHandler:
+    file_name = None
+    trace_file_name = None
+
+    def open_logger(self, header: list = None) -> DiscardingLogger:
+        # Input: optional list (header row, unused)
+        # Return: DiscardingLogger
+        return DiscardingLogger()
+
+    def open_trace(self, parameters: dict) -> DiscardingTrace:
+        # Input: dict (trial parameters, unused)
+        # Return: DiscardingTrace
+        return DiscardingTrace()
+
+    def read_file(self) -> None:
+        pass
@@ -0,0 +1,123 @@
+import pytest
+
+from acquisition import I2C_OVERHEAD, ContinuousAcquisition, ScanChannel, ScanningAcquisition
+
+# Reads fail with OSError, like a lost I2C device, after reads conversions
+class FailingChannel:
+    def __init__(self, reads: int) -> None:
+        self.reads = reads
+
+    @property
+    def voltage(self) -> float:
+        if self.reads == 0:
+            raise OSError("I2C read failed")
+        self.reads -= 1
+        return 1.0
+
+class FakeADS:
+    gain = 1
+    data_rate = 860
+
+def test_continuous_acquisition_raises_its_error():
+    acquisition = ContinuousAcquisition(FailingChannel(3), 860)
+    acquisition.start()
+    acquisition.join(timeout=1.0)
+    assert isinstance(acquisition.error, OSError)
+    with pytest.raises(RuntimeError, match="I2C read failed"):
+        acquisition.latest()
+
+def test_failing_first_read_is_raised_while_waiting():
+    acquisition = ContinuousAcquisition(FailingChannel(0), 860)
+    acquisition.start()
+    with pytest.raises(RuntimeError):
+        acquisition.wait_for_sample()
+
+def test_scanning_acquisition_raises_its_error():
+    acquisition = ScanningAcquisition(FakeADS(), [ScanChannel('cuff', 0)], lambda pin: FailingChannel(3))
+    acquisition.start()
+    acquisition.join(timeout=1.0)
+    with pytest.raises(RuntimeError):
+        acquisition.latest('cuff')
+
+# Every conversion takes the ADS's conversion time on a simulated clock, and the scan
+# stops itself after duration seconds
+class ScanBench:
+    def __init__(self, channels, duration: float) -> None:
+        self.now = 0.0
+        self.duration = duration
+        self.ads = FakeADS()
+        self.reads = []
+        self.acquisition = ScanningAcquisition(self.ads, channels, self.make_input, clock=self.clock, sleep=self.sleep)
+
+    def clock(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.now += seconds
+
+    def make_input(self, pin: int) -> "BenchInput":
+        return BenchInput(self, pin)
+
+    def run(self) -> ScanningAcquisition:
+        self.acquisition.scan()
+        return self.acquisition
+
+class BenchInput:
+    def __init__(self, bench: ScanBench, pin: int) -> None:
+        self.bench = bench
+        self.pin = pin
+
+    @property
+    def voltage(self) -> float:
+        bench = self.bench
+        bench.now += 1.0 / bench.ads.data_rate + I2C_OVERHEAD
+        bench.reads.append(self.pin)
+        if bench.now >= bench.duration:
+            bench.acquisition.stop()
+        return float(self.pin)
+
+def test_fixed_rate_channels_keep_their_rate():
+    bench = ScanBench([ScanChannel('cuff', 0), ScanChannel('line', 1, rate=100),
+                       ScanChannel('supply', 3, data_rate=128, gain=2 / 3, rate=1, convert=None)], 0.995)
+    acquisition = bench.run()
+    assert acquisition.missed == 0
+    assert abs(acquisition.buffer('line').count - 100) <= 1
+    assert acquisition.buffer('supply').count == 1
+    assert acquisition.latest('supply').pressure == 3.0
+    # The free-running cuff channel fills the rest of the ADC time
+    conversion = 1 / 860 + I2C_OVERHEAD
+    free_time = 0.995 - 100 * conversion - (1 / 128 + I2C_OVERHEAD)
+    assert acquisition.buffer('cuff').count >= int(free_time / conversion) - 1
+
+def test_switching_discards_settling_conversions():
+    bench = ScanBench([ScanChannel('cuff', 0), ScanChannel('line', 1, rate=50, settle_conversions=2)], 0.2)
+    acquisition = bench.run()
+    samples = acquisition.buffer('line').count
+    assert samples >= 10
+    assert bench.reads.count(1) == 3 * samples
+    assert acquisition.switches >= 2 * samples - 1
+
+def test_free_channels_take_turns():
+    bench = ScanBench([ScanChannel('cuff', 0), ScanChannel('cuff2', 2)], 0.1)
+    acquisition = bench.run()
+    assert abs(acquisition.buffer('cuff').count - acquisition.buffer('cuff2').count) <= 1
+
+def test_channel_settings_are_checked():
+    with pytest.raises(ValueError):
+        ScanChannel('cuff', 4)
+    with pytest.raises(ValueError):
+        ScanChannel('cuff', 0, data_rate=100)
+    with pytest.raises(ValueError):
+        ScanChannel('cuff', 0, gain=3)
+    with pytest.raises(ValueError):
+        ScanningAcquisition(FakeADS(), [], lambda pin: None)
+    with pytest.raises(ValueError):
+        ScanningAcquisition(FakeADS(), [ScanChannel('cuff', 0), ScanChannel('cuff', 1)], lambda pin: None)
+
+def test_fixed_rates_must_fit_the_adc_time():
+    with pytest.raises(ValueError, match="ADC time"):
+        ScanningAcquisition(FakeADS(), [ScanChannel('line', 1, data_rate=8, rate=10)], lambda pin: None)
+    # Settling counts against the budget too
+    with pytest.raises(ValueError):
+        ScanningAcquisition(FakeADS(), [ScanChannel('line', 1, data_rate=128, rate=40, settle_conversions=3)],
+                            lambda pin: None)
@@ -0,0 +1,21 @@
+import asyncio
+
+import pytest
+
+from PumpControlSimulator import PumpControlSimulator
+from async_runtime import AsyncRuntime
+
+@pytest.fixture(autouse=True)
+def session_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+# The async runtime passes on the same samples as run_trials
+def test_runtime_samples_every_step_like_run_trials():
+    threaded = PumpControlSimulator(1, 100, 0.2, 0.2, 0.2, 0, seed=1)
+    threaded_samples = []
+    assert threaded.run_trials(on_sample=threaded_samples.append) == 'COMPLETE'
+
+    pump_control = PumpControlSimulator(1, 100, 0.2, 0.2, 0.2, 0, seed=1)
+    samples = []
+    assert asyncio.run(AsyncRuntime(pump_control, on_sample=samples.append).run()) == 'COMPLETE'
+    assert samples == threaded_samples
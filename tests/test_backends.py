@@ -0,0 +1,30 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from backends import backend_name, create_pump_control, get_backend
+
+def test_backend_name_falls_back_to_the_environment(monkeypatch):
+    monkeypatch.setenv('PUMP_BACKEND', 'sim')
+    assert backend_name() == 'sim'
+    assert backend_name('tester') == 'tester'
+    with pytest.raises(ValueError):
+        backend_name('arduino')
+
+def test_keyword_arguments_override_the_defaults(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    pump_control = create_pump_control('sim', 1, 100, 0.2, 0.2, 0.2, 0, speed=None)
+    assert type(pump_control) is get_backend('sim')
+    assert pump_control.sim_clock.speed is None
+    pump_control.close_log()
+
+# Choosing a software backend must not import the Pi libraries
+def test_software_backends_import_no_hardware_libraries():
+    code = ("import sys, backends\n"
+            "for name in ('sim', 'tester', 'replay'): backends.get_backend(name)\n"
+            "print(sorted({'RPi', 'board', 'busio', 'adafruit_ads1x15'} & set(sys.modules)))")
+    repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, cwd=repository, check=True)
+    assert result.stdout.strip() == '[]'
@@ -0,0 +1,82 @@
+import json
+import os
+
+import pytest
+
+from batch_runner import load_batch, run_batch, session_duration
+
+SESSION = {'number_of_trials': 1, 'pressure': 100, 'inflate_time': 0.2, 'hold_time': 0.2,
+           'deflate_time': 0.2, 'time_between_trials': 0}
+
+def write_protocol(tmp_path, content) -> str:
+    file_name = str(tmp_path / "protocol.json")
+    with open(file_name, 'w') as file:
+        json.dump(content, file)
+    return file_name
+
+def test_defaults_and_repeats_are_applied(tmp_path):
+    file_name = write_protocol(tmp_path, {
+        'defaults': {'backend': 'sim', 'pause': 1, 'hold_time': 5},
+        'sessions': [{**SESSION, 'name': 'baseline', 'repeat': 2}, {**SESSION, 'hold_time': 1}]})
+    batch = load_batch(file_name)
+    assert [session['name'] for session in batch] == ['baseline', 'baseline', 'session2']
+    assert [session['hold_time'] for session in batch] == [0.2, 0.2, 1]
+    assert all(session['backend'] == 'sim' and session['pause'] == 1 for session in batch)
+
+def test_a_plain_list_of_sessions_is_a_batch(tmp_path):
+    assert len(load_batch(write_protocol(tmp_path, [SESSION]))) == 1
+
+@pytest.mark.parametrize('change, message', [
+    ({'pressure': None}, "pressure must be a number"),
+    ({'inflate_time': 0}, "inflate_time must be more than 0"),
+    ({'hold_time': -1}, "hold_time must be a number of at least 0"),
+    ({'repeat': 0}, "repeat must be a whole number"),
+    ({'pause': True}, "pause must be a number"),
+    ({'controller': 'fuzzy'}, "controller must be one of"),
+    ({'filter': 'kalman'}, "filter must be one of"),
+])
+def test_every_session_is_checked_before_the_batch_runs(tmp_path, change, message):
+    file_name = write_protocol(tmp_path, [SESSION, {**SESSION, 'name': 'late', **change}])
+    with pytest.raises(ValueError, match="late: " + message):
+        load_batch(file_name)
+
+def test_missing_settings_are_named(tmp_path):
+    session = dict(SESSION)
+    del session['deflate_time']
+    with pytest.raises(ValueError, match="missing deflate_time"):
+        load_batch(write_protocol(tmp_path, [session]))
+
+def test_unknown_file_types_are_rejected(tmp_path):
+    with pytest.raises(ValueError, match="protocol files must be"):
+        load_batch(str(tmp_path / "protocol.txt"))
+
+def test_session_duration():
+    assert session_duration(SESSION) == pytest.approx(0.6)
+
+def test_batch_runs_every_session_and_goes_on_after_an_error(tmp_path):
+    batch = [{**SESSION, 'name': 'first', 'backend': 'sim', 'speed': None, 'seed': 1},
+             {**SESSION, 'name': 'broken', 'backend': 'sim', 'no_such_option': 1},
+             {**SESSION, 'name': 'last', 'backend': 'sim', 'speed': None, 'seed': 2, 'controller': 'pid'}]
+    output = str(tmp_path / "Logs")
+    lines = []
+    results = run_batch(batch, output, report=lines.append)
+
+    assert [result['outcome'] for result in results] == ['COMPLETE', 'ERROR', 'COMPLETE']
+    assert 'no_such_option' in results[1]['error']
+    assert [json.loads(line) for line in lines] == results
+    assert os.path.basename(results[2]['log']).startswith("Sim_03_last_")
+    assert os.path.dirname(results[0]['log']) == output
+    assert os.path.exists(results[0]['trace'])
+
+def test_a_halted_session_stops_the_batch(tmp_path):
+    batch = [{**SESSION, 'name': 'stopped', 'backend': 'sim', 'speed': None},
+             {**SESSION, 'name': 'never', 'backend': 'sim', 'speed': None}]
+
+    # Ctrl+C during the hold
+    def halt(pump_control) -> None:
+        def interrupted_step(elapsed: float) -> None:
+            raise KeyboardInterrupt
+        pump_control.hold_step = interrupted_step
+    results = run_batch(batch, str(tmp_path), report=lambda line: None, on_start=halt)
+    assert [result['name'] for result in results] == ['stopped']
+    assert results[0]['outcome'] == 'HALTED'
@@ -0,0 +1,56 @@
+import os
+
+import benchmark
+from benchmark import compare, bench_protocol, format_results, latency_summary, time_calls
+from PumpControlSimulator import PumpControlSimulator
+
+def test_latency_summary_uses_nearest_rank_percentiles():
+    summary = latency_summary([(n + 1) * 1000 for n in range(100)])
+    assert summary == {'count': 100, 'mean': 50.5, 'p50': 51.0, 'p90': 91.0, 'p99': 100.0, 'max': 100.0}
+    assert latency_summary([]) == {'count': 0}
+
+def test_time_calls_calls_n_times():
+    calls = []
+    assert time_calls(lambda: calls.append(None), 25)['count'] == 25
+    assert len(calls) == 25
+
+def test_compare_pairs_benchmarks_of_both_runs():
+    old = {'results': {'step.hold.pid': {'p50': 2.0}, 'protocol.3x250.simulated': {'max_phase_error_ms': 4.0},
+                       'removed': {'p50': 1.0}}}
+    new = {'results': {'step.hold.pid': {'p50': 3.0}, 'protocol.3x250.simulated': {'max_phase_error_ms': 2.0},
+                       'added': {'p50': 1.0}}}
+    assert compare(old, new) == [('step.hold.pid', 'p50', 2.0, 3.0, 1.5),
+                                 ('protocol.3x250.simulated', 'max_phase_error_ms', 4.0, 2.0, 0.5)]
+
+def test_protocol_timing_on_the_simulator(tmp_path):
+    pump_control = PumpControlSimulator(1, 100, 0.5, 0.5, 0.5, 0, speed=None, seed=1,
+                                        log_prefix=os.path.join(str(tmp_path), 'Sim_'))
+    result = bench_protocol(pump_control)
+    assert result['outcome'] == 'COMPLETE'
+    assert result['phases'] == 3
+    assert result['ticks'] > 0
+    assert result['max_phase_error_ms'] < 20
+    assert result['mean_phase_error_ms'] <= result['max_phase_error_ms']
+
+def test_format_results_has_a_line_per_benchmark():
+    text = format_results({'step.hold.pid': latency_summary([1000, 2000]),
+                           'protocol.quick': {'mean_phase_error_ms': 1.0, 'max_phase_error_ms': 2.0,
+                                              'overruns': 0, 'wall_seconds': 1.5}})
+    lines = text.splitlines()
+    assert len(lines) == 2
+    assert lines[0].startswith('step.hold.pid') and lines[0].endswith(' us')
+    assert 'phase error mean 1.00 max 2.00 ms, overruns 0, 1.5 s' in lines[1]
+
+def test_session_files_go_to_a_temporary_directory(monkeypatch, tmp_path):
+    directories = []
+
+    def run_benchmarks(quick: bool, directory: str) -> dict:
+        directories.append(directory)
+        open(os.path.join(directory, 'Bench_1.csv'), 'w').close()
+        return {}
+    monkeypatch.setattr(benchmark, 'run_benchmarks', run_benchmarks)
+    benchmark.run_suite(quick=True)
+    assert not os.path.exists(directories[0])
+    benchmark.run_suite(quick=True, output_directory=str(tmp_path))
+    assert directories[1] == str(tmp_path)
+    assert os.path.exists(os.path.join(str(tmp_path), 'Bench_1.csv'))
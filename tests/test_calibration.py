@@ -0,0 +1,92 @@
+import json
+import time
+
+import pytest
+
+from calibration import (CalibrationProfile, ProfileCache, average_voltage, load_or_calibrate,
+                         two_point_calibration, zero_calibration)
+from sampling import ADS_OFFSET, PRESSURE_PER_VOLT
+
+# The vented cuff: readings around the op-amp bias, alternating by deviation
+def vented_readings(bias: float = -0.0045, deviation: float = 0.0001):
+    readings = iter([bias + deviation, bias - deviation] * 1000)
+    return lambda: next(readings)
+
+def test_average_voltage():
+    mean, deviation = average_voltage(vented_readings(-0.0045, 0.0001), 64)
+    assert mean == pytest.approx(-0.0045)
+    assert deviation == pytest.approx(0.0001)
+    with pytest.raises(ValueError):
+        average_voltage(vented_readings(), 0)
+
+def test_zero_calibration_reads_the_vented_cuff_as_zero():
+    profile = zero_calibration(vented_readings(-0.0045), CalibrationProfile(0x49), 64)
+    assert profile.to_pressure(-0.0045) == pytest.approx(0.0)
+    assert profile.gain == PRESSURE_PER_VOLT
+    assert profile.noise == pytest.approx(0.0001 * PRESSURE_PER_VOLT)
+    assert (profile.ads_address, profile.samples, profile.method) == (0x49, 64, 'zero')
+    # A two point profile keeps its gain and method when it is zeroed again
+    two_point = CalibrationProfile(0x49, gain=900.0, method='two_point')
+    rezeroed = zero_calibration(vented_readings(-0.0045), two_point, 8)
+    assert (rezeroed.gain, rezeroed.method) == (900.0, 'two_point')
+
+def test_zero_calibration_rejects_a_pressurised_cuff():
+    # About 100 mmHg on the cuff
+    with pytest.raises(ValueError, match="vent the cuff"):
+        zero_calibration(vented_readings(-ADS_OFFSET + 100 / PRESSURE_PER_VOLT), CalibrationProfile(), 64)
+
+def test_two_point_calibration_goes_through_both_points():
+    profile = two_point_calibration(-0.004, 0.0, 0.196, 200.0, CalibrationProfile(0x48, noise=0.3))
+    assert profile.gain == pytest.approx(1000.0)
+    assert profile.to_pressure(-0.004) == pytest.approx(0.0)
+    assert profile.to_pressure(0.196) == pytest.approx(200.0)
+    assert profile.to_voltage(200.0) == pytest.approx(0.196)
+    assert (profile.method, profile.noise) == ('two_point', 0.3)
+    with pytest.raises(ValueError):
+        two_point_calibration(0.1, 0.0, 0.1, 200.0, CalibrationProfile())
+    with pytest.raises(ValueError, match="rise with the voltage"):
+        two_point_calibration(0.2, 0.0, 0.1, 200.0, CalibrationProfile())
+
+def test_cache_round_trip(tmp_path):
+    cache = ProfileCache(str(tmp_path / "calibration.json"))
+    assert cache.load(0x48) is None
+    first = CalibrationProfile(0x48, offset=0.0046, method='zero', created=1.0)
+    second = CalibrationProfile(0x4A, gain=950.0, method='two_point', created=2.0)
+    cache.save(first)
+    cache.save(second)
+    assert cache.profiles() == {0x48: first, 0x4A: second}
+    with open(cache.file_name) as file:
+        assert list(json.load(file)) == ['0x48', '0x4a']
+    assert not (tmp_path / "calibration.json.tmp").exists()
+
+def test_broken_cache_entries_are_skipped(tmp_path):
+    file_name = tmp_path / "calibration.json"
+    file_name.write_text(json.dumps({'0x48': {'ads_address': '0x48', 'offset': 0.005, 'unknown': 1},
+                                     '0x49': {'ads_address': 'not an address'}}))
+    assert list(ProfileCache(str(file_name)).profiles()) == [0x48]
+    file_name.write_text("{")
+    assert ProfileCache(str(file_name)).profiles() == {}
+
+def test_freshness():
+    cache = ProfileCache(max_age=60)
+    assert cache.is_fresh(CalibrationProfile(method='zero', created=1000.0), now=1060.0)
+    assert not cache.is_fresh(CalibrationProfile(method='zero', created=1000.0), now=1061.0)
+    assert not cache.is_fresh(CalibrationProfile())
+
+def test_fresh_profiles_are_used_without_reading_the_sensor(tmp_path):
+    cache = ProfileCache(str(tmp_path / "calibration.json"))
+    cached = CalibrationProfile(0x48, offset=0.0046, method='zero', created=time.time())
+    cache.save(cached)
+
+    def read_voltage() -> float:
+        raise AssertionError("the sensor must not be read")
+    assert load_or_calibrate(read_voltage, 0x48, cache) == (cached, True)
+
+def test_stale_profiles_are_zeroed_again_and_keep_their_gain(tmp_path):
+    cache = ProfileCache(str(tmp_path / "calibration.json"), max_age=60)
+    cache.save(CalibrationProfile(0x48, gain=950.0, method='two_point', created=time.time() - 120))
+    profile, cached = load_or_calibrate(vented_readings(-0.0045), 0x48, cache, 16)
+    assert not cached
+    assert profile.gain == 950.0
+    assert profile.offset == pytest.approx(0.0045)
+    assert cache.load(0x48) == profile
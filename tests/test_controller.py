@@ -0,0 +1,19 @@
+from controller import BangBangController
+from sampling import PressureSample
+
+def command(controller, pressure: float, setpoint: float = 100.0) -> float:
+    return controller.update(setpoint, 0.0, PressureSample(0.0, 0.0, pressure))
+
+# By default the pumps switch exactly at the setpoint
+def test_bang_bang_switches_at_the_setpoint():
+    controller = BangBangController()
+    assert command(controller, 99.9) == 1.0
+    assert command(controller, 100.0) == 0.0
+    assert command(controller, 100.1) == -1.0
+
+def test_bang_bang_hysteresis_holds_the_pumps_off_near_the_setpoint():
+    controller = BangBangController(hysteresis=2.0)
+    assert command(controller, 99.0) == 0.0
+    assert command(controller, 97.0) == 1.0
+    assert command(controller, 99.0) == 1.0
+    assert command(controller, 100.0) == 0.0
@@ -0,0 +1,24 @@
+import csv
+
+import pytest
+
+from device_manager import CuffConfig, DeviceManager
+
+@pytest.fixture(autouse=True)
+def session_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+def metric_names(file_name: str) -> list:
+    with open(file_name, newline='') as file:
+        return [row['text'] for row in csv.DictReader(file) if row['kind'] == 'METRIC']
+
+# Jitter and overruns of the shared loop are logged once, as scheduler metrics
+def test_cuffs_log_only_their_ticks_per_phase():
+    cuffs = [CuffConfig('left'), CuffConfig('right', 5, 6, 26, 0x49)]
+    manager = DeviceManager(cuffs, 1, 100, 0.2, 0.2, 0.2, 0, backend='sim', speed=None)
+    assert manager.run() is not None
+    for file_name in manager.log_files().values():
+        names = metric_names(file_name)
+        assert names.count('ticks') == 3
+        assert 'overruns' not in names and 'max_jitter' not in names
+        assert 'scheduler.overruns' in names and 'scheduler.max_jitter' in names
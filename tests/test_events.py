@@ -0,0 +1,60 @@
+import csv
+
+from events import EVENT_FIELDS, Actuator, Event, EventKind, EventLog
+from scheduler import Phase
+
+class StepClock:
+    def __init__(self) -> None:
+        self.now = 0
+
+    def __call__(self) -> int:
+        self.now += 1000
+        return self.now
+
+def test_rows_name_the_kind_and_source():
+    assert Event(5, EventKind.ACTUATOR, Actuator.VALVE, 2, 1.0).row() == [5, 'ACTUATOR', 'VALVE', 2, 1.0, '']
+    assert Event(6, EventKind.PHASE_END, Phase.HOLD, 0, 4.9).row() == [6, 'PHASE_END', 'HOLD', 0, 4.9, '']
+    assert Event(7, EventKind.METRIC, Phase.INFLATE, 0, 3, 'overruns').row() == [7, 'METRIC', 'INFLATE', 0, 3, 'overruns']
+    assert Event(8, EventKind.METRIC, 0, 0, 1.5, 'duty').row() == [8, 'METRIC', 0, 0, 1.5, 'duty']
+
+def test_events_come_back_in_time_order_across_kinds():
+    log = EventLog(StepClock())
+    log.record(EventKind.PARAMETER, value=100, text='pressure')
+    log.record(EventKind.PHASE_START, Phase.INFLATE, 5)
+    log.trial = 1
+    log.record(EventKind.ACTUATOR, Actuator.INFLATION_PUMP, 1.0)
+    log.record(EventKind.NOTE, text='Emergency Shutoff')
+
+    events = list(log.events())
+    assert [event.t_ns for event in events] == [1000, 2000, 3000, 4000]
+    assert [event.kind for event in events] == [EventKind.PARAMETER, EventKind.PHASE_START, EventKind.ACTUATOR, EventKind.NOTE]
+    assert [event.trial for event in events] == [0, 0, 1, 1]
+    assert [event.kind for event in log.events(EventKind.NOTE, EventKind.PARAMETER)] == [EventKind.PARAMETER, EventKind.NOTE]
+    assert log.count() == 4
+    assert log.count(EventKind.ACTUATOR) == 1
+
+def test_values_keep_the_last_value_per_name():
+    log = EventLog(StepClock())
+    log.record(EventKind.PARAMETER, value=100, text='pressure')
+    log.record(EventKind.PARAMETER, value=5, text='hold_time')
+    log.record(EventKind.PARAMETER, value=120, text='pressure')
+    assert log.values() == {'pressure': 120, 'hold_time': 5}
+    assert log.values(EventKind.METRIC) == {}
+
+def test_listener_gets_every_event():
+    received = []
+    log = EventLog(StepClock(), received.append)
+    log.record(EventKind.ACTUATOR, Actuator.VALVE, 1.0)
+    assert len(received) == 1
+    assert received[0].row() == [1000, 'ACTUATOR', 'VALVE', 0, 1.0, '']
+
+def test_csv_export(tmp_path):
+    log = EventLog(StepClock())
+    log.record(EventKind.ACTUATOR, Actuator.DEFLATION_PUMP, 0.0)
+    log.record(EventKind.NOTE, text='done')
+    file_name = str(tmp_path / "events.csv")
+    log.write_csv(file_name, EventKind.NOTE)
+    with open(file_name, newline='') as file:
+        rows = list(csv.reader(file))
+    assert rows[0] == EVENT_FIELDS
+    assert rows[1:] == [['2000', 'NOTE', '0', '0', 'nan', 'done']]
@@ -0,0 +1,95 @@
+import math
+import random
+import statistics
+
+import pytest
+
+from filters import (AlphaBetaFilter, ExponentialAverage, MedianFilter, MovingAverage, RawFilter,
+                     make_filter)
+from sampling import PressureSample, pressure_to_voltage
+
+PERIOD = 0.01
+
+def run(pressure_filter, readings) -> list:
+    return [pressure_filter.update(pressure, n * PERIOD) for n, pressure in enumerate(readings)]
+
+def test_raw_filter_tracks_the_rate():
+    raw = RawFilter()
+    assert run(raw, [100, 101, 103]) == [100, 101, 103]
+    assert raw.rate == pytest.approx(200)
+
+def test_moving_average_matches_the_mean_of_the_window():
+    rng = random.Random(2)
+    readings = [rng.uniform(0, 300) for _ in range(50)]
+    filtered = run(MovingAverage(8), readings)
+    for n, value in enumerate(filtered):
+        assert value == pytest.approx(statistics.fmean(readings[max(0, n - 7):n + 1]))
+
+def test_median_removes_single_spikes():
+    filtered = run(MedianFilter(5), [100, 100, 100, 900, 100, 100, -50, 100])
+    assert filtered[2:] == [100] * 6
+    # Even windows average the two middle readings
+    assert run(MedianFilter(4), [1, 2, 3, 4, 10])[-2:] == [2.5, 3.5]
+
+def test_median_matches_the_window_median():
+    rng = random.Random(3)
+    readings = [rng.uniform(0, 300) for _ in range(50)]
+    filtered = run(MedianFilter(5), readings)
+    for n, value in enumerate(filtered):
+        assert value == statistics.median(readings[max(0, n - 4):n + 1])
+
+def test_exponential_average_follows_the_time_constant():
+    ema = ExponentialAverage(time_constant=0.05)
+    ema.update(0, 0.0)
+    assert ema.update(100, 0.05) == pytest.approx(100 * (1 - math.exp(-1)))
+    # The same elapsed time in smaller steps reaches the same value
+    fine = ExponentialAverage(time_constant=0.05)
+    fine.update(0, 0.0)
+    for n in range(1, 6):
+        value = fine.update(100, n * 0.01)
+    assert value == pytest.approx(ema.value)
+
+def test_alpha_beta_follows_a_ramp_without_lag():
+    ramp = [50 + 125 * n * PERIOD for n in range(300)]
+    alpha_beta = AlphaBetaFilter.from_noise()
+    filtered = run(alpha_beta, ramp)
+    assert filtered[-1] == pytest.approx(ramp[-1], abs=0.5)
+    assert alpha_beta.rate == pytest.approx(125, rel=0.02)
+
+def test_alpha_beta_rate_is_smoother_than_finite_differences():
+    rng = random.Random(4)
+    readings = [200 + rng.gauss(0, 1) for _ in range(500)]
+    raw, alpha_beta = RawFilter(), AlphaBetaFilter.from_noise()
+    raw_rates, estimated_rates = [], []
+    for n, pressure in enumerate(readings):
+        raw.update(pressure, n * PERIOD)
+        alpha_beta.update(pressure, n * PERIOD)
+        raw_rates.append(raw.rate)
+        estimated_rates.append(alpha_beta.rate)
+    assert statistics.pstdev(estimated_rates[100:]) < statistics.pstdev(raw_rates[100:]) / 10
+
+def test_reset_forgets_the_window():
+    median = MedianFilter(3)
+    run(median, [500, 500, 500])
+    median.reset()
+    assert median.update(100, 1.0) == 100
+    assert median.rate == 0.0
+
+def test_filter_sample_keeps_the_raw_timestamp():
+    moving_average = MovingAverage(2)
+    moving_average.filter_sample(PressureSample(0.0, pressure_to_voltage(100), 100))
+    filtered = moving_average.filter_sample(PressureSample(0.01, pressure_to_voltage(120), 120))
+    assert filtered.timestamp == 0.01
+    assert filtered.pressure == 110
+    assert filtered.voltage == pytest.approx(pressure_to_voltage(110))
+
+def test_settings_are_checked():
+    with pytest.raises(ValueError):
+        MovingAverage(0)
+    with pytest.raises(ValueError):
+        ExponentialAverage(0)
+    with pytest.raises(ValueError):
+        AlphaBetaFilter(alpha=0)
+    with pytest.raises(ValueError, match="Unknown filter"):
+        make_filter('kalman')
+    assert make_filter('median', size=3).size == 3
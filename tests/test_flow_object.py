@@ -0,0 +1,99 @@
+from metrics import Histogram
+from PumpControl import PumpControl
+
+class RecordingGPIO:
+    LOW = 0
+    HIGH = 1
+
+    def __init__(self) -> None:
+        self.writes = []
+        self.duties = []
+
+    def output(self, pin: int, value: int) -> None:
+        self.writes.append((pin, value))
+
+    def PWM(self, pin: int, frequency: float) -> "RecordingPWM":
+        return RecordingPWM(self.duties)
+
+class RecordingPWM:
+    def __init__(self, duties: list) -> None:
+        self.duties = duties
+
+    def start(self, duty_cycle: float) -> None:
+        self.duties.append(duty_cycle)
+
+    def ChangeDutyCycle(self, duty_cycle: float) -> None:
+        self.duties.append(duty_cycle)
+
+class ManualClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+def test_repeated_states_write_nothing():
+    gpio = RecordingGPIO()
+    transitions = []
+    valve = PumpControl.FlowObject(gpio, 21, "Valve", on_transition=transitions.append)
+    assert gpio.writes == [(21, gpio.LOW)]
+
+    assert valve.set_state(True)
+    for _ in range(100):
+        assert not valve.set_state(True)
+    assert valve.set_state(False)
+    assert not valve.set_state(False)
+
+    assert gpio.writes == [(21, gpio.LOW), (21, gpio.HIGH), (21, gpio.LOW)]
+    assert transitions == [valve, valve]
+    assert valve.toggles == 2
+
+def test_force_rewrites_the_pin_without_a_transition():
+    gpio = RecordingGPIO()
+    transitions = []
+    valve = PumpControl.FlowObject(gpio, 21, "Valve", on_transition=transitions.append)
+    assert not valve.set_state(False, force=True)
+    assert gpio.writes == [(21, gpio.LOW), (21, gpio.LOW)]
+    assert transitions == []
+    assert valve.toggles == 0
+
+def test_on_time_and_last_transition():
+    clock = ManualClock()
+    pump = PumpControl.FlowObject(RecordingGPIO(), 17, "Inflation Pump", clock=clock)
+    clock.now = 1.0
+    pump.set_state(True)
+    clock.now = 3.5
+    assert pump.total_on_time() == 2.5
+    pump.set_state(False)
+    clock.now = 10.0
+    assert pump.on_time == 2.5
+    assert pump.total_on_time() == 2.5
+    assert pump.last_transition == 3.5
+
+def test_pwm_duty_is_only_written_when_it_changes():
+    gpio = RecordingGPIO()
+    transitions = []
+    write_time = Histogram('pin_write_seconds')
+    pump = PumpControl.FlowObject(gpio, 17, "Inflation Pump", pwm_frequency=100,
+                                  on_transition=transitions.append, write_time=write_time)
+    assert pump.set_duty(0.5)
+    assert not pump.set_duty(0.5)
+    assert not pump.set_duty(0.75)
+    assert pump.duty == 0.75
+    assert pump.set_duty(0)
+    assert gpio.duties == [0, 50, 75, 0]
+    assert len(transitions) == 2
+    assert write_time.count == 3
+
+def test_lock_out_keeps_the_pin_off():
+    gpio = RecordingGPIO()
+    pump = PumpControl.FlowObject(gpio, 17, "Inflation Pump")
+    pump.set_state(True)
+    pump.lock_out()
+    assert gpio.writes[-1] == (17, gpio.LOW)
+    assert pump.locked_out
+    pump.set_state(False)
+    assert not pump.set_state(True)
+    assert not pump.get_state()
+    assert not pump.set_duty(1.0)
+    assert gpio.writes[-1] == (17, gpio.LOW)
@@ -0,0 +1,77 @@
+import pytest
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+import live_plot
+from live_plot import LivePlot
+
+# Tk is not needed to draw: the plot runs on an Agg canvas and frames are scheduled by hand
+class FakeWidget:
+    def __init__(self) -> None:
+        self.scheduled = []
+
+    def after(self, interval: int, callback) -> None:
+        self.scheduled.append((interval, callback))
+
+class AggCanvas(FigureCanvasAgg):
+    def __init__(self, figure, master=None) -> None:
+        super().__init__(figure)
+        self.widget = FakeWidget()
+        self.blits = 0
+
+    def get_tk_widget(self) -> FakeWidget:
+        return self.widget
+
+    def blit(self, bbox=None) -> None:
+        self.blits += 1
+
+@pytest.fixture
+def plot(monkeypatch):
+    monkeypatch.setattr(live_plot, 'FigureCanvasTkAgg', AggCanvas)
+    plot = LivePlot(None, window=10.0, bins=100, series=('Cuff 1', 'Cuff 2'))
+    plot.reset(100.0, 300.0)
+    return plot
+
+def test_window_keeps_only_recent_samples(plot):
+    for n in range(2000):
+        plot.append(n * 0.01, 100.0)
+    assert len(plot.times[0]) in (1000, 1001)
+    x, y = plot.line_data(0)
+    assert -10.0 <= x[0] < -9.98
+    assert x[-1] == 0.0
+    assert plot.line_data(1) == ([], [])
+
+def test_session_view_keeps_the_minimum_and_maximum_of_every_bin(plot):
+    for n in range(10000):
+        plot.append(n * 0.01, 200.0 if n % 100 == 50 else (10.0 if n % 100 == 25 else 100.0))
+    plot.toggle_view()
+    x, y = plot.line_data(0)
+    assert len(x) == len(y) == 2 * 100
+    assert y[0::2] == [10.0] * 100
+    assert y[1::2] == [200.0] * 100
+    assert x[:2] == [0.5, 0.5]
+
+def test_frames_only_redraw_after_new_samples(plot):
+    plot.start()
+    canvas = plot.canvas
+    assert canvas.widget.scheduled[0][0] == 50
+    plot.redraw()
+    blits = canvas.blits
+    plot.redraw()
+    assert canvas.blits == blits
+    plot.extend([(0.1, 120.0, 0), (0.1, 130.0, 1)])
+    plot.redraw()
+    assert canvas.blits == blits + 1
+    assert list(plot.lines[1].get_ydata()) == [130.0]
+
+def test_y_axis_grows_when_the_pressure_leaves_the_plot(plot):
+    plot.start()
+    plot.append(1.0, 400.0)
+    plot.redraw()
+    assert plot.axis.get_ylim()[1] == pytest.approx(440.0)
+
+def test_reset_replaces_the_series(plot):
+    plot.append(1.0, 100.0)
+    plot.reset(60.0, 250.0, ('Cuff',))
+    assert [line.get_label() for line in plot.lines] == ['Cuff']
+    assert list(plot.times[0]) == []
+    assert plot.bin_width == pytest.approx(0.6)
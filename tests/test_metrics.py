@@ -0,0 +1,35 @@
+from metrics import Histogram, Metrics, render
+
+def bucket_counts(text: str, name: str) -> dict:
+    counts = {}
+    for line in text.splitlines():
+        if line.startswith(name + '_bucket'):
+            edge = line.split('le="')[1].split('"')[0]
+            counts[edge] = int(line.rsplit(' ', 1)[1])
+    return counts
+
+def test_count_histograms_export_small_buckets():
+    metrics = Metrics()
+    depth = metrics.histogram('log_queue_depth', unit=1)
+    for value in (0, 1, 3, 4, 20, 300):
+        depth.record(value)
+    counts = bucket_counts(render([metrics]), 'log_queue_depth')
+    assert counts['1'] == 2
+    assert counts['4'] == 4
+    assert counts['32'] == 5
+    assert counts['512'] == 6
+    assert counts['+Inf'] == 6
+
+def test_time_histograms_export_microseconds_to_seconds():
+    histogram = Histogram('adc_conversion_seconds')
+    histogram.record(3_000_000)
+    edges = histogram.cumulative()
+    assert edges[0][0] == 1024e-9
+    assert [count for edge, count in edges if edge < 2e-3] == [0] * 11
+    assert edges[-1][1] == 1
+
+def test_buckets_include_values_on_their_edge():
+    histogram = Histogram('control_loop_period_seconds')
+    for exponent in histogram.export_exponents:
+        histogram.record(1 << exponent)
+    assert [count for edge, count in histogram.cumulative()] == list(range(1, len(histogram.export_exponents) + 1))
@@ -0,0 +1,42 @@
+import csv
+
+from pressure_trace import TRACE_FIELDS, TraceWriter, export_trace_csv, iter_trace, read_trace
+from sampling import PressureSample
+
+def write_trace(file_name: str, count: int) -> None:
+    writer = TraceWriter(file_name, {'pressure': 150.0})
+    for index in range(count):
+        writer.write(PressureSample(index * 0.01, 0.5, float(index)), index % 5, index // 5)
+    writer.close()
+
+def test_trace_round_trip(tmp_path):
+    file_name = str(tmp_path / "session.trace")
+    write_trace(file_name, 12)
+    parameters, records = read_trace(file_name)
+    assert parameters == {'pressure': 150.0}
+    assert len(records) == 12
+    assert records['time'][3] == 0.03
+    assert records['pressure'][11] == 11.0
+    assert (records['phase'][10], records['trial'][10]) == (0, 2)
+    assert [record[2] for record in iter_trace(file_name)] == [float(index) for index in range(12)]
+
+# A trace cut short by a crash is read up to its last complete record
+def test_partial_last_record_is_ignored(tmp_path):
+    file_name = str(tmp_path / "session.trace")
+    write_trace(file_name, 3)
+    with open(file_name, 'ab') as file:
+        file.write(b'\x01\x02\x03')
+    _, records = read_trace(file_name)
+    assert len(records) == 3
+    assert len(list(iter_trace(file_name))) == 3
+
+def test_export_csv(tmp_path):
+    trace_file = str(tmp_path / "session.trace")
+    csv_file = str(tmp_path / "session.csv")
+    write_trace(trace_file, 4)
+    export_trace_csv(trace_file, csv_file)
+    with open(csv_file, newline='') as file:
+        rows = list(csv.reader(file))
+    assert rows[0] == TRACE_FIELDS
+    assert len(rows) == 5
+    assert float(rows[2][2]) == 1.0
@@ -0,0 +1,13 @@
+import pytest
+
+from protocol import compile_protocol
+from scheduler import Phase
+
+def test_phases_of_one_trial():
+    protocol = compile_protocol(1, 250, 2, 5, 2, 10)
+    assert [spec.phase for spec in protocol.phases] == [Phase.INFLATE, Phase.HOLD, Phase.DEFLATE]
+
+@pytest.mark.parametrize('trials', [0, 0.5, -1])
+def test_a_protocol_needs_a_trial(trials):
+    with pytest.raises(ValueError):
+        compile_protocol(trials, 250, 2, 5, 2, 10)
@@ -0,0 +1,105 @@
+import math
+
+import pytest
+
+from PumpControlSimulator import PumpControlSimulator, SimulatedGPIO
+from PumpControlTester import PumpControlTester
+
+# Like RPi.GPIO, writing a pin after it was released raises RuntimeError
+class ReleasingGPIO(SimulatedGPIO):
+    def __init__(self, *args) -> None:
+        super().__init__(*args)
+        self.released = set()
+
+    def output(self, pin: int, value: int) -> None:
+        if pin in self.released:
+            raise RuntimeError("The GPIO channel has not been set up as an OUTPUT")
+        super().output(pin, value)
+
+    def cleanup(self, channels=None) -> None:
+        super().cleanup(channels)
+        self.released.update(self.pins if channels is None else channels)
+
+class ReleasingSimulator(PumpControlSimulator):
+    def setup_hardware(self) -> None:
+        super().setup_hardware()
+        self.GPIO = ReleasingGPIO(self.cuff, self.sim_clock, self.InflateChannel, self.DeflateChannel, self.ValveChannel)
+
+@pytest.fixture(autouse=True)
+def session_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+def test_error_shuts_off_once_and_closes_the_log():
+    pump_control = ReleasingSimulator(1, 100, 0.2, 0.2, 0.2, 0, seed=1)
+
+    def failing_step(elapsed: float) -> None:
+        raise OSError("I2C read failed")
+    pump_control.hold_step = failing_step
+
+    assert pump_control.run_trials() == 'ERROR'
+    assert pump_control.shut_off
+    assert pump_control.session_log.closed
+    with open(pump_control.log_file.file_name) as file:
+        log = file.read()
+    assert log.count("Emergency Shutoff") == 1
+    assert "OSError: I2C read failed" in log
+
+def test_base_exceptions_propagate_after_shutoff():
+    pump_control = ReleasingSimulator(1, 100, 0.2, 0.2, 0.2, 0, seed=1)
+
+    def exiting_step(elapsed: float) -> None:
+        raise SystemExit(1)
+    pump_control.hold_step = exiting_step
+
+    with pytest.raises(SystemExit):
+        pump_control.run_trials()
+    assert pump_control.shut_off
+    assert pump_control.session_log.closed
+
+def test_completed_session():
+    pump_control = ReleasingSimulator(1, 100, 0.2, 0.2, 0.2, 0, seed=1)
+    assert pump_control.run_trials() == 'COMPLETE'
+    assert pump_control.session_log.closed
+
+def test_stopping_a_pwm_pump_logs_zero_duty():
+    pump_control = PumpControlSimulator(1, 100, 0.2, 0.2, 0.2, 0, seed=1, pwm_frequency=1000)
+    pump_control.apply_command(-0.5)
+    pump_control.apply_command(0.0)
+    assert math.copysign(1.0, pump_control.deflation_pump.duty) == 1.0
+    pump_control.emergency_shutoff()
+    pump_control.close_log()
+    with open(pump_control.log_file.file_name) as file:
+        assert '-0.0' not in file.read()
+
+def test_tester_runs_the_pump_control_session():
+    pump_control = PumpControlTester(1, 100, 0.2, 0.2, 0.2, 0)
+    samples = []
+    assert pump_control.run_trials(on_sample=samples.append) == 'COMPLETE'
+    assert samples
+    assert pump_control.shut_off
+    with open(pump_control.log_file.file_name) as log:
+        assert 'PARAMETER' in log.read()
+
+def test_stop_in_the_last_phase_halts_the_session():
+    pump_control = PumpControlSimulator(1, 100, 0.2, 0.2, 0.2, 0, seed=1)
+    last = pump_control.protocol.phases[-1]
+    assert pump_control.run_trials(lambda: pump_control.phase_spec is not last) == 'HALTED'
+
+def test_without_session_files_nothing_is_written(tmp_path):
+    pump_control = PumpControlSimulator(1, 100, 0.2, 0.2, 0.2, 0, seed=1, session_files=False)
+    pump_control.read_voltage()
+    pump_control.raise_pressure(20)
+    pump_control.emergency_shutoff()
+    pump_control.close_log()
+    assert pump_control.log_file.file_name is None
+    assert list(tmp_path.iterdir()) == []
+
+def test_pressure_loops_log_instead_of_printing(capsys):
+    pump_control = PumpControlSimulator(1, 100, 0.2, 0.2, 0.2, 0, seed=1)
+    pump_control.raise_pressure(50)
+    pump_control.lower_pressure(10)
+    pump_control.close_log()
+    assert capsys.readouterr().out == ''
+    with open(pump_control.log_file.file_name) as file:
+        log = file.read()
+    assert "Raise Pressure End" in log and "Lower Pressure End" in log
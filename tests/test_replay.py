@@ -0,0 +1,31 @@
+import os
+
+import pytest
+
+from PumpControlSimulator import PumpControlSimulator
+from PumpControlReplay import RecordedPressure, replay_session
+from scheduler import Phase
+
+@pytest.fixture(autouse=True)
+def session_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+@pytest.fixture
+def trace_file():
+    pump_control = PumpControlSimulator(2, 100, 0.2, 0.2, 0.2, 0.2, seed=1)
+    assert pump_control.run_trials() == 'COMPLETE'
+    return pump_control.log_file.trace_file_name
+
+def test_recording_seeks_to_the_first_record_of_a_phase(trace_file):
+    recording = RecordedPressure(trace_file)
+    start = next(index for index, trial, phase in recording.segments if trial == 1 and phase == Phase.HOLD)
+    recording.seek(1, Phase.HOLD, 10.0)
+    sample = recording.read(10.0)
+    assert sample.timestamp == recording.times[start]
+    assert sample.pressure == float(recording.pressures[start])
+
+def test_replay_writes_its_files_to_the_output_directory(trace_file, tmp_path):
+    summary = replay_session(trace_file, output_dir=str(tmp_path / "replays"))
+    assert summary['phases']['hold']['ticks'] > 0
+    assert not [name for name in os.listdir(tmp_path) if name.startswith("Replay_")]
+    assert sorted(os.path.splitext(name)[1] for name in os.listdir(tmp_path / "replays")) == ['.csv', '.trace']
@@ -0,0 +1,20 @@
+import pytest
+
+from PumpControlSimulator import PumpControlSimulator
+from safety_supervisor import SafetyLimits, SafetySupervisor
+
+@pytest.fixture(autouse=True)
+def session_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+def test_heartbeat_timeout_covers_slow_control_loops():
+    pump_control = PumpControlSimulator(1, 100, 0.5, 0.25, 0.25, 0, seed=1, speed=1, control_frequency=4.0)
+    assert pump_control.supervisor.heartbeat_timeout == 0.75
+    assert pump_control.run_trials() == 'COMPLETE'
+    assert pump_control.safety_trip is None
+
+def test_heartbeat_timeout_keeps_the_limit_for_fast_loops():
+    pump_control = PumpControlSimulator(1, 100, 0.2, 0.2, 0.2, 0, seed=1, safety_limits=None)
+    supervisor = SafetySupervisor(pump_control, SafetyLimits(heartbeat_timeout=0.2))
+    assert supervisor.heartbeat_timeout == 0.2
+    pump_control.close_log()
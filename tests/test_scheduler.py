@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+
+from async_runtime import AsyncTickScheduler
+from scheduler import Phase, TickScheduler
+
+# Clock that only moves when stepped or slept. Rejects negative sleeps like time.sleep
+# and asyncio.sleep would on a real clock
+class ManualClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        if seconds < 0:
+            raise ValueError("sleep length must be non-negative")
+        self.now += seconds
+
+    async def async_sleep(self, seconds: float) -> None:
+        self.sleep(seconds)
+
+# Reads in whole nanoseconds, like the session clock
+class NanosecondClock(ManualClock):
+    def time(self) -> float:
+        return round(self.now * 1e9) / 1e9
+
+# Run one phase on the blocking or the async scheduler
+def run_phase(kind: str, clock: ManualClock, duration: float, step):
+    if kind == 'sync':
+        return TickScheduler(100.0, clock.time, clock.sleep).run_phase(Phase.HOLD, duration, step)
+    scheduler = AsyncTickScheduler(100.0, clock.time, clock.async_sleep)
+    return asyncio.run(scheduler.run_phase(Phase.HOLD, duration, step))
+
+# Steps take 4 ms, except the last tick of the phase which runs 50 ms past its end
+def overrunning_step(clock: ManualClock):
+    def step(elapsed: float) -> None:
+        clock.now += 0.004 if elapsed < 0.03 else 0.05
+    return step
+
+@pytest.mark.parametrize('kind', ['sync', 'async'])
+def test_final_step_overrun_ends_the_phase(kind):
+    clock = ManualClock()
+    stats = run_phase(kind, clock, 0.035, overrunning_step(clock))
+    assert stats.ticks == 4
+    assert stats.overruns == 1
+    assert abs(stats.duration - 0.08) < 1e-9
+
+@pytest.mark.parametrize('kind', ['sync', 'async'])
+def test_phase_ends_on_time(kind):
+    clock = ManualClock()
+    stats = run_phase(kind, clock, 0.035, lambda elapsed: None)
+    assert stats.ticks == 4
+    assert stats.overruns == 0
+    assert abs(stats.duration - 0.035) < 1e-9
+
+# 0.4 + 0.2 is a hair above 0.6, less than a nanosecond the clock can show
+@pytest.mark.parametrize('kind', ['sync', 'async'])
+def test_phase_ends_within_the_clock_resolution(kind):
+    clock = NanosecondClock()
+    clock.now = 0.4
+    stats = run_phase(kind, clock, 0.2, lambda elapsed: None)
+    assert stats.ticks == 20
@@ -0,0 +1,59 @@
+import math
+
+import numpy as np
+import pytest
+
+from pressure_trace import TraceWriter
+from sampling import PressureSample
+from scheduler import Phase
+from session_analytics import Session, analyse_sessions, segments, trial_metrics
+
+# One trial at 10 Hz: a 10 s ramp to 100 mmHg, 5 s hold with one 105 mmHg reading, a 10 s
+# ramp down to 0
+def synthetic_session() -> Session:
+    ramp = np.arange(0, 10, 0.1)
+    time = np.concatenate((ramp, 10 + np.arange(0, 5, 0.1), 15 + ramp))
+    pressure = np.concatenate((10 * ramp, np.full(50, 100.0), 100 - 10 * ramp))
+    pressure[120] = 105.0
+    phase = np.repeat([Phase.INFLATE, Phase.HOLD, Phase.DEFLATE], [100, 50, 100])
+    parameters = {'pressure': 100.0, 'inflate_time': 10.0, 'hold_time': 5.0, 'deflate_time': 10.0}
+    return Session('synthetic.trace', parameters, time, pressure, phase, np.zeros(250, dtype=np.int64))
+
+def test_segments_split_the_session_by_trial_and_phase():
+    spans = segments(synthetic_session())
+    assert spans == {(0, Phase.INFLATE): (0, 100), (0, Phase.HOLD): (100, 150), (0, Phase.DEFLATE): (150, 250)}
+
+def test_trial_metrics():
+    session = synthetic_session()
+    metrics = trial_metrics(session, 0, segments(session))
+    # 10 mmHg is reached at 1 s and 90 mmHg at 9 s
+    assert metrics['rise_time'] == pytest.approx(8.0)
+    assert metrics['overshoot'] == pytest.approx(5.0)
+    assert metrics['hold_mean'] == pytest.approx(100.1)
+    assert metrics['deflate_slope'] == pytest.approx(-10.0)
+    assert metrics['desired_deflate_slope'] == pytest.approx(-10.0)
+    assert metrics['deflate_slope_error'] == pytest.approx(0.0)
+    assert metrics['inflate_time'] == pytest.approx(9.9)
+
+def test_missing_phases_give_nan():
+    session = synthetic_session()
+    spans = segments(session)
+    del spans[(0, Phase.DEFLATE)]
+    metrics = trial_metrics(session, 0, spans)
+    assert math.isnan(metrics['deflate_slope'])
+    assert math.isnan(metrics['deflate_time'])
+
+# The process pool returns the same rows, in file order, as analysing one file at a time
+def test_sessions_analysed_in_parallel_keep_their_order(tmp_path):
+    session = synthetic_session()
+    file_names = []
+    for number in range(3):
+        file_name = str(tmp_path / ('session_' + str(number) + '.trace'))
+        writer = TraceWriter(file_name, {**session.parameters, 'number_of_trials': 1})
+        for time, pressure, phase in zip(session.time, session.pressure + number, session.phase):
+            writer.write(PressureSample(float(time), 0.0, float(pressure)), int(phase), 0)
+        writer.close()
+        file_names.append(file_name)
+    rows = analyse_sessions(file_names, workers=2)
+    assert [row['session'] for row in rows] == ['session_0.trace', 'session_1.trace', 'session_2.trace']
+    assert rows == analyse_sessions(file_names, workers=1)
@@ -0,0 +1,39 @@
+from datetime import datetime
+
+from session_clock import SessionClock
+
+class ManualClock:
+    def __init__(self, now: int) -> None:
+        self.now = now
+
+    def __call__(self) -> int:
+        return self.now
+
+def test_offsets_count_from_the_session_start():
+    clock = ManualClock(5_000_000_000)
+    session_clock = SessionClock(clock, lambda: 1_700_000_000_000_000_000)
+    assert session_clock.time_ns() == 0
+    clock.now += 1_500_000_001
+    assert session_clock.time_ns() == 1_500_000_001
+    assert session_clock.time() == 1.500000001
+
+def test_wall_time_is_only_read_once():
+    reads = []
+
+    def wall_ns() -> int:
+        reads.append(None)
+        return 1_700_000_000_000_000_000
+    session_clock = SessionClock(ManualClock(0), wall_ns)
+    assert session_clock.wall_time_ns(250_000_000) == 1_700_000_000_250_000_000
+    session_clock.format(0)
+    session_clock.anchor()
+    assert len(reads) == 1
+
+def test_format_and_anchor():
+    wall_start_ns = 1_700_000_000_000_000_000
+    session_clock = SessionClock(ManualClock(0), lambda: wall_start_ns)
+    expected = datetime.fromtimestamp(1_700_000_000.25)
+    assert session_clock.wall_time(250_000_000) == expected
+    assert session_clock.format(250_000_000) == expected.strftime("%Y-%m-%d %H:%M:%S.%f")
+    assert session_clock.anchor() == {'start': datetime.fromtimestamp(1_700_000_000).isoformat(),
+                                      'wall_start_ns': wall_start_ns}
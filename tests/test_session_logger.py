@@ -0,0 +1,27 @@
+from session_logger import FileHandler
+
+# Sessions started in the same second must not share their files
+def test_sessions_in_the_same_second_get_their_own_files(tmp_path):
+    prefix = str(tmp_path / "Log_")
+    handlers = [FileHandler(prefix) for _ in range(3)]
+    assert len({handler.file_name for handler in handlers}) == 3
+    assert len({handler.trace_file_name for handler in handlers}) == 3
+
+def test_read_file_prints_the_closed_log(tmp_path, capsys):
+    handler = FileHandler(str(tmp_path / "Log_"))
+    logger = handler.open_logger(['Time', 'Object'])
+    logger.log(['12:00:00', 'valve'])
+    logger.close()
+    handler.read_file()
+    printed = capsys.readouterr().out.splitlines()
+    assert printed == ["#1 ['Time', 'Object']", "#2 ['12:00:00', 'valve']"]
+
+# Every row must fit the header, also when rows were dropped
+def test_dropped_rows_add_no_row(tmp_path):
+    handler = FileHandler(str(tmp_path / "Log_"))
+    logger = handler.open_logger(['t_ns', 'kind'])
+    logger.log([1, 'NOTE'])
+    logger.dropped = 3
+    logger.close()
+    with open(handler.file_name) as file:
+        assert file.read().splitlines() == ['t_ns,kind', '1,NOTE']
@@ -0,0 +1,41 @@
+import pytest
+
+from PumpControlSimulator import CuffModel, PumpControlSimulator, SimulatedClock
+
+@pytest.fixture(autouse=True)
+def session_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+def test_inflation_stalls_below_the_stall_pressure():
+    cuff = CuffModel(sensor_noise=0.0)
+    cuff.inflate_duty = 1.0
+    cuff.advance(1.0)
+    rising = cuff.pressure
+    assert rising > 0
+    cuff.advance(60.0)
+    assert rising < cuff.pressure < cuff.stall_pressure
+
+def test_open_valve_vents_the_cuff():
+    cuff = CuffModel(sensor_noise=0.0)
+    cuff.pressure = cuff.sensed_pressure = 200.0
+    cuff.valve_open = True
+    cuff.advance(5.0)
+    assert cuff.pressure < 1.0
+
+def test_simulated_clock_only_moves_when_slept():
+    clock = SimulatedClock()
+    clock.sleep(0.25)
+    clock.sleep(-1.0)
+    assert clock.time() == 0.25
+    assert clock.time_ns() == 250_000_000
+
+# A seeded session reaches the desired pressure and replays identically
+def test_seeded_sessions_are_reproducible():
+    pressures = []
+    for _ in range(2):
+        pump_control = PumpControlSimulator(1, 150, 2, 1, 2, 0, seed=3)
+        samples = []
+        assert pump_control.run_trials(on_sample=samples.append) == 'COMPLETE'
+        pressures.append([sample.pressure for sample in samples])
+    assert pressures[0] == pressures[1]
+    assert max(pressures[0]) > 140
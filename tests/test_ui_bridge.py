@@ -0,0 +1,26 @@
+import threading
+
+from ui_bridge import UiBridge
+
+def test_drain_keeps_arrival_order():
+    bridge = UiBridge()
+    bridge.push_event('status', 'Running Trials...')
+    bridge.push_sample(0.01, 10.0)
+    bridge.push_sample(0.02, 12.0, 1)
+    bridge.push_event('finished', 'COMPLETE')
+    samples, events = bridge.drain()
+    assert samples == [(0.01, 10.0, 0), (0.02, 12.0, 1)]
+    assert events == [('status', 'Running Trials...'), ('finished', 'COMPLETE')]
+    assert bridge.drain() == ([], [])
+
+# Samples pushed from a trial thread all arrive, in order, across several drains
+def test_samples_from_another_thread():
+    bridge = UiBridge()
+    thread = threading.Thread(target=lambda: [bridge.push_sample(index, float(index)) for index in range(5000)])
+    thread.start()
+    received = []
+    while thread.is_alive():
+        received += bridge.drain()[0]
+    thread.join()
+    received += bridge.drain()[0]
+    assert [sample[0] for sample in received] == list(range(5000))
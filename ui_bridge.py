@@ -0,0 +1,45 @@
+#!/usr/bin/python3.9.6
+import queue
+
+### Trial Thread to Tk Bridge ###
+# Tk widgets and matplotlib may only be touched from the thread running the mainloop.
+# The trial thread only pushes samples and events onto a queue, which never blocks and
+# never waits on the display. The Tk side drains the queue from a periodic after()
+# callback and applies everything that arrived since the last drain as one UI update.
+class UiBridge:
+    SAMPLE = 0
+    EVENT = 1
+
+    def __init__(self) -> None:
+        self.__queue = queue.SimpleQueue()
+
+    ### Trial thread side ###
+    # series is the plot line the sample belongs to, i.e. the cuff when several cuffs run
+    def push_sample(self, elapsed: float, pressure: float, series: int = 0) -> None:
+        # Input: float (seconds since session start), float (mmHg), int (series index)
+        # Return: None
+        self.__queue.put((self.SAMPLE, elapsed, pressure, series))
+
+    # Events are (name, value) pairs, i.e. ('status', 'Running Trials...')
+    def push_event(self, name: str, value=None) -> None:
+        # Input: str (event name), optional value
+        # Return: None
+        self.__queue.put((self.EVENT, name, value, None))
+
+    ### Tk side ###
+    # Take everything queued so far, keeping samples and events in arrival order
+    def drain(self) -> tuple:
+        # Input: None
+        # Return: tuple (list of (elapsed, pressure, series), list of (name, value))
+        samples, events = [], []
+        get = self.__queue.get_nowait
+        try:
+            while True:
+                kind, first, second, third = get()
+                if kind == self.SAMPLE:
+                    samples.append((first, second, third))
+                else:
+                    events.append((first, second))
+        except queue.Empty:
+            pass
+        return samples, events